@@ -0,0 +1,508 @@
+#! /usr/bin/env python3
+#
+#   Foresail Project // Turku University
+#   Department of Future Technologies
+#   Embedded Systems Laboratory
+#
+#   Benchmark writesd.py image writing without SD cards.
+#
+#   benchsd.py - 2026, Jani Tammi <jasata@utu.fi>
+#   0.1.0   2026-10-19  Initial version.
+#   0.2.0   2026-10-19  'discard' strategy, erase cost in simulated card,
+#                       real device target (--device).
+#
+#
+#   Each write strategy is run against each target and timed:
+#
+#       Strategies  dd              As writesd.py: dd bs=4M conv=fsync
+#                   native          writesd.write_image()
+#                   native-sparse   writesd.write_image(sparse = True)
+#                                   (sim only - skipped holes on the filled
+#                                   targets would keep their old data)
+#                   discard         writesd.discard_device() (whole target)
+#                                   followed by native-sparse, if discarded
+#                                   blocks read as zeros (native otherwise)
+#
+#       Targets     file            Regular (pre-allocated) file
+#                   loop            Loop device on top of a file (root only)
+#                   sim             Simulated card (file-backed model with
+#                                   per-write latency, bandwidth limit, erase
+#                                   and read-modify-write penalties)
+#                   dev             Real card ('--device', root only).
+#                                   ALL DATA ON THE DEVICE IS DESTROYED!
+#
+#   Targets are "used" before each run: loop and dev are filled with data
+#   (as a card that has been written before), simulated card has
+#   '--sim-used' of its erase blocks dirty. This is what discard removes.
+#
+#   The image is synthetic (sparse file, '--fill' of it containing data,
+#   in 4 MB blocks spread over the image) unless '--image' is given.
+#   With a real image, a loop target and root, the '--customise' phase
+#   mounts the written image partitions and times the writesd.py -style
+#   modifications (file copies into /boot and rootfs).
+#
+#   Commandline:
+#       ./benchsd.py                            # 1 GB image, 30% data
+#       ./benchsd.py --size 4096 --fill 0.4 --target sim --sim-used 0.5
+#       sudo ./benchsd.py --image raspbian.img --target loop --customise
+#       sudo ./benchsd.py --device /dev/sdb --strategy native --strategy discard
+#
+#   NOTE: File and loop targets measure mostly the page cache and the disk
+#         of this machine. Simulated card gives relative numbers for the
+#         strategies (number and size of writes), not absolute card speeds.
+#
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+# Python 3.5 or newer
+if sys.version_info < (3, 5):
+    print("You need Python 3.5 or newer!")
+    os._exit(1)
+
+import writesd
+
+
+# PEP 396 -- Module Version Numbers https://www.python.org/dev/peps/pep-0396/
+__version__ = "0.2.0"
+__author__  = "Jani Tammi <jasata@utu.fi>"
+VERSION = __version__
+HEADER  = """
+=============================================================================
+University of Turku, Department of Future Technologies
+ForeSail-1 / PATE Monitor SD card write benchmark
+Version {}, 2026 {}
+""".format(__version__, __author__)
+
+
+#
+# GLOBAL Application Variables
+#
+class App:
+    size            = 1024          # Synthetic image size, MB
+    fill            = 0.3           # Synthetic image data ratio
+    blocksize       = 4 * 1024**2   # Write chunk (as dd bs=4M)
+    strategies      = ["dd", "native", "native-sparse", "discard"]
+    targets         = ["file", "loop", "sim"]
+    device          = None          # Real device for 'dev' target
+    class Sim:
+        latency     = 0.002         # Seconds per write() call
+        bandwidth   = 20 * 1024**2  # Bytes per second (sequential)
+        erase_block = 4 * 1024**2   # Erase block (allocation unit) size
+        erase       = 0.005         # Seconds to erase one dirty erase block
+        used        = 0.0           # Ratio of erase blocks already dirty
+
+
+###############################################################################
+#
+# Simulated card
+#
+#   Backed by a regular file (so that the result can be verified), but each
+#   write() is "charged" a time cost instead of sleeping:
+#
+#       latency + len / bandwidth
+#       + erase                     for each erase block the write touches
+#                                   that already holds data (not erased)
+#       + erase_block / bandwidth   if the write partially covers such a
+#                                   block (card has to read-modify-write
+#                                   the whole block)
+#
+#   Seeks (holes skipped by sparse writing) cost nothing. Dirty blocks are
+#   cleaned only by discard(), at the cost of one write call latency per
+#   discard request (card erases them in the background).
+#
+class SimulatedCard:
+    """File-like object for write_image()."""
+    def __init__(self, path: str, size: int, used: float = App.Sim.used):
+        self.path   = path
+        self.file   = open(path, "w+b", buffering = 0)
+        self.file.truncate(size)
+        self.elapsed = 0.0
+        self.writes = 0
+        self.rmw    = 0
+        self.erases = 0
+        eb = App.Sim.erase_block
+        count = (size + eb - 1) // eb
+        # Spread 'used' dirty blocks evenly over the card
+        step = 1 / used if used > 0 else 0
+        self.dirty = set(
+            int(i * step) for i in range(int(count * used))
+        ) if used > 0 else set()
+    def fileno(self) -> int:
+        return self.file.fileno()
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self.file.seek(offset, whence)
+    def tell(self) -> int:
+        return self.file.tell()
+    def write(self, data) -> int:
+        eb = App.Sim.erase_block
+        offset = self.file.tell()
+        count = self.file.write(data)
+        self.writes += 1
+        self.elapsed += App.Sim.latency + count / App.Sim.bandwidth
+        block = offset // eb
+        while block * eb < offset + count:
+            covered = min(offset + count, (block + 1) * eb) - max(offset, block * eb)
+            if block in self.dirty:
+                self.erases += 1
+                self.elapsed += App.Sim.erase
+                if covered < eb:
+                    # Partial write into a dirty block => read-modify-write
+                    self.rmw += 1
+                    self.elapsed += eb / App.Sim.bandwidth
+            self.dirty.add(block)
+            block += 1
+        return count
+    def discard(self, offset: int, length: int):
+        """Erase blocks fully within the range become clean."""
+        eb = App.Sim.erase_block
+        self.elapsed += App.Sim.latency
+        for block in range(-(-offset // eb), (offset + length) // eb):
+            self.dirty.discard(block)
+    def flush(self):
+        pass
+    def close(self):
+        self.file.close()
+
+
+###############################################################################
+#
+# Image and targets
+#
+
+def synthetic_image(path: str, size: int, fill: float) -> int:
+    """Create a sparse image of 'size' bytes, 'fill' of it random data.
+    Returns the number of data bytes."""
+    bs = App.blocksize
+    count = size // bs
+    data = int(count * fill)
+    step = count / data if data else 0
+    with open(path, "wb") as file:
+        file.truncate(size)
+        for i in range(data):
+            file.seek(int(i * step) * bs)
+            file.write(os.urandom(bs))
+    return data * bs
+
+
+class Target:
+    """Prepared target. 'device' is the path to write into."""
+    def __init__(self, kind: str, directory: str, size: int):
+        self.kind   = kind
+        self.size   = size
+        self.file   = os.path.join(directory, "target." + kind)
+        self.device = self.file
+        self.sim    = None
+        if kind == "sim":
+            self.sim = SimulatedCard(self.file, size, App.Sim.used)
+            return
+        if kind == "dev":
+            self.file = None
+            self.device = App.device
+            if writesd.device_size(self.device) < size:
+                raise ValueError("'{}' is smaller than the image!".format(
+                    self.device
+                ))
+        else:
+            with open(self.file, "wb") as file:
+                file.truncate(size)
+        if kind == "loop":
+            self.device = subprocess.run(
+                ["losetup", "--find", "--show", self.file],
+                stdout = subprocess.PIPE, check = True
+            ).stdout.decode().strip()
+        self.fill()
+    def fill(self):
+        """Fill with (non-zero) data, as a previously used card would be."""
+        pattern = os.urandom(App.blocksize)
+        with open(self.device, "r+b", buffering = 0) as file:
+            for offset in range(0, self.size, len(pattern)):
+                file.write(pattern[:self.size - offset])
+            os.fsync(file.fileno())
+    def release(self):
+        if self.sim:
+            self.sim.close()
+        if self.kind == "loop":
+            subprocess.run(["losetup", "--detach", self.device])
+        if self.file:
+            os.unlink(self.file)
+
+
+class Result:
+    def __init__(self, strategy: str, target: str):
+        self.strategy   = strategy
+        self.target     = target
+        self.status     = "n/a"
+        self.write      = 0.0
+        self.written    = 0             # Bytes actually written
+        self.size       = 0             # Image size
+        self.customise  = None
+        self.verify     = None
+        self.detail     = ""
+
+
+def drop_caches():
+    """Drop page cache (root only), so that each run reads the image from
+    disk as writesd.py would."""
+    try:
+        os.sync()
+        with open("/proc/sys/vm/drop_caches", "w") as file:
+            file.write("3")
+    except OSError:
+        pass
+
+
+def run_write(strategy: str, image: str, target: Target, result: Result):
+    size = result.size = os.path.getsize(image)
+    start = time.monotonic()
+    if strategy == "dd":
+        if target.sim:
+            result.detail = "dd cannot write to simulated card"
+            return
+        writesd.do_or_die(
+            "dd if={} of={} bs=4M conv=fsync,notrunc status=none".format(
+                image, target.device
+            )
+        )
+        result.written = size
+    elif strategy == "discard":
+        if target.kind == "file":
+            result.detail = "regular file cannot be discarded"
+            return
+        if target.sim:
+            target.sim.discard(0, target.size)
+            sparse = True
+        else:
+            writesd.discard_device(target.device, [(0, target.size)])
+            sparse = writesd.discard_zeroes(target.device, [(0, target.size)])
+        discarded = time.monotonic() - start
+        result.written, _ = writesd.write_image(
+            image,
+            target.sim or target.device,
+            App.blocksize,
+            sparse = sparse
+        )
+        result.detail = "discard {:.2f}s{}, ".format(
+            discarded, "" if sparse else " (not zeroed)"
+        )
+    else:
+        if strategy == "native-sparse" and not target.sim:
+            # Holes are not written, target would keep old data in them
+            result.detail = "target is not zeroed (use discard)"
+            return
+        result.written, _ = writesd.write_image(
+            image,
+            target.sim or target.device,
+            App.blocksize,
+            sparse = (strategy == "native-sparse")
+        )
+    result.write = time.monotonic() - start
+    if target.sim:
+        result.write = target.sim.elapsed
+        result.detail += "{} writes, {} erases, {} RMW".format(
+            target.sim.writes, target.sim.erases, target.sim.rmw
+        )
+    elif result.written < size:
+        result.detail += "{:.0f} MB skipped".format(
+            (size - result.written) / 1024**2
+        )
+    result.status = "OK"
+
+
+def run_customise(target: Target, directory: str) -> float:
+    """Mount partitions of the written image and do writesd.py -like
+    modifications. Returns seconds. Partitions are mounted by offset,
+    so that partition device nodes (udev) are not needed."""
+    mnt = os.path.join(directory, "mnt")
+    os.makedirs(mnt, exist_ok = True)
+    start = time.monotonic()
+    parts = writesd.partition_table(target.device)
+    for (_, _, offset, size), files in zip(
+        parts[:2], (["ssh", "install.py"], ["etc/run-once.marker"])
+    ):
+        subprocess.run(
+            [
+                "mount", "-o",
+                "loop,offset={},sizelimit={}".format(offset, size),
+                target.device, mnt
+            ],
+            check = True
+        )
+        try:
+            for name in files:
+                path = os.path.join(mnt, name)
+                os.makedirs(os.path.dirname(path), exist_ok = True)
+                with open(path, "w") as file:
+                    file.write("benchsd\n")
+        finally:
+            subprocess.run(["umount", mnt], check = True)
+    return time.monotonic() - start
+
+
+def result_table(results: list) -> str:
+    def t(value):
+        return "" if value is None else "{:.2f}s".format(value)
+    # MB/s is effective: image size per write time
+    lines = [
+        "{:<14} {:<6} {:<7} {:>9} {:>9} {:>9} {:>9}  {}".format(
+            "STRATEGY", "TARGET", "STATUS", "WRITE", "MB/s",
+            "CUSTOM", "VERIFY", "DETAIL"
+        )
+    ]
+    for r in results:
+        lines.append(
+            "{:<14} {:<6} {:<7} {:>9} {:>9} {:>9} {:>9}  {}".format(
+                r.strategy,
+                r.target,
+                r.status,
+                t(r.write) if r.status != "n/a" else "",
+                "{:.1f}".format(r.size / 1024**2 / r.write) if r.write else "",
+                t(r.customise),
+                t(r.verify),
+                r.detail
+            )
+        )
+    return "\n".join(lines)
+
+
+##############################################################################
+#
+# MAIN
+#
+##############################################################################
+if __name__ == '__main__':
+
+    #
+    # Commandline arguments
+    #
+    parser = argparse.ArgumentParser(
+        description     = HEADER,
+        formatter_class = argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        '--image',
+        help    = "Use real image instead of a synthetic one.",
+        metavar = "FILE"
+    )
+    parser.add_argument(
+        '--size',
+        help    = "Synthetic image size in MB. Default: {}".format(App.size),
+        type    = int,
+        default = App.size
+    )
+    parser.add_argument(
+        '--fill',
+        help    = "Synthetic image data ratio. Default: {}".format(App.fill),
+        type    = float,
+        default = App.fill
+    )
+    parser.add_argument(
+        '--strategy',
+        help    = "Write strategy. Can be repeated. Default: all",
+        choices = App.strategies,
+        action  = 'append'
+    )
+    parser.add_argument(
+        '--target',
+        help    = "Target type. Can be repeated. Default: all",
+        choices = App.targets + ["dev"],
+        action  = 'append'
+    )
+    parser.add_argument(
+        '--sim-used',
+        help    = "Ratio of simulated card erase blocks already containing\n" +
+                  "data. Default: {}".format(App.Sim.used),
+        type    = float,
+        default = App.Sim.used
+    )
+    parser.add_argument(
+        '--device',
+        help    = "Real device for 'dev' target (implies '--target dev').\n" +
+                  "ALL DATA ON THE DEVICE IS DESTROYED!",
+        metavar = "DEVICE"
+    )
+    parser.add_argument(
+        '--customise',
+        help    = "Time mount-and-modify phase (--image, loop target, root).",
+        action  = 'store_true'
+    )
+    parser.add_argument(
+        '--verify',
+        help    = "Time read back verification.",
+        action  = 'store_true'
+    )
+    parser.add_argument(
+        '--dir',
+        help    = "Directory for image and targets. Default: system temp.",
+        default = None
+    )
+    args = parser.parse_args()
+
+    App.Sim.used = args.sim_used
+    App.device = args.device
+    strategies = args.strategy or App.strategies
+    targets = args.target or ([] if args.device else App.targets)
+    if args.device and "dev" not in targets:
+        targets.append("dev")
+    if "dev" in targets and not (args.device and os.geteuid() == 0):
+        print("ERROR: 'dev' target requires --device and root privileges!")
+        os._exit(1)
+    if "loop" in targets and os.geteuid() != 0:
+        if args.target:
+            print("ERROR: 'loop' target requires root privileges!")
+            os._exit(1)
+        targets.remove("loop")
+    if args.device and writesd.disk_is_mounted(args.device):
+        print("ERROR: '{}' has mounted partitions!".format(args.device))
+        os._exit(1)
+    if args.customise and not (args.image and "loop" in targets):
+        print("ERROR: --customise requires --image and 'loop' target!")
+        os._exit(1)
+
+    print(HEADER)
+    with tempfile.TemporaryDirectory(dir = args.dir) as directory:
+        if args.image:
+            image = args.image
+            data = os.path.getsize(image)
+        else:
+            image = os.path.join(directory, "synthetic.img")
+            data = synthetic_image(image, args.size * 1024**2, args.fill)
+        size = os.path.getsize(image)
+        print(
+            "Image: {} ({:.0f} MB, {:.0f} MB data)".format(
+                image, size / 1024**2, data / 1024**2
+            )
+        )
+        results = []
+        for kind in targets:
+            for strategy in strategies:
+                result = Result(strategy, kind)
+                results.append(result)
+                print("{} -> {}... ".format(strategy, kind), end = '', flush = True)
+                target = Target(kind, directory, size)
+                try:
+                    drop_caches()
+                    run_write(strategy, image, target, result)
+                    if result.status == "OK" and args.customise and kind == "loop":
+                        result.customise = run_customise(target, directory)
+                    if result.status == "OK" and args.verify and not args.customise:
+                        drop_caches()
+                        start = time.monotonic()
+                        if not writesd.verify_image(image, target.device):
+                            result.status = "BAD"
+                        result.verify = time.monotonic() - start
+                except Exception as e:
+                    result.status = "FAILED"
+                    result.detail = str(e).splitlines()[0] if str(e) else repr(e)
+                finally:
+                    target.release()
+                print(result.status)
+        print("")
+        print(result_table(results))
+    os._exit(0 if all(r.status in ("OK", "n/a") for r in results) else 1)
+
+
+# EOF
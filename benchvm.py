@@ -0,0 +1,755 @@
+#! /usr/bin/env python3
+#
+#   Foresail Project // Turku University
+#   Department of Future Technologies
+#   Embedded Systems Laboratory
+#
+#   Load test nginx and uWSGI configuration generated by vminstall.py.
+#
+#   benchvm.py - 2026, Jani Tammi <jasata@utu.fi>
+#   0.1.0   2026-10-19  Initial version.
+#
+#
+#   For each tuning profile ('--profile', vminstall.py 'profiles'), the
+#   nginx site and uWSGI ini are generated from vminstall.py templates
+#   exactly as the installer does, relocated into a temporary directory
+#   and started as this user:
+#
+#       /run/uwsgi/app/vm.utu.fi/   ->  <tmp>/<profile>/run/
+#       /var/log/...                ->  <tmp>/<profile>/log/
+#       /var/www/vm.utu.fi          ->  application directory
+#       /etc/ssl/.../vm.utu.fi.*    ->  <tmp>/ (self-signed, ECDSA P-256)
+#       listen 443 ssl              ->  listen 127.0.0.1:<port> ssl
+#
+#   Port 80 redirect server, IPv6 listens and uid/gid are left out. The
+#   'listen' backlog is limited to net.core.somaxconn of this machine
+#   (vminstall.py raises it with sysctl).
+#
+#   Application is a stand-in WSGI callable (application.py, '--delay'
+#   seconds per request, '--size' bytes response) with a static directory,
+#   or a real application directory ('--app', such as a clone of the
+#   vm.utu.fi site with its instance/ configuration).
+#
+#   Load is HTTP/1.1 over TLS with keep-alive, '--connections' concurrent
+#   connections for '--duration' seconds, spread over '--clients' client
+#   processes. Requests during first '--warmup' seconds are not counted.
+#   Without nginx ('--direct', or if nginx is not installed) the uWSGI
+#   unix socket is loaded directly with the uwsgi protocol (one connection
+#   per request, as nginx does).
+#
+#   '--url' loads an existing deployment instead (no stack is started).
+#
+#   Commandline:
+#       ./benchvm.py                                    # pi and vm profiles
+#       ./benchvm.py --cores 4 --memory 1024            # sized as a Pi 3
+#       ./benchvm.py --path /static/bench.css -c 256
+#       ./benchvm.py --app /srv/vm.utu.fi --path /courses
+#       ./benchvm.py --url https://vm.utu.fi/ --duration 30
+#
+#   NOTE: Client processes run on the same machine and compete with nginx
+#         and uWSGI for the CPU. Compare profiles to each other, not to
+#         the numbers of a real unit.
+#
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+# Python 3.5 or newer
+if sys.version_info < (3, 5):
+    print("You need Python 3.5 or newer!")
+    os._exit(1)
+
+import vminstall
+
+
+# PEP 396 -- Module Version Numbers https://www.python.org/dev/peps/pep-0396/
+__version__ = "0.1.0"
+__author__  = "Jani Tammi <jasata@utu.fi>"
+VERSION = __version__
+HEADER  = """
+=============================================================================
+University of Turku, Department of Future Technologies
+Course Virtualization Project nginx/uWSGI load test
+Version {}, 2026 {}
+""".format(__version__, __author__)
+
+
+#
+# GLOBAL Application Variables
+#
+class App:
+    profiles        = list(vminstall.profiles)
+    nginx           = "nginx"
+    nginx_conf      = "/etc/nginx"      # uwsgi_params, mime.types, ...
+    uwsgi           = "uwsgi"
+    port            = 8443
+    path            = "/"
+    connections     = 32
+    clients         = min(4, os.cpu_count() or 1)   # Client processes
+    duration        = 10.0          # Seconds
+    warmup          = 1.0           # Seconds, not counted
+    timeout         = 30.0          # Seconds, stack start and requests
+    class Stand_in:
+        delay       = 0.005         # Seconds per request (SQLite, ...)
+        size        = 4096          # Response bytes
+
+
+###############################################################################
+#
+# Stack
+#
+
+STAND_IN = """# Stand-in for vm.utu.fi application (benchvm.py)
+import time
+
+DELAY = {delay}
+BODY  = b"x" * {size}
+
+def app(environ, start_response):
+    if DELAY:
+        time.sleep(DELAY)
+    start_response(
+        "200 OK",
+        [("Content-Type", "text/plain"), ("Content-Length", str(len(BODY)))]
+    )
+    return [BODY]
+"""
+
+
+def stand_in(directory: str, delay: float, size: int):
+    """Write stand-in application (application.py) and static files
+    (bench.css, fingerprinted bench.0123abcd.css, with gzip variants)."""
+    os.makedirs(os.path.join(directory, "static"), exist_ok = True)
+    with open(os.path.join(directory, "application.py"), "w") as file:
+        file.write(STAND_IN.format(delay = delay, size = size))
+    css = "body { margin: 0; }\n" * (size // 20 + 1)
+    for name in ("bench.css", "bench.0123abcd.css"):
+        with open(os.path.join(directory, "static", name), "w") as file:
+            file.write(css[:size])
+    vminstall.precompress(os.path.join(directory, "static"))
+
+
+def certificate(directory: str) -> tuple:
+    """Self-signed ECDSA certificate for vm.utu.fi. Returns (cert, key)."""
+    cert = os.path.join(directory, "vm.utu.fi.crt")
+    key  = os.path.join(directory, "vm.utu.fi.key")
+    subprocess.run(
+        [
+            "openssl", "req", "-x509", "-nodes", "-days", "1",
+            "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1",
+            "-subj", "/CN=vm.utu.fi", "-keyout", key, "-out", cert
+        ],
+        stdout = subprocess.DEVNULL,
+        stderr = subprocess.PIPE,
+        check = True
+    )
+    return cert, key
+
+
+class Stack:
+    """nginx and uWSGI of one tuning profile, relocated into 'directory'."""
+    def __init__(self, values: dict, directory: str, application: str,
+                 tls: tuple, nginx: bool):
+        import re
+        self.values     = values
+        self.directory  = directory
+        self.run_dir    = os.path.join(directory, "run")
+        self.log_dir    = os.path.join(directory, "log")
+        self.use_nginx  = nginx
+        self.socket     = os.path.join(self.run_dir, "vm.utu.fi.socket")
+        self.stats      = os.path.join(self.run_dir, "stats.socket")
+        self.nginx      = None
+        self.uwsgi      = None
+        for path in (self.run_dir, self.log_dir, os.path.join(directory, "tmp")):
+            os.makedirs(path, exist_ok = True)
+        if values["listen"] > values["somaxconn"]:
+            values = dict(values, listen = values["somaxconn"])
+        self.values = values
+        relocate = [
+            ("/run/uwsgi/app/vm.utu.fi/",       self.run_dir + "/"),
+            ("/var/log/nginx/",                 self.log_dir + "/"),
+            ("/var/log/uwsgi/",                 self.log_dir + "/"),
+            ("/var/www/vm.utu.fi",              application),
+            ("/etc/ssl/certs/vm.utu.fi.crt",    tls[0]),
+            ("/etc/ssl/private/vm.utu.fi.key",  tls[1]),
+            ("include uwsgi_params;",
+             "include {}/uwsgi_params;".format(App.nginx_conf)),
+            ("include fastcgi_params;",
+             "include {}/fastcgi_params;".format(App.nginx_conf)),
+            ("listen 443 ssl;",
+             "listen 127.0.0.1:{} ssl;".format(App.port))
+        ]
+        templates = {}
+        for name in ("nginx.site", "uwsgi.ini"):
+            content = vminstall.files[name].content
+            for key, value in values.items():
+                content = content.replace("{{" + key + "}}", str(value))
+            for key, value in vminstall.cache_config(False).items():
+                content = content.replace("{{" + key + "}}", value)
+            for old, new in relocate:
+                content = content.replace(old, new)
+            templates[name] = content
+        # Port 80 redirect server, IPv6
+        site = re.sub(
+            r"\nserver \{\s*listen\s+80;.*?\n\}\n", "\n",
+            templates["nginx.site"], flags = re.DOTALL
+        )
+        site = re.sub(r"\n\s*listen\s+\[::\].*", "", site)
+        # Credentials, Debian plugin (not needed by pip installed uWSGI)
+        ini = re.sub(r"\n(uid|gid)\s*=.*", "", templates["uwsgi.ini"])
+        if not os.path.isdir("/usr/lib/uwsgi/plugins"):
+            ini = re.sub(r"\nplugins\s*=.*", "", ini)
+        self.site_file  = os.path.join(directory, "vm.utu.fi")
+        self.ini_file   = os.path.join(directory, "vm.utu.fi.ini")
+        self.conf_file  = os.path.join(directory, "nginx.conf")
+        vminstall.write_file(self.site_file, site)
+        vminstall.write_file(self.ini_file, ini)
+        vminstall.write_file(self.conf_file, self.nginx_conf())
+    def nginx_conf(self) -> str:
+        """Main nginx.conf, as configure_nginx() leaves it (worker values)."""
+        tmp = os.path.join(self.directory, "tmp")
+        return """
+worker_processes {worker_processes};
+worker_rlimit_nofile {worker_rlimit_nofile};
+pid {directory}/nginx.pid;
+error_log {log}/error.log warn;
+
+events {{
+    worker_connections {worker_connections};
+}}
+
+http {{
+    sendfile on;
+    tcp_nopush on;
+    types_hash_max_size 2048;
+    include {conf}/mime.types;
+    default_type application/octet-stream;
+    ssl_protocols TLSv1.2 TLSv1.3;
+    client_body_temp_path {tmp}/client;
+    proxy_temp_path {tmp}/proxy;
+    fastcgi_temp_path {tmp}/fastcgi;
+    uwsgi_temp_path {tmp}/uwsgi;
+    scgi_temp_path {tmp}/scgi;
+    include {site};
+}}
+""".format(
+            directory   = self.directory,
+            log         = self.log_dir,
+            conf        = App.nginx_conf,
+            tmp         = tmp,
+            site        = self.site_file,
+            **self.values
+        )
+    def start(self, timeout: float) -> float:
+        """Start uWSGI (and nginx), wait until all workers have loaded the
+        application and nginx accepts connections. Returns seconds."""
+        import socket
+        start = time.monotonic()
+        self.uwsgi = subprocess.Popen(
+            [App.uwsgi, "--ini", self.ini_file],
+            stdin  = subprocess.DEVNULL,
+            stdout = subprocess.DEVNULL,
+            stderr = subprocess.DEVNULL
+        )
+        try:
+            vminstall.wait_uwsgi(self.stats, [], timeout)
+        except ValueError:
+            raise ValueError(
+                "uWSGI did not start:\n" + self.log_tail("uwsgi.log")
+            ) from None
+        if not self.use_nginx:
+            return time.monotonic() - start
+        self.nginx = subprocess.Popen(
+            [
+                App.nginx, "-p", self.directory, "-c", self.conf_file,
+                "-g", "daemon off;"
+            ],
+            stdout = subprocess.DEVNULL,
+            stderr = subprocess.PIPE
+        )
+        while time.monotonic() - start < timeout:
+            if self.nginx.poll() is not None:
+                raise ValueError(
+                    "nginx did not start:\n" +
+                    self.nginx.stderr.read().decode(errors = "replace")
+                )
+            try:
+                socket.create_connection(("127.0.0.1", App.port), 1).close()
+                return time.monotonic() - start
+            except OSError:
+                time.sleep(0.1)
+        raise ValueError("nginx not listening in {}s".format(timeout))
+    def stop(self):
+        """SIGTERM (uWSGI 'die-on-term', nginx fast shutdown), then kill."""
+        for proc in (self.nginx, self.uwsgi):
+            if proc and proc.poll() is None:
+                proc.terminate()
+                try:
+                    proc.wait(10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    proc.wait()
+    def log_tail(self, name: str, lines: int = 20) -> str:
+        try:
+            with open(os.path.join(self.log_dir, name), "r") as file:
+                return "".join(file.readlines()[-lines:])
+        except OSError:
+            return "(no log)"
+    def __str__(self):
+        return "uWSGI {} x {} threads (listen {}), nginx {} x {} connections".format(
+            self.values["processes"], self.values["threads"],
+            self.values["listen"], self.values["worker_processes"],
+            self.values["worker_connections"]
+        )
+
+
+###############################################################################
+#
+# Load
+#
+#   Each client process runs an asyncio loop with its share of connections.
+#   A connection repeats its request until the deadline and records the
+#   latency of each request completed after the warmup. Failed requests
+#   (non-2xx/3xx status, connection errors) are counted and the connection
+#   is reopened.
+#
+
+class Target:
+    """Where the load goes: 'https' (host, port, TLS) or 'uwsgi' (unix
+    socket path)."""
+    def __init__(self, kind: str, address, path: str, host: str = "vm.utu.fi"):
+        self.kind       = kind
+        self.address    = address
+        self.path       = path
+        self.host       = host
+    @classmethod
+    def from_url(cls, url: str):
+        from urllib.parse import urlsplit
+        parts = urlsplit(url)
+        if parts.scheme != "https":
+            raise ValueError("Only https:// URLs are supported")
+        return cls(
+            "https",
+            (parts.hostname, parts.port or 443),
+            (parts.path or "/") + ("?" + parts.query if parts.query else ""),
+            parts.netloc
+        )
+
+
+def uwsgi_packet(target: Target) -> bytes:
+    """uwsgi protocol request (modifier1 0: WSGI) for GET target.path."""
+    import struct
+    path, _, query = target.path.partition("?")
+    env = {
+        "REQUEST_METHOD"    : "GET",
+        "REQUEST_URI"       : target.path,
+        "PATH_INFO"         : path,
+        "QUERY_STRING"      : query,
+        "SERVER_PROTOCOL"   : "HTTP/1.1",
+        "SERVER_NAME"       : target.host,
+        "SERVER_PORT"       : "443",
+        "HTTP_HOST"         : target.host,
+        "HTTPS"             : "on",
+        "REMOTE_ADDR"       : "127.0.0.1"
+    }
+    data = b""
+    for key, value in env.items():
+        key, value = key.encode(), value.encode()
+        data += struct.pack("<H", len(key)) + key
+        data += struct.pack("<H", len(value)) + value
+    return struct.pack("<BHB", 0, len(data), 0) + data
+
+
+async def _response(reader) -> tuple:
+    """Read one HTTP/1.1 response. Returns (status, keep-alive)."""
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split()[1])
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip().lower()
+    if "content-length" in headers:
+        await reader.readexactly(int(headers["content-length"]))
+    elif headers.get("transfer-encoding") == "chunked":
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+            await reader.readexactly(size + 2)
+            if not size:
+                break
+    else:
+        await reader.read()
+        return status, False
+    return status, headers.get("connection") != "close"
+
+
+async def _connection(target: Target, deadline: float, counted: float,
+                      result: dict):
+    import ssl
+    import asyncio
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    request = "GET {} HTTP/1.1\r\nHost: {}\r\nUser-Agent: benchvm.py/{}\r\n\r\n".format(
+        target.path, target.host, __version__
+    ).encode()
+    packet = uwsgi_packet(target) if target.kind == "uwsgi" else None
+    writer = None
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        try:
+            if packet:
+                reader, writer = await asyncio.open_unix_connection(
+                    target.address
+                )
+                writer.write(packet)
+                status = int((await reader.read()).split(b" ", 2)[1])
+                writer.close()
+                writer = None
+            else:
+                if not writer:
+                    reader, writer = await asyncio.open_connection(
+                        *target.address, ssl = context,
+                        server_hostname = target.host.split(":")[0]
+                    )
+                writer.write(request)
+                status, alive = await asyncio.wait_for(
+                    _response(reader), App.timeout
+                )
+                if not alive:
+                    writer.close()
+                    writer = None
+            if not 200 <= status < 400:
+                raise ValueError(status)
+            if start >= counted:
+                result["latency"].append(time.monotonic() - start)
+        except (OSError, ValueError, IndexError, EOFError,
+                asyncio.TimeoutError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError) as e:
+            if start >= counted:
+                result["errors"] += 1
+                result["last"] = "{}: {}".format(type(e).__name__, e)
+            if writer:
+                writer.close()
+                writer = None
+            await asyncio.sleep(0.01)
+    if writer:
+        writer.close()
+
+
+def run_client(job: tuple) -> dict:
+    """Client process. 'job' is (target, connections, start, warmup,
+    duration), 'start' in time.time() of the parent (common start)."""
+    import asyncio
+    target, connections, start, warmup, duration = job
+    offset  = time.monotonic() - time.time()
+    counted = start + offset + warmup
+    result  = {"latency" : [], "errors" : 0, "last" : ""}
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(
+        asyncio.gather(*[
+            _connection(target, counted + duration, counted, result)
+            for _ in range(connections)
+        ])
+    )
+    loop.close()
+    return result
+
+
+class Result:
+    def __init__(self, profile: str, mode: str):
+        self.profile    = profile
+        self.mode       = mode
+        self.status     = "n/a"
+        self.requests   = 0
+        self.errors     = 0
+        self.rate       = 0.0
+        self.latency    = []            # Seconds, sorted
+        self.detail     = ""
+    def percentile(self, p: float) -> float:
+        """Nearest-rank percentile in milliseconds."""
+        if not self.latency:
+            return None
+        import math
+        index = max(0, math.ceil(p / 100.0 * len(self.latency)) - 1)
+        return 1000 * self.latency[index]
+
+
+def run_load(target: Target, result: Result, connections: int, clients: int,
+             duration: float, warmup: float):
+    import multiprocessing
+    clients = max(1, min(clients, connections))
+    start = time.time() + 0.5       # Client processes start together
+    jobs = [
+        (
+            target,
+            connections // clients + (1 if n < connections % clients else 0),
+            start,
+            warmup,
+            duration
+        )
+        for n in range(clients)
+    ]
+    with multiprocessing.Pool(clients) as pool:
+        parts = pool.map(run_client, jobs)
+    for part in parts:
+        result.latency += part["latency"]
+        result.errors  += part["errors"]
+        result.detail   = part["last"] or result.detail
+    result.latency.sort()
+    result.requests = len(result.latency)
+    result.rate     = result.requests / duration
+    result.status   = "OK" if not result.errors else "ERRORS"
+
+
+def result_table(results: list) -> str:
+    def ms(value):
+        return "" if value is None else "{:.1f}".format(value)
+    lines = [
+        "{:<8} {:<6} {:<7} {:>9} {:>7} {:>9} {:>8} {:>8} {:>8} {:>8}  {}".format(
+            "PROFILE", "MODE", "STATUS", "REQUESTS", "ERRORS", "REQ/S",
+            "P50 ms", "P90 ms", "P99 ms", "MAX ms", "DETAIL"
+        )
+    ]
+    for r in results:
+        lines.append(
+            "{:<8} {:<6} {:<7} {:>9} {:>7} {:>9.1f} {:>8} {:>8} {:>8} {:>8}  {}".format(
+                r.profile,
+                r.mode,
+                r.status,
+                r.requests,
+                r.errors,
+                r.rate,
+                ms(r.percentile(50)),
+                ms(r.percentile(90)),
+                ms(r.percentile(99)),
+                ms(r.percentile(100)),
+                r.detail[:40]
+            )
+        )
+    return "\n".join(lines)
+
+
+##############################################################################
+#
+# MAIN
+#
+##############################################################################
+if __name__ == '__main__':
+
+    #
+    # Commandline arguments
+    #
+    parser = argparse.ArgumentParser(
+        description     = HEADER,
+        formatter_class = argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        '--profile',
+        help    = "vminstall.py tuning profile. Can be repeated.\n" +
+                  "Default: all ({})".format(", ".join(App.profiles)),
+        choices = App.profiles,
+        action  = 'append'
+    )
+    parser.add_argument(
+        '--cores',
+        help    = "Size profiles for this many cores. Default: this machine",
+        type    = int
+    )
+    parser.add_argument(
+        '--memory',
+        help    = "Size profiles for this much memory (MB).\n" +
+                  "Default: this machine",
+        type    = int,
+        metavar = "MB"
+    )
+    parser.add_argument(
+        '-c',
+        '--connections',
+        help    = "Concurrent connections. Default: {}".format(App.connections),
+        type    = int,
+        default = App.connections
+    )
+    parser.add_argument(
+        '--clients',
+        help    = "Client processes. Default: {}".format(App.clients),
+        type    = int,
+        default = App.clients
+    )
+    parser.add_argument(
+        '-d',
+        '--duration',
+        help    = "Seconds of counted load. Default: {}".format(App.duration),
+        type    = float,
+        default = App.duration
+    )
+    parser.add_argument(
+        '--warmup',
+        help    = "Seconds of uncounted load first. Default: {}".format(
+            App.warmup
+        ),
+        type    = float,
+        default = App.warmup
+    )
+    parser.add_argument(
+        '--path',
+        help    = "Request path. Default: '{}'".format(App.path),
+        default = App.path
+    )
+    parser.add_argument(
+        '--app',
+        help    = "Application directory (application.py with 'app').\n" +
+                  "Default: stand-in application",
+        metavar = "DIR"
+    )
+    parser.add_argument(
+        '--delay',
+        help    = "Stand-in application seconds per request. Default: {}".format(
+            App.Stand_in.delay
+        ),
+        type    = float,
+        default = App.Stand_in.delay
+    )
+    parser.add_argument(
+        '--size',
+        help    = "Stand-in application response bytes. Default: {}".format(
+            App.Stand_in.size
+        ),
+        type    = int,
+        default = App.Stand_in.size
+    )
+    parser.add_argument(
+        '--port',
+        help    = "Local port for nginx. Default: {}".format(App.port),
+        type    = int,
+        default = App.port
+    )
+    parser.add_argument(
+        '--direct',
+        help    = "No nginx, load uWSGI socket directly (uwsgi protocol).",
+        action  = 'store_true'
+    )
+    parser.add_argument(
+        '--url',
+        help    = "Load an existing deployment (https://) instead.",
+        metavar = "URL"
+    )
+    parser.add_argument(
+        '--keep',
+        help    = "Keep generated configuration and logs (temp directory).",
+        action  = 'store_true'
+    )
+    args = parser.parse_args()
+
+    App.port = args.port
+    if args.app and not os.path.isfile(os.path.join(args.app, "application.py")):
+        print("ERROR: '{}' has no application.py!".format(args.app))
+        os._exit(1)
+    if args.connections < 1 or args.duration <= 0:
+        print("ERROR: --connections and --duration must be positive!")
+        os._exit(1)
+
+    print(HEADER)
+    results = []
+
+    #
+    # Existing deployment
+    #
+    if args.url:
+        try:
+            target = Target.from_url(args.url)
+        except ValueError as e:
+            print("ERROR: {}".format(e))
+            os._exit(1)
+        result = Result("remote", "https")
+        results.append(result)
+        print(
+            "{} connections, {}s... ".format(args.connections, args.duration),
+            end = '', flush = True
+        )
+        run_load(
+            target, result, args.connections, args.clients,
+            args.duration, args.warmup
+        )
+        print(result.status)
+        print("")
+        print(result_table(results))
+        os._exit(0 if not result.errors else 1)
+
+    #
+    # Local stack per profile
+    #
+    if not shutil.which(App.uwsgi):
+        print("ERROR: uWSGI ('{}') not found!".format(App.uwsgi))
+        os._exit(1)
+    nginx = not args.direct
+    if nginx and not shutil.which(App.nginx):
+        print("NOTE: nginx not found, loading uWSGI socket directly (--direct)")
+        nginx = False
+    directory = tempfile.mkdtemp(prefix = "benchvm-")
+    try:
+        if args.app:
+            application = os.path.abspath(args.app)
+        else:
+            application = os.path.join(directory, "app")
+            stand_in(application, args.delay, args.size)
+        try:
+            tls = certificate(directory)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(e)
+            print("TLS certificate generation failed!")
+            os._exit(-1)
+        for profile in args.profile or App.profiles:
+            values = vminstall.tuning(
+                profile,
+                args.cores,
+                args.memory * 1024**2 if args.memory else None
+            )
+            result = Result(profile, "nginx" if nginx else "uwsgi")
+            results.append(result)
+            stack = Stack(
+                values, os.path.join(directory, profile), application, tls, nginx
+            )
+            print("{}: {}".format(profile, stack))
+            try:
+                print("    starting... ", end = '', flush = True)
+                print("{:.1f}s".format(stack.start(App.timeout)))
+                if nginx:
+                    target = Target("https", ("127.0.0.1", App.port), args.path)
+                else:
+                    target = Target("uwsgi", stack.socket, args.path)
+                print(
+                    "    {} connections, {}s... ".format(
+                        args.connections, args.duration
+                    ),
+                    end = '', flush = True
+                )
+                run_load(
+                    target, result, args.connections, args.clients,
+                    args.duration, args.warmup
+                )
+                print(result.status)
+            except (OSError, ValueError, subprocess.SubprocessError) as e:
+                print("FAILED")
+                print(e)
+                result.status = "FAILED"
+                result.detail = str(e).split("\n")[0]
+            finally:
+                stack.stop()
+    finally:
+        if args.keep:
+            print("Configuration and logs kept in '{}'".format(directory))
+        else:
+            shutil.rmtree(directory, ignore_errors = True)
+
+    print("")
+    print(result_table(results))
+    os._exit(0 if all(r.status == "OK" for r in results) else 1)
+
+
+# EOF
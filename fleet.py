@@ -0,0 +1,416 @@
+#! /usr/bin/env python3
+#
+#   Foresail Project // Turku University
+#   Department of Future Technologies
+#   Embedded Systems Laboratory
+#
+#   Push and run install.py on a number of PATE Monitor units concurrently.
+#
+#   fleet.py - 2026, Jani Tammi <jasata@utu.fi>
+#   0.1.0   2026-10-19  Initial version.
+#   0.1.1   2026-10-19  Unpack with sudo (remote directories are root's),
+#                       push bare git mirrors instead of bundles.
+#
+#
+#   Each host gets the files listed with '--push' (by default install.py,
+#   install.config, wheelhouse/ and mirrors/ - those that exist in script's
+#   directory), after which the installer is executed. mirrors/ contains
+#   bare mirrors ('git clone --mirror', <name>.git) that install.py fetches
+#   and clones from (/var/cache/pminstall/git). Output of each host
+#   is streamed to console, prefixed with host name, and a table of results
+#   is printed at the end.
+#
+#   Files are sent as a tar stream over a single SSH connection per item:
+#       tar -C <local> -cf - . | ssh <host> "sudo -n sh -c 'mkdir -p <dir> && tar ...'"
+#   Target directories are owned by root, while the login is not (as the
+#   default command implies). '--no-sudo' if logging in as root.
+#
+#   Commandline:
+#       ./fleet.py pate1 pi@pate2 pate3         # hosts as arguments
+#       ./fleet.py --hosts fleet.hosts -j 10    # hosts from file, 10 at a time
+#       ./fleet.py --hosts fleet.hosts --command "sudo python3 /boot/install.py --plan"
+#
+#   Testing without units:
+#       ./fleet.py --transport local --local-root /tmp/fleet a b c \
+#                  --command "python3 /boot/install.py --help"
+#   ...runs everything on this machine, each "host" rooted in its own
+#   directory (/tmp/fleet/a, ...). Remote paths are prefixed accordingly
+#   and files are unpacked without sudo.
+#
+import os
+import sys
+import time
+import shlex
+import asyncio
+import argparse
+
+# Python 3.5 or newer
+if sys.version_info < (3, 5):
+    print("You need Python 3.5 or newer!")
+    os._exit(1)
+
+
+# PEP 396 -- Module Version Numbers https://www.python.org/dev/peps/pep-0396/
+__version__ = "0.1.1"
+__author__  = "Jani Tammi <jasata@utu.fi>"
+VERSION = __version__
+HEADER  = """
+=============================================================================
+University of Turku, Department of Future Technologies
+ForeSail-1 / PATE Monitor fleet installer
+Version {}, 2026 {}
+""".format(__version__, __author__)
+
+
+#
+# GLOBAL Application Variables
+#
+class App:
+    class Script:
+        name        = os.path.basename(__file__)
+        path        = os.path.dirname(os.path.realpath(__file__))
+    # (local, remote directory) - defaults are used only if local exists
+    push            = [
+        ("install.py",      "/boot"),
+        ("install.config",  "/boot"),
+        ("wheelhouse",      "/var/cache/pminstall/wheels"),
+        ("mirrors",         "/var/cache/pminstall/git")
+    ]
+    command         = "sudo python3 /boot/install.py"
+    sudo            = "sudo -n"     # Unpack as root (non-interactive)
+    jobs            = 8             # Hosts processed concurrently
+    connect_timeout = 10            # Seconds, SSH ConnectTimeout
+
+
+###############################################################################
+#
+# Transports
+#
+#   A transport turns "run this shell command on host" into a local argv.
+#   Remote paths are passed through path(), so that a transport can relocate
+#   them (LocalTransport roots each host in its own directory).
+#
+
+class SSHTransport:
+    """Runs commands on remote hosts with OpenSSH client (non-interactive)."""
+    def __init__(self, options: list = None):
+        self.options = [
+            "-o", "BatchMode=yes",
+            "-o", "ConnectTimeout={}".format(App.connect_timeout)
+        ]
+        for option in options or []:
+            self.options += ["-o", option]
+    def path(self, host: str, path: str) -> str:
+        return path
+    def argv(self, host: str, command: str) -> list:
+        return ["ssh", *self.options, host, command]
+
+
+class LocalTransport:
+    """Runs commands locally, each host in directory '<root>/<host>'.
+    Lets the orchestration be exercised without any units or sshd."""
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+    def path(self, host: str, path: str) -> str:
+        return os.path.join(self.root, host) + path
+    def argv(self, host: str, command: str) -> list:
+        os.makedirs(os.path.join(self.root, host), exist_ok = True)
+        return ["sh", "-c", command.replace("/boot/", self.path(host, "/boot/"))]
+
+
+###############################################################################
+#
+# Orchestration
+#
+
+class Result:
+    def __init__(self, host: str):
+        self.host       = host
+        self.status     = "waiting"
+        self.returncode = None
+        self.push_time  = 0.0
+        self.run_time   = 0.0
+        self.lines      = 0
+        self.last       = ""
+    @property
+    def ok(self) -> bool:
+        return self.status == "OK"
+
+
+class Fleet:
+    """Processes hosts concurrently, at most 'jobs' at a time."""
+    def __init__(self, transport, push: list, command: str, jobs: int,
+                 sudo: str = ""):
+        self.transport  = transport
+        self.push       = push
+        self.command    = command
+        self.jobs       = jobs
+        self.sudo       = sudo
+        self.width      = 0
+    def progress(self, host: str, line: str):
+        print("{:<{w}} | {}".format(host, line, w = self.width), flush = True)
+    async def _stream(self, result: Result, reader):
+        """Echo output line by line. Apt and pip use '\\r' for progress,
+        which is treated as a line break. No limit on line length."""
+        pending = b""
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            lines = (pending + data).replace(b"\r", b"\n").split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                line = line.decode("utf-8", errors = "replace").rstrip()
+                if line:
+                    result.lines += 1
+                    result.last = line
+                    self.progress(result.host, line)
+        if pending.strip():
+            result.lines += 1
+            result.last = pending.decode("utf-8", errors = "replace").rstrip()
+            self.progress(result.host, result.last)
+    async def _send(self, result: Result, local: str, remote: str) -> int:
+        """Send file or directory content into remote directory."""
+        host = result.host
+        if os.path.isdir(local):
+            tar = ["tar", "-C", local, "-cf", "-", "."]
+        else:
+            tar = [
+                "tar", "-C", os.path.dirname(local) or ".",
+                "-cf", "-", os.path.basename(local)
+            ]
+        remote = shlex.quote(self.transport.path(host, remote))
+        # Ownership, permissions and timestamps are not restored (/boot is
+        # vfat, which supports none of them), nor are those of existing
+        # directories (the '.' entry) overwritten
+        unpack = (
+            "mkdir -p {0} && tar -C {0} --no-same-owner --no-same-permissions "
+            "--no-overwrite-dir -m -xf -"
+        ).format(remote)
+        if self.sudo:
+            unpack = "{} sh -c {}".format(self.sudo, shlex.quote(unpack))
+        rfd, wfd = os.pipe()
+        try:
+            packer = await asyncio.create_subprocess_exec(
+                *tar, stdout = wfd, stderr = asyncio.subprocess.PIPE
+            )
+            unpacker = await asyncio.create_subprocess_exec(
+                *self.transport.argv(host, unpack),
+                stdin   = rfd,
+                stdout  = asyncio.subprocess.PIPE,
+                stderr  = asyncio.subprocess.STDOUT
+            )
+        finally:
+            os.close(rfd)
+            os.close(wfd)
+        _, errors = await asyncio.gather(
+            self._stream(result, unpacker.stdout),
+            packer.stderr.read()
+        )
+        if errors:
+            self.progress(host, errors.decode("utf-8", errors = "replace"))
+        return (await packer.wait()) or (await unpacker.wait())
+    async def _host(self, result: Result, semaphore):
+        async with semaphore:
+            host = result.host
+            result.status = "push"
+            start = time.monotonic()
+            for local, remote in self.push:
+                self.progress(host, "--> {} to {}".format(local, remote))
+                code = await self._send(result, local, remote)
+                if code:
+                    result.status     = "push failed"
+                    result.returncode = code
+                    result.push_time  = time.monotonic() - start
+                    return result
+            result.push_time = time.monotonic() - start
+            result.status = "run"
+            start = time.monotonic()
+            self.progress(host, "--> {}".format(self.command))
+            proc = await asyncio.create_subprocess_exec(
+                *self.transport.argv(host, self.command),
+                stdin   = asyncio.subprocess.DEVNULL,
+                stdout  = asyncio.subprocess.PIPE,
+                stderr  = asyncio.subprocess.STDOUT
+            )
+            await self._stream(result, proc.stdout)
+            result.returncode = await proc.wait()
+            result.run_time   = time.monotonic() - start
+            result.status     = "OK" if not result.returncode else "FAILED"
+            return result
+    async def _run(self, hosts: list) -> list:
+        semaphore = asyncio.Semaphore(self.jobs)
+        results = [Result(host) for host in hosts]
+        await asyncio.gather(
+            *[self._host(result, semaphore) for result in results]
+        )
+        return results
+    def run(self, hosts: list) -> list:
+        """Process all hosts. Returns a list of Result objects."""
+        self.width = max(len(h) for h in hosts)
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(self._run(hosts))
+
+
+def result_table(results: list) -> str:
+    w = max([len(r.host) for r in results] + [4])
+    lines = [
+        "{:<{w}}  {:<12} {:>4} {:>8} {:>8}  {}".format(
+            "HOST", "STATUS", "EXIT", "PUSH", "RUN", "LAST OUTPUT", w = w
+        )
+    ]
+    for r in results:
+        lines.append(
+            "{:<{w}}  {:<12} {:>4} {:>7.1f}s {:>7.1f}s  {}".format(
+                r.host,
+                r.status,
+                "" if r.returncode is None else r.returncode,
+                r.push_time,
+                r.run_time,
+                r.last[:40],
+                w = w
+            )
+        )
+    ok = len([r for r in results if r.ok])
+    lines.append("{} of {} hosts OK".format(ok, len(results)))
+    return "\n".join(lines)
+
+
+def read_hosts(filename: str) -> list:
+    """One host per line, '#' starts a comment."""
+    hosts = []
+    with open(filename, "r") as file:
+        for line in file:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                hosts.append(line)
+    return hosts
+
+
+##############################################################################
+#
+# MAIN
+#
+##############################################################################
+if __name__ == '__main__':
+
+    #
+    # Commandline arguments
+    #
+    parser = argparse.ArgumentParser(
+        description     = HEADER,
+        formatter_class = argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        'hosts',
+        help    = "Hosts ([user@]host) to install.",
+        nargs   = '*',
+        metavar = "HOST"
+    )
+    parser.add_argument(
+        '--hosts',
+        help    = "Read hosts from file (one per line).",
+        dest    = "hostfile",
+        metavar = "FILE"
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        help    = "Number of hosts processed concurrently. Default: {}".format(
+            App.jobs
+        ),
+        type    = int,
+        default = App.jobs
+    )
+    parser.add_argument(
+        '--push',
+        help    = "Send LOCAL file or directory content to REMOTE directory.\n" +
+                  "Can be repeated. Replaces the default list:\n" +
+                  "\n".join("  {}:{}".format(l, r) for l, r in App.push),
+        action  = 'append',
+        metavar = "LOCAL:REMOTE"
+    )
+    parser.add_argument(
+        '--command',
+        help    = "Command to execute. Default: '{}'".format(App.command),
+        default = App.command
+    )
+    parser.add_argument(
+        '-o',
+        help    = "SSH option (as for 'ssh -o'). Can be repeated.",
+        action  = 'append',
+        dest    = "ssh_options",
+        metavar = "OPTION"
+    )
+    parser.add_argument(
+        '--transport',
+        help    = "'ssh' (default) or 'local' (for testing).",
+        choices = ["ssh", "local"],
+        default = "ssh"
+    )
+    parser.add_argument(
+        '--local-root',
+        help    = "Directory for 'local' transport hosts.",
+        default = "/tmp/fleet",
+        metavar = "DIR"
+    )
+    parser.add_argument(
+        '--no-sudo',
+        help    = "Unpack pushed files without '{}' (root login).\n".format(
+                      App.sudo
+                  ) + "Implied by 'local' transport.",
+        action  = 'store_true'
+    )
+    args = parser.parse_args()
+
+    hosts = list(args.hosts)
+    if args.hostfile:
+        hosts += read_hosts(args.hostfile)
+    hosts = list(dict.fromkeys(hosts))
+    if not hosts:
+        parser.print_help(sys.stderr)
+        print("ERROR: No hosts given!")
+        os._exit(1)
+
+    #
+    # Resolve push list
+    #
+    if args.push:
+        push = []
+        for item in args.push:
+            local, sep, remote = item.rpartition(":")
+            if not sep or not local:
+                print("ERROR: Invalid --push '{}' (LOCAL:REMOTE)".format(item))
+                os._exit(1)
+            if not os.path.exists(local):
+                print("ERROR: '{}' does not exist!".format(local))
+                os._exit(1)
+            push.append((local, remote))
+    else:
+        push = [
+            (os.path.join(App.Script.path, local), remote)
+            for local, remote in App.push
+            if os.path.exists(os.path.join(App.Script.path, local))
+        ]
+
+    if args.transport == "local":
+        transport = LocalTransport(args.local_root)
+    else:
+        transport = SSHTransport(args.ssh_options)
+
+    print(HEADER)
+    print(
+        "{} host(s), {} at a time, pushing: {}".format(
+            len(hosts),
+            args.jobs,
+            ", ".join(os.path.basename(l) for l, _ in push) or "nothing"
+        )
+    )
+    sudo = "" if args.no_sudo or args.transport == "local" else App.sudo
+    results = Fleet(transport, push, args.command, args.jobs, sudo).run(hosts)
+    print("")
+    print(result_table(results))
+    os._exit(0 if all(r.ok for r in results) else 1)
+
+
+# EOF
@@ -11,12 +11,23 @@
 #   0.2.2   2019-01-21  Bug fixes.
 #   0.2.3   2019-01-21  pmapi setup.py now with --force option.
 #   0.3.0   2019-06-10	Keyboard configuration function added.
+#   0.4.0   2026-10-19  Background prefetch of packages, repositories and
+#                       wheels while local configuration steps run.
+#   0.5.0   2026-10-19  Users, groups and memberships provisioned in-process
+#                       (AccountDB) with a single locked write.
+#   0.6.0   2026-10-19  Step tracer: timings and resource usage of each step
+#                       and command into /boot/install.trace.json.
+#   0.7.0   2026-10-19  Command output captured into a bounded buffer and
+#                       'install.output.log'. Shown on failure or with -v.
+#   0.8.0   2026-10-19  --plan option to list drift from the desired state.
+#   0.9.0   2026-10-19  Read /boot/install.config. Clone repositories through
+#                       LAN git mirror ([Mirror] url), if configured.
+#   0.10.0  2026-10-19  Progress to systemd (sd_notify STATUS) when run by
+#                       run-once.service. Re-runs pull already cloned repos.
+#   0.11.0  2026-10-19  Command layer (Shell) with --record and --replay.
 #
-#   TODO - Read /boot/install.config
-#       import configparser
-#       config = configparser.ConfigParser()
-#       config.read('/boot/install.config')
-#       if (config['Config']['mode'] == "DEV"):
+#   TODO - Use instance mode from /boot/install.config (Config.mode)
+#       if (Config.mode == "DEV"):
 #           (do stuff)
 #
 #
@@ -25,7 +36,7 @@ import sys
 import platform
 
 # PEP 396 -- Module Version Numbers https://www.python.org/dev/peps/pep-0396/
-__version__ = "0.3.0"
+__version__ = "0.11.0"
 __author__  = "Jani Tammi <jasata@utu.fi>"
 VERSION = __version__
 HEADER  = """
@@ -112,6 +123,30 @@ repositories = [
 
 class Config:
     logging_level = "DEBUG"
+    # Downloads made ahead of time (git mirrors, pip sdists/wheels, logs)
+    prefetch_dir  = "/var/cache/pminstall"
+    # Step timings and resource usage (JSON), collected from the card later
+    trace_file    = "/boot/install.trace.json"
+    # Command output is captured (last 'output_tail' bytes kept in memory,
+    # shown on failure) and appended to 'output_log' (opened once at start
+    # as 'output_file' - absolute path, the installer changes directories).
+    # Echo to console (-v).
+    output_tail   = 16 * 1024
+    output_log    = "/var/log/pminstall/install.output.log"
+    output_file   = None
+    output_echo   = False
+    # Per-request timeout (seconds) for remote HEAD queries in --plan
+    plan_timeout  = 0.8
+    # Written by writesd.py
+    install_config = "/boot/install.config"
+    mode          = None
+    # LAN git mirror (install.config [Mirror] url), e.g. 'git://station/'.
+    # Repositories from 'mirror_hosts' (default: hosts of 'repositories')
+    # are cloned through it, falling back to origin if that fails.
+    mirror_url    = None
+    mirror_hosts  = []
+    # Files written by the installer itself are relocated here on --replay
+    replay_dir    = "install.replay"
 
 
 ###############################################################################
@@ -140,7 +175,13 @@ try:
     #
     # Must be run as root
     #
-    if os.geteuid() != 0:
+    #   (replay of a recorded run touches nothing and can be done as anyone)
+    #   Arguments are not parsed yet: '--replay FILE', '--replay=FILE' and
+    #   argparse abbreviations ('--rep FILE') all have to be recognised.
+    if os.geteuid() != 0 and not any(
+        arg.startswith("--rep") and "--replay".startswith(arg.split("=")[0])
+        for arg in sys.argv[1:]
+    ):
         raise ValueError("You need to have root privileges to run this script.")
 
 
@@ -162,16 +203,428 @@ except Exception as e:
 #
 import pwd
 import grp
+import time
 import shutil
 import logging
 import argparse
 import datetime
+import resource
+import threading
 import subprocess
 
 __moduleName = os.path.basename(os.path.splitext(__file__)[0])
 __fileName   = os.path.basename(__file__)
 
 
+def proc_io(pid = "self") -> dict:
+    """Storage I/O counters of a process from /proc/<pid>/io."""
+    counters = {"read_bytes" : 0, "write_bytes" : 0}
+    try:
+        with open("/proc/{}/io".format(pid), "r") as file:
+            for line in file:
+                key, _, value = line.partition(":")
+                if key in counters:
+                    counters[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+
+def net_bytes() -> dict:
+    """System-wide received and transmitted bytes (all but loopback)."""
+    counters = {"net_rx" : 0, "net_tx" : 0}
+    try:
+        with open("/proc/net/dev", "r") as file:
+            for line in file.readlines()[2:]:
+                iface, _, values = line.partition(":")
+                if iface.strip() == "lo":
+                    continue
+                values = values.split()
+                counters["net_rx"] += int(values[0])
+                counters["net_tx"] += int(values[8])
+    except (OSError, ValueError, IndexError):
+        pass
+    return counters
+
+
+# RingBuffer, pump_output() and Shell are copied into vminstall.py (the
+# first two also into writesd.py). This is the reference copy - change it
+# first. Why they are copies: README.md, "Record and Replay".
+class RingBuffer:
+    """Keeps (at least) the last 'size' bytes written into it. Memory use is
+    bounded to 2 * size, regardless of how much is written."""
+    def __init__(self, size: int):
+        self.size   = size
+        self.total  = 0
+        self.buffer = bytearray()
+    def write(self, data: bytes):
+        self.total  += len(data)
+        self.buffer += data
+        if len(self.buffer) > 2 * self.size:
+            del self.buffer[:-self.size]
+    def tail(self) -> str:
+        """Last 'size' bytes as text. If older output has been discarded,
+        the partial first line is dropped."""
+        data = bytes(self.buffer[-self.size:])
+        if self.total > len(data):
+            data = data[data.find(b"\n") + 1:]
+        return data.decode("utf-8", errors = "replace")
+
+
+def pump_output(proc, ring: RingBuffer, tee = None, echo: bool = False):
+    """Reads merged stdout/stderr of 'proc' (Popen(stdout = PIPE)) into
+    'ring' and optionally into 'tee' (binary file) and to console, until EOF.
+    Non-blocking reads, so the child never stalls on a full pipe. The child
+    is not reaped (waitid(WNOWAIT)). If it has exited, but a daemonized
+    descendant still holds the pipe open, reading stops once it goes quiet."""
+    import selectors
+    fd = proc.stdout.fileno()
+    os.set_blocking(fd, False)
+    selector = selectors.DefaultSelector()
+    selector.register(fd, selectors.EVENT_READ)
+    exited = False
+    try:
+        while True:
+            if selector.select(timeout = 0.2 if exited else 0.5):
+                try:
+                    data = os.read(fd, 65536)
+                except BlockingIOError:
+                    continue
+                if not data:
+                    break
+                ring.write(data)
+                if tee:
+                    tee.write(data)
+                if echo:
+                    sys.stdout.buffer.write(data)
+                    sys.stdout.flush()
+            elif exited:
+                break
+            else:
+                exited = os.waitid(
+                    os.P_PID, proc.pid,
+                    os.WEXITED | os.WNOHANG | os.WNOWAIT
+                ) is not None
+    finally:
+        selector.close()
+        proc.stdout.close()
+
+
+class Shell:
+    """Command layer. Every command the installer runs (Tracer.run() and
+    Prefetch) and every in-process change to, or query of, the system
+    (call()) goes through here, so that a run can be recorded on a unit and
+    replayed anywhere (without root, the Pi or the network).
+
+    live    Run commands (default). Nothing is recorded.
+    record  Run commands and record each command and call: start offset,
+            duration, thread, exit code or return value, output tail and
+            I/O counters. Written into 'filename' (JSON) by save().
+    replay  Nothing is run. Results come from a recording, and the recorded
+            duration is slept (multiplied by 'scale', 0 = no waiting).
+            Commands are matched by commandline (calls by name) in recorded
+            order, so that concurrent jobs may complete in any order.
+            Anything not found in the recording succeeds immediately and is
+            listed by summary()."""
+    def __init__(self, mode: str = "live", filename: str = None,
+                 scale: float = 1.0):
+        import collections
+        self.mode       = mode
+        self.filename   = filename
+        self.scale      = scale
+        self.config     = {}        # Recorded Config values
+        self.entries    = []        # Recorded (record mode)
+        self.recorded   = {}        # key : deque of entries (replay mode)
+        self.missing    = []        # Keys not found in recording
+        self._lock      = threading.Lock()
+        self._started   = time.monotonic()
+        if mode == "replay":
+            import json
+            with open(filename, "r") as file:
+                data = json.load(file)
+            self.config = data.get("config", {})
+            for entry in data["entries"]:
+                self.recorded.setdefault(
+                    entry["key"], collections.deque()
+                ).append(entry)
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+    def local(self, path: str) -> str:
+        """Path for files the installer itself writes (trace, logs). When
+        replaying, relocated under Config.replay_dir."""
+        if not self.replaying:
+            return path
+        path = os.path.join(Config.replay_dir, path.lstrip("/"))
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        return path
+    def _replay(self, key: str) -> dict:
+        with self._lock:
+            queue = self.recorded.get(key)
+            entry = queue.popleft() if queue else None
+            if entry is None:
+                self.missing.append(key)
+        if entry is None:
+            log.warning("Replay: '{}' not in recording".format(key))
+            return {}
+        if self.scale:
+            time.sleep(entry["duration"] * self.scale)
+        return entry
+    def _record(self, key: str, start: float, **values):
+        if self.mode != "record":
+            return
+        entry = dict(
+            key         = key,
+            start       = round(start - self._started, 3),
+            duration    = round(time.monotonic() - start, 3),
+            thread      = threading.current_thread().name,
+            **values
+        )
+        with self._lock:
+            self.entries.append(entry)
+    def run(self, cmd: list, output: RingBuffer = None, tee = None,
+            echo: bool = False, stdin = None) -> tuple:
+        """Run command. If 'output' is given, stdout and stderr are captured
+        into it (and into 'tee', a binary file, and to console if 'echo').
+        Returns (exit code, I/O counters of the command)."""
+        key = " ".join(cmd)
+        if self.replaying:
+            entry = self._replay(key)
+            data = entry.get("output", "").encode("utf-8")
+            if output is not None:
+                output.write(data)
+                if tee:
+                    tee.write(data)
+                if echo:
+                    sys.stdout.buffer.write(data)
+                    sys.stdout.flush()
+            return entry.get("returncode", 0), entry.get("io", {})
+        start = time.monotonic()
+        if output is None:
+            proc = subprocess.Popen(cmd, stdin = stdin)
+        else:
+            proc = subprocess.Popen(
+                cmd,
+                stdin  = stdin,
+                stdout = subprocess.PIPE,
+                stderr = subprocess.STDOUT
+            )
+            pump_output(proc, output, tee, echo)
+        io = {}
+        try:
+            # Wait for exit, but leave the zombie for /proc/<pid>/io reading
+            os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+            io = proc_io(proc.pid)
+        except (AttributeError, OSError):
+            pass
+        returncode = proc.wait()
+        self._record(
+            key, start,
+            returncode  = returncode,
+            io          = io,
+            output      = output.tail() if output is not None else ""
+        )
+        return returncode, io
+    def call(self, name: str, function, *args):
+        """Call 'function' (which changes or queries the system) and return
+        its value. Value must be JSON serializable, for the recording.
+        Exceptions are recorded and raised again (as ValueError) on replay."""
+        if self.replaying:
+            entry = self._replay(name)
+            if entry.get("error"):
+                raise ValueError(entry["error"])
+            return entry.get("value")
+        start = time.monotonic()
+        try:
+            value = function(*args)
+        except Exception as e:
+            self._record(name, start, error = str(e) or repr(e))
+            raise
+        self._record(name, start, value = value)
+        return value
+    def save(self):
+        """Write the recording (record mode only)."""
+        if self.mode != "record":
+            return
+        import json
+        with self._lock:
+            data = {
+                "script"    : os.path.basename(__file__),
+                "version"   : __version__,
+                "host"      : platform.node(),
+                "recorded"  : datetime.datetime.now().isoformat(),
+                "total"     : round(time.monotonic() - self._started, 3),
+                "config"    : self.config,
+                "entries"   : sorted(self.entries, key = lambda e: e["start"])
+            }
+        with open(self.filename + ".tmp", "w") as file:
+            json.dump(data, file, indent = 2)
+        os.replace(self.filename + ".tmp", self.filename)
+    def summary(self) -> str:
+        """Replay result: time and differences against the recording."""
+        lines = [
+            "Replayed in {:.1f}s (time scale {})".format(
+                time.monotonic() - self._started, self.scale
+            )
+        ]
+        unused = [k for k, queue in self.recorded.items() for _ in queue]
+        for title, keys in (("Not in recording", self.missing),
+                            ("Recorded, not replayed", unused)):
+            if keys:
+                lines.append("{} ({}):".format(title, len(keys)))
+                lines += ["    " + key for key in keys]
+        return "\n".join(lines)
+
+
+class Tracer:
+    """Records resource usage for each step (print_step_label()) and each
+    command (do_or_die()), and writes it as JSON into 'filename'.
+    Default location is /boot, which can be read when the card is brought
+    back to the host.
+
+    Per step and per command:
+    wall            float   Seconds
+    cpu_user        float   Child user CPU seconds  (getrusage(RUSAGE_CHILDREN))
+    cpu_sys         float   Child system CPU seconds
+    maxrss_kb       int     Largest child RSS so far (RUSAGE_CHILDREN high-water)
+    read_bytes      int     Storage reads  (/proc/<pid>/io, incl. descendants)
+    write_bytes     int     Storage writes
+    net_rx, net_tx  int     System-wide network bytes during the step/command
+
+    Command I/O counters are read from the exited, but not yet reaped child
+    (waitid(WNOWAIT)), so that they include everything the command did.
+    Step I/O counters are those of this process, which include all reaped
+    children (commands and other subprocesses) as well.
+    The report is rewritten after every step, so a failed run leaves one too.
+    """
+    def __init__(self, filename: str):
+        self.filename   = filename
+        self.steps      = []
+        self.current    = None
+        self.extra      = {}
+        self.report     = {
+            "script"    : os.path.basename(__file__),
+            "version"   : __version__,
+            "host"      : platform.node(),
+            "started"   : datetime.datetime.now().isoformat(),
+            "result"    : "running",
+            "steps"     : self.steps
+        }
+        self._started   = time.monotonic()
+    @staticmethod
+    def _sample() -> dict:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return dict(
+            time        = time.monotonic(),
+            cpu_user    = usage.ru_utime,
+            cpu_sys     = usage.ru_stime,
+            maxrss_kb   = usage.ru_maxrss,
+            **net_bytes()
+        )
+    @staticmethod
+    def _delta(begin: dict, end: dict) -> dict:
+        return {
+            "wall"      : round(end["time"] - begin["time"], 3),
+            "cpu_user"  : round(end["cpu_user"] - begin["cpu_user"], 3),
+            "cpu_sys"   : round(end["cpu_sys"] - begin["cpu_sys"], 3),
+            "maxrss_kb" : end["maxrss_kb"],
+            "net_rx"    : end["net_rx"] - begin["net_rx"],
+            "net_tx"    : end["net_tx"] - begin["net_tx"]
+        }
+    def step(self, label: str):
+        """Close the current step (if any) and begin a new one."""
+        self.end_step()
+        self.current = {
+            "step"      : len(self.steps) + 1,
+            "label"     : label,
+            "commands"  : [],
+            "_begin"    : self._sample(),
+            "_io"       : proc_io()
+        }
+    def end_step(self):
+        if not self.current:
+            return
+        step = self.current
+        self.current = None
+        step.update(self._delta(step.pop("_begin"), self._sample()))
+        own = proc_io()
+        # Counters of reaped children are included in our own
+        for key in ("read_bytes", "write_bytes"):
+            step[key] = own[key] - step["_io"][key]
+        del step["_io"]
+        self.steps.append(step)
+        self.write()
+    def run(self, cmd: list, output: RingBuffer = None) -> int:
+        """Run command and record its usage. Returns the exit code.
+        If 'output' is given, command's stdout and stderr are captured into
+        it, appended into Config.output_log and echoed only if
+        Config.output_echo is set. On failure, the captured tail is included
+        in the report."""
+        begin = self._sample()
+        if output is None:
+            returncode, io = shell.run(cmd)
+        else:
+            tee = Config.output_file
+            tee.write("### {}\n".format(" ".join(cmd)).encode("utf-8"))
+            returncode, io = shell.run(cmd, output, tee, Config.output_echo)
+            tee.flush()
+        entry = {"command" : " ".join(cmd), "returncode" : returncode}
+        entry.update(self._delta(begin, self._sample()))
+        entry.update(io or {"read_bytes" : 0, "write_bytes" : 0})
+        if returncode and output is not None:
+            entry["output"] = output.tail()
+        if self.current:
+            self.current["commands"].append(entry)
+        else:
+            self.steps.append(dict(step = None, label = None, **entry))
+        log.debug(
+            "'{}' returned {} in {:.1f}s".format(
+                entry["command"], returncode, entry["wall"]
+            )
+        )
+        return returncode
+    def add(self, key: str, value):
+        """Attach additional (JSON serializable) data to the report."""
+        self.report[key] = value
+    def finish(self, result: str):
+        self.end_step()
+        self.report["result"] = result
+        self.write()
+        # Every exit path finishes the trace - save the recording as well
+        shell.save()
+    def write(self):
+        import json
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.report["total"] = {
+            "wall"      : round(time.monotonic() - self._started, 3),
+            "cpu_user"  : round(usage.ru_utime, 3),
+            "cpu_sys"   : round(usage.ru_stime, 3),
+            "maxrss_kb" : usage.ru_maxrss
+        }
+        try:
+            with open(self.filename + ".tmp", "w") as file:
+                json.dump(self.report, file, indent = 2)
+            os.replace(self.filename + ".tmp", self.filename)
+        except OSError as e:
+            log.error("Unable to write '{}': {}".format(self.filename, e))
+
+
+def sd_notify(state: str):
+    """Send state (such as 'STATUS=...') to systemd, if run as a service.
+    Equivalent of sd_notify(3), without the libsystemd dependency."""
+    import socket
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return
+    if address.startswith("@"):
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(state.encode("utf-8"), address)
+    except OSError as e:
+        log.debug("sd_notify() failed: " + str(e))
+
+
 def print_step_label(msg: str):
     try:
         (print_step_label.count)
@@ -179,6 +632,8 @@ def print_step_label(msg: str):
         print_step_label.count = 1
     else:
         print_step_label.count += 1
+    trace.step(msg)
+    sd_notify("STATUS=Step {}: {}".format(print_step_label.count, msg))
     log.info(
         "STEP {} : {}".format(
             print_step_label.count,
@@ -195,10 +650,19 @@ def print_step_label(msg: str):
     print("#" * 79)
 
 
-def do_or_die(cmd: list):
-    prc = subprocess.run(cmd.split(" "))
-    if prc.returncode:
+def do_or_die(cmd: list, cleanup = None):
+    """Run command, exit on failure. 'cleanup' (if given) is called before
+    exiting, to leave nothing half-done for a retried run."""
+    output = RingBuffer(Config.output_tail)
+    if trace.run(cmd.split(" "), output):
+        if not Config.output_echo:
+            print(output.tail(), end = "")
+        if cleanup:
+            cleanup()
         print("Command '{}' failed!".format(cmd))
+        print("Complete output in '{}'".format(Config.output_log))
+        trace.finish("failed: " + cmd)
+        sd_notify("STATUS=Failed: " + cmd)
         os._exit(-1)
 
 
@@ -238,82 +702,172 @@ def get_user(user) -> pwd.struct_passwd:
     return user
 
 
-def create_group(name, gid=None) -> grp.struct_group:
-    """Creates a group and returns grp.struct_group for it."""
-    # NOTE: use 'groupdel <name>' to remove
-    # There are no known Python modules to handle this, so subprocesses...
-    log = logging.getLogger(
-        __fileName + ":" + \
-        sys._getframe().f_code.co_name + "()"
-    )
-    if gid:
-        cmd = ["groupadd", "--gid", str(gid), name]
-    else:
-        cmd = ["groupadd", name]
-    log.debug("Running subprocess {}".format(" ".join(cmd)))
-    # Let exceptions propagate up. Nothing we can do about them anyway.
-    process = subprocess.run(cmd)
-    log.debug("Subprocess returned: " + str(process))
-    if process.returncode:
-        raise ValueError("Subprocess groupadd returned with nonzero code!")
-    return get_group(name)
-
-
-def create_user(name, pwd, primarygrp, uid=None) -> pwd.struct_passwd:
-    """Creates a user and returns pwd.struct_passwd for it. If primarygrp is None, user shall be created into its own group (like pi.pi, for example). NOTE: Debian Stretch 'useradd' has bug(s). For one, the default shell no longer gets set. We need to do this explictly after creation with 'usermod' command."""
-    # NOTE: use 'userdel -r -f <name>' to remove
-    # There are no known Python modules to handle this, so subprocesses...
-    log = logging.getLogger(
-        __fileName + ":" + \
-        sys._getframe().f_code.co_name + "()"
+def read_install_config(filename: str):
+    """Reads install.config (written into /boot by writesd.py) into Config."""
+    import configparser
+    cfg = configparser.ConfigParser()
+    if not cfg.read(filename):
+        return
+    Config.mode = cfg.get("Config", "mode", fallback = None)
+    if cfg.has_section("Mirror"):
+        Config.mirror_url = cfg["Mirror"].get("url") or None
+        Config.mirror_hosts = [
+            h.strip() for h in cfg["Mirror"].get("hosts", "").split(",")
+            if h.strip()
+        ]
+
+
+def git_mirror_options() -> str:
+    """'git -c' options rewriting repository URLs to the LAN mirror.
+    Passed on the commandline (not into ~/.gitconfig), so cloned
+    repositories keep their original remote URLs. Git passes them on to
+    submodule clones as well."""
+    if not Config.mirror_url:
+        return ""
+    import urllib.parse
+    hosts = Config.mirror_hosts or sorted(
+        {urllib.parse.urlsplit(repo[2]).hostname for repo in repositories}
     )
-    # useradd --password $(openssl passwd -1 patemon) --uid 2000 --user-group --create-home patemon
-    cmd = ["useradd"]
-    if pwd:
-        # Python 3.5 does not have 'capture_output' !!
-        proc_openssl = subprocess.run(
-            ["openssl", "passwd", "-1", pwd],
-            stdout = subprocess.PIPE
-        )
-        if proc_openssl.returncode:
-            raise ValueError("openssl returned error!")
-        cmd = [*cmd, *["--password", proc_openssl.stdout.decode("utf-8")[:-1]]]
-    if uid:
-        cmd = [*cmd, *["--uid", str(uid)]]
-    if primarygrp:
-        cmd = [*cmd, *["--gid", str(primarygrp)]]
-    else:
-        cmd = [*cmd, *["--user-group"]]
-    cmd = [*cmd, *["--create-home", name]]
-    log.debug("Subprocess: '{}'".format(" ".join(cmd)))
-    # Let exceptions propagate up. Nothing we can do about them anyway.
-    proc_useradd = subprocess.run(cmd, stdout = subprocess.PIPE)
-    log.debug("Subprocess returned: " + str(proc_useradd))
-    if proc_useradd.returncode:
-        raise ValueError(
-            "Subprocess useradd returned with nonzero code!\n" + \
-            proc_useradd.stdout.decode("utf-8")
-        )
-    # Buggy Debian Stretch 'useradd' needs you to set the shell explicitly
-    proc_usermod = subprocess.run(
-        ["usermod", "--shell", "/bin/bash", name]
+    base = Config.mirror_url.rstrip("/") + "/"
+    return "".join(
+        " -c url.{}{}/.insteadOf=https://{}/".format(base, host, host)
+        for host in hosts
     )
-    if proc_useradd.returncode:
-        raise ValueError(
-            "Subprocess usermod returned with nonzero code!\n" + \
-            proc_useradd.stdout.decode("utf-8")
-        )
-    return get_user(name)
 
 
-def add2group(user, group):
-    """Adds specified user to specified secondary group."""
-    # usermod -a G 
-    proc_usermod = subprocess.run(
-        ["usermod", "-a", "-G", group, user]
-    )
-    if proc_usermod.returncode:
-        raise ValueError("usermod returned non-zero!")
+def repository_mirror(url: str) -> str:
+    """Path of the prefetched bare mirror for the given repository URL."""
+    name = url.rstrip("/").split("/")[-1]
+    if not name.endswith(".git"):
+        name += ".git"
+    return os.path.join(Config.prefetch_dir, "git", name)
+
+
+def wheelhouse() -> str:
+    """Directory into which pip3 packages are prefetched."""
+    return os.path.join(Config.prefetch_dir, "wheels")
+
+
+class Prefetch:
+    """Runs download-only commands in background threads while the installer
+    performs purely local steps. Jobs are named lists of commands; commands
+    within one job run sequentially (apt commands share the archive lock),
+    separate jobs run concurrently. Output goes to 'prefetch.log' in the
+    cache directory, not to the console.
+
+    Prefetching is an optimization only - a failed job is logged and the
+    installer steps later simply download whatever is missing."""
+    def __init__(self, cachedir: str):
+        self.cachedir   = cachedir
+        self.jobs       = []    # [(name, [cmd, ...]), ...]
+        self.results    = {}    # name : (returncode, seconds)
+        self.threads    = []
+        self.started    = None
+        self.finished   = None
+        self.waited     = 0.0
+        self._lock      = threading.Lock()
+    def add(self, name: str, *cmds):
+        self.jobs.append((name, list(cmds)))
+    def _run(self, name: str, cmds: list):
+        start = time.monotonic()
+        returncode = 0
+        with open(os.path.join(self.cachedir, "prefetch.log"), "ab") as logfile:
+            for cmd in cmds:
+                logfile.write("### {}: {}\n".format(name, cmd).encode("utf-8"))
+                try:
+                    returncode, _ = shell.run(
+                        cmd.split(" "),
+                        RingBuffer(Config.output_tail),
+                        logfile,
+                        stdin = subprocess.DEVNULL
+                    )
+                except Exception as e:
+                    logfile.write((str(e) + "\n").encode("utf-8"))
+                    returncode = -1
+                if returncode:
+                    break
+        with self._lock:
+            self.results[name] = (returncode, time.monotonic() - start)
+            self.finished = time.monotonic()
+    def start(self):
+        os.makedirs(self.cachedir, exist_ok = True)
+        self.started = time.monotonic()
+        for name, cmds in self.jobs:
+            log.debug("Prefetch '{}': {}".format(name, " ; ".join(cmds)))
+            t = threading.Thread(target = self._run, args = (name, cmds))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+    def join(self):
+        """Wait for all jobs to finish. Time spent waiting is recorded."""
+        start = time.monotonic()
+        for t in self.threads:
+            t.join()
+        self.waited = time.monotonic() - start
+    def summary(self) -> dict:
+        """Job timings as a dictionary (for the step report)."""
+        total = 0.0
+        if self.started is not None and self.finished is not None:
+            total = self.finished - self.started
+        return {
+            "jobs"      : {
+                name : {"returncode" : code, "seconds" : round(secs, 3)}
+                for name, (code, secs) in self.results.items()
+            },
+            "download"  : round(total, 3),
+            "waited"    : round(self.waited, 3),
+            "hidden"    : round(max(total - self.waited, 0.0), 3)
+        }
+    def report(self) -> str:
+        """Summary of job timings and how much of the download was hidden."""
+        lines = []
+        for name, _ in self.jobs:
+            code, secs = self.results.get(name, (None, 0.0))
+            lines.append(
+                "    {:.<{w}} : {:7.1f}s {}".format(
+                    name, secs, "OK" if code == 0 else "FAILED ({})".format(code),
+                    w = 20
+                )
+            )
+        if self.started is not None and self.finished is not None:
+            total  = self.finished - self.started
+            hidden = max(total - self.waited, 0.0)
+            lines.append(
+                "    Download {:.1f}s, waited {:.1f}s, hidden {:.1f}s ({:.0f}%)".format(
+                    total, self.waited, hidden,
+                    100.0 * hidden / total if total else 100.0
+                )
+            )
+        return "\n".join(lines)
+
+
+def write_file(path: str, content: str):
+    with open(path, "w") as file:
+        file.write(content)
+
+
+def make_directory(path: str, mode: int = None, owner: str = None,
+                   group: str = None):
+    """Create directory, if it does not exist, and set its ownership and
+    mode (if given). ValueError if 'path' exists and is not a directory."""
+    if not os.path.exists(path):
+        os.makedirs(path)
+    elif not os.path.isdir(path):
+        raise ValueError("'{}' exists and is not a directory!".format(path))
+    if owner:
+        shutil.chown(path, owner, group)
+    if mode is not None:
+        os.chmod(path, mode)
+
+
+def clear_directory(path: str):
+    """Remove everything inside 'path'."""
+    for entry in os.listdir(path):
+        entry = os.path.join(path, entry)
+        if os.path.isdir(entry) and not os.path.islink(entry):
+            shutil.rmtree(entry)
+        else:
+            os.remove(entry)
 
 
 def localize_keymap(model = "pc105", layout = "fi", variant = "", options = ""):
@@ -323,8 +877,10 @@ def localize_keymap(model = "pc105", layout = "fi", variant = "", options = ""):
         "XKBMODEL=\"{}\"\nXKBLAYOUT=\"{}\"\n".format(model, layout) + \
         "XKBVARIANT=\"{}\"\nXKBOPTIONS=\"{}\"\n\n".format(variant, options) + \
         "BACKSPACE=\"guess\""
-    with open("/etc/default/keyboard", 'w') as kfile:
-        kfile.write(keyboard_config_file)
+    shell.call(
+        "write /etc/default/keyboard",
+        write_file, "/etc/default/keyboard", keyboard_config_file
+    )
     # Apply changes
     do_or_die('dpkg-reconfigure -f noninteractive keyboard-configuration')
     do_or_die('invoke-rc.d keyboard-setup start')
@@ -364,45 +920,502 @@ def display_all():
         print("OK")
 
 
-class User:
-    uid         = None
-    pwd         = None
-    grp         = None
-    othergroups = None
-    def __init__(self, name, uid=None, pwd=None, grp=None, othergroups=None):
-        self.name = name
-        self.uid = uid
-        self.pwd = pwd
-        self.grp = grp
-        self.othergroups = othergroups
-    @property
-    def exits(self) -> bool:
-        return get_user(self.name) is not None
-    @property
-    def struct_passwd(self):
-        return get_user(self.name)
-    def create(self):
-        # 
-        # Check that 'othergroups' exist
-        for grp in self.othergroups:
-            if not get_group(grp):
-                raise ValueError("Cannot create user! Secondary group '{}' does not exist!".format(grp))
-        create_user(
-            self.name,
-            self.pwd,
-            primarygrp = self.grp,
-            uid = self.uid
+class AccountDB:
+    """In-memory index of /etc/passwd, /etc/shadow, /etc/group and
+    /etc/gshadow. Loaded once, modified in memory, written back in one go.
+
+    Usage:
+        with AccountDB() as db:             # takes /etc/.pwd.lock
+            changes = db.plan(users, memberships)
+            db.commit()
+
+    Files are kept as lists of colon separated fields, in original order, so
+    that entries this script does not touch are written back unchanged.
+    Commit writes each file into '<file>+', fsyncs it and renames it over
+    the original (previous content is kept as '<file>-'), just as the shadow
+    utilities do. Locking is compatible with lckpwdf(3): a POSIX write lock
+    on '/etc/.pwd.lock', waited for at most 15 seconds.
+    If plan() finds nothing to do, commit() does not touch the files."""
+    files = ("passwd", "shadow", "group", "gshadow")
+    def __init__(self, etc: str = "/etc"):
+        self.etc        = etc
+        self._lockfd    = None
+        self.changes    = []
+        self.homes      = []        # (home, uid, gid) to create after commit
+        self.passwords  = {}        # username : password, hashed on commit
+        self.load()
+    def load(self):
+        self.table = {}
+        for name in self.files:
+            try:
+                with open(os.path.join(self.etc, name), "r") as file:
+                    self.table[name] = [
+                        line.rstrip("\n").split(":")
+                        for line in file if line.strip()
+                    ]
+            except FileNotFoundError:
+                self.table[name] = None
+        self.changes    = []
+        self.homes      = []
+        self.passwords  = {}
+        self.defs       = self._login_defs()
+    def _login_defs(self) -> dict:
+        defs = {
+            "UID_MIN" : 1000, "UID_MAX" : 60000,
+            "GID_MIN" : 1000, "GID_MAX" : 60000
+        }
+        try:
+            with open(os.path.join(self.etc, "login.defs"), "r") as file:
+                for line in file:
+                    parts = line.split()
+                    if len(parts) == 2 and parts[0] in defs:
+                        defs[parts[0]] = int(parts[1])
+        except (FileNotFoundError, ValueError):
+            pass
+        return defs
+    def __enter__(self):
+        self.lock()
+        # Re-read under the lock, nothing can change it now
+        self.load()
+        return self
+    def __exit__(self, type, value, traceback):
+        self.unlock()
+    def lock(self, timeout: int = 15):
+        import fcntl
+        fd = os.open(
+            os.path.join(self.etc, ".pwd.lock"),
+            os.O_WRONLY | os.O_CREAT,
+            0o600
         )
-        for grp in self.othergroups:
-            proc_usermod = subprocess.run(
-                ["usermod", "-a", "-G", grp, self.name]
-            )
-            if proc_usermod.returncode:
-                raise ValueError("usermod returned non-zero!")
-    def __str__(self):
-        return "{} ({}) pwd: '{}', grp: '{}', other groups: '{}'".format(
-            self.name, self.uid, self.pwd, self.grp, self.othergroups
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    os.close(fd)
+                    raise ValueError(
+                        "Unable to lock account files (/etc/.pwd.lock)!"
+                    )
+                time.sleep(0.2)
+        self._lockfd = fd
+    def unlock(self):
+        if self._lockfd is not None:
+            os.close(self._lockfd)
+            self._lockfd = None
+    #
+    # Lookups (replace NSS queries get_user() / get_group())
+    #
+    def _find(self, table: str, name: str) -> list:
+        for entry in self.table[table] or []:
+            if entry[0] == name:
+                return entry
+        return None
+    def user(self, name: str) -> list:
+        return self._find("passwd", name)
+    def group(self, name: str) -> list:
+        return self._find("group", name)
+    def group_names(self) -> list:
+        return [g[0] for g in self.table["group"]]
+    def members(self, group: str) -> list:
+        entry = self.group(group)
+        if not entry or not entry[3]:
+            return []
+        return entry[3].split(",")
+    def _next_id(self, table: str, idx: int, lo: str, hi: str) -> int:
+        used = {int(e[idx]) for e in self.table[table] if e[idx].isdigit()}
+        lo, hi = self.defs[lo], self.defs[hi]
+        inrange = [i for i in used if lo <= i <= hi]
+        nextid = max(inrange) + 1 if inrange else lo
+        while nextid in used:
+            nextid += 1
+        if nextid > hi:
+            raise ValueError("No free IDs left in {}!".format(table))
+        return nextid
+    def _free_gid(self, wanted: int = None) -> int:
+        used = {int(g[2]) for g in self.table["group"]}
+        if wanted is not None and wanted not in used:
+            return wanted
+        return self._next_id("group", 2, "GID_MIN", "GID_MAX")
+    #
+    # Modifications (in memory only)
+    #
+    def add_group(self, name: str, gid: int = None) -> int:
+        gid = self._free_gid(gid)
+        self.table["group"].append([name, "x", str(gid), ""])
+        if self.table["gshadow"] is not None:
+            self.table["gshadow"].append([name, "!", "", ""])
+        self.changes.append("create group '{}' ({})".format(name, gid))
+        return gid
+    def add_user(self, name: str, uid: int, password: str, primarygrp: str):
+        if uid is None:
+            uid = self._next_id("passwd", 2, "UID_MIN", "UID_MAX")
+        if primarygrp is None:
+            gid = self.add_group(name, uid)
+        else:
+            gid = int(self.group(primarygrp)[2])
+        home = "/home/" + name
+        self.table["passwd"].append(
+            [name, "x", str(uid), str(gid), "", home, "/bin/bash"]
+        )
+        if password:
+            self.passwords[name] = password
+        self.table["shadow"].append([
+            name,
+            "!",
+            str(int(time.time() // 86400)),
+            "0", "99999", "7", "", "", ""
+        ])
+        self.homes.append((home, uid, gid))
+        self.changes.append("create user '{}' ({}:{})".format(name, uid, gid))
+    def add_member(self, user: str, group: str):
+        if user in self.members(group):
+            return
+        for table in ("group", "gshadow"):
+            entry = self._find(table, group) if self.table[table] else None
+            if entry:
+                entry[3] = ",".join([m for m in entry[3].split(",") if m] + [user])
+        self.changes.append("add '{}' to group '{}'".format(user, group))
+    def plan(self, users: list, memberships: dict) -> list:
+        """Computes (in memory) changes needed to reach the desired state
+        described by 'users' and 'memberships' (see top of this script).
+        Returns a list of change descriptions - empty list if none."""
+        for name, uid, password, primarygrp, othergroups in users:
+            if self.user(name):
+                continue
+            for group in [primarygrp, *(othergroups or [])]:
+                if group and not self.group(group):
+                    raise ValueError(
+                        "Cannot create user '{}'! Group '{}' does not exist!".format(
+                            name, group
+                        )
+                    )
+            self.add_user(name, uid, password, primarygrp)
+        wanted = [
+            (name, group)
+            for name, _, _, _, othergroups in users
+            for group in othergroups or []
+        ]
+        for user, groups in memberships.items():
+            wanted += [(user, group) for group in groups]
+        for user, group in wanted:
+            if not self.user(user):
+                raise ValueError("User '{}' does not exist!".format(user))
+            if not self.group(group):
+                raise ValueError("Group '{}' does not exist!".format(group))
+            self.add_member(user, group)
+        return self.changes
+    #
+    # Write back
+    #
+    def commit(self):
+        """Write all files, if there are changes. Must hold the lock."""
+        if not self.changes:
+            return
+        if self._lockfd is None:
+            raise ValueError("AccountDB.commit() called without lock!")
+        for name, password in self.passwords.items():
+            self._find("shadow", name)[1] = hash_password(password)
+        for name in self.files:
+            if self.table[name] is None:
+                continue
+            path = os.path.join(self.etc, name)
+            stats = os.stat(path)
+            with open(path + "+", "w") as file:
+                file.write("".join(":".join(e) + "\n" for e in self.table[name]))
+                file.flush()
+                os.fsync(file.fileno())
+            os.chmod(path + "+", stats.st_mode & 0o7777)
+            os.chown(path + "+", stats.st_uid, stats.st_gid)
+            shutil.copy2(path, path + "-")
+            os.rename(path + "+", path)
+        for home, uid, gid in self.homes:
+            if os.path.exists(home):
+                continue
+            shutil.copytree("/etc/skel", home, symlinks = True)
+            os.chmod(home, 0o755)
+            for dirpath, dirnames, filenames in os.walk(home):
+                for entry in [dirpath] + [
+                    os.path.join(dirpath, f) for f in dirnames + filenames
+                ]:
+                    os.lchown(entry, uid, gid)
+        self.changes    = []
+        self.homes      = []
+        self.passwords  = {}
+
+
+def provision_accounts() -> list:
+    """Resolve 'users' and 'memberships' against the account files and
+    write all changes at once. Returns the list of changes made."""
+    with AccountDB() as accounts:
+        changes = accounts.plan(users, memberships)
+        accounts.commit()
+    return changes
+
+
+def hash_password(password: str) -> str:
+    """SHA-512 crypt(3) hash, computed in-process when 'crypt' is available.
+    Falls back to 'openssl passwd' otherwise."""
+    try:
+        import crypt
+        return crypt.crypt(password, crypt.mksalt(crypt.METHOD_SHA512))
+    except ImportError:
+        proc = subprocess.run(
+            ["openssl", "passwd", "-6", password],
+            stdout = subprocess.PIPE
         )
+        if proc.returncode:
+            raise ValueError("openssl returned error!")
+        return proc.stdout.decode("utf-8").strip()
+
+###############################################################################
+#
+# Plan (--plan) - drift between desired state and the system, computed
+# without running any subprocesses. Files are read directly.
+#
+
+def debian_version_compare(a: str, b: str) -> int:
+    """Compares Debian package versions like 'dpkg --compare-versions'.
+    Returns negative, zero or positive (a < b, a == b, a > b)."""
+    def order(c: str) -> int:
+        if c == "~":
+            return -1
+        if c.isdigit():
+            return 0
+        if c.isalpha():
+            return ord(c)
+        return ord(c) + 256
+    def compare_part(a: str, b: str) -> int:
+        while a or b:
+            # Non-digit prefix, character by character ('~' sorts first)
+            i = j = 0
+            while i < len(a) and not a[i].isdigit():
+                i += 1
+            while j < len(b) and not b[j].isdigit():
+                j += 1
+            pa, pb = a[:i], b[:j]
+            for k in range(max(len(pa), len(pb))):
+                ca = order(pa[k]) if k < len(pa) else 0
+                cb = order(pb[k]) if k < len(pb) else 0
+                if ca != cb:
+                    return ca - cb
+            a, b = a[i:], b[j:]
+            # Digit prefix, numerically
+            i = j = 0
+            while i < len(a) and a[i].isdigit():
+                i += 1
+            while j < len(b) and b[j].isdigit():
+                j += 1
+            na, nb = int(a[:i] or 0), int(b[:j] or 0)
+            if na != nb:
+                return na - nb
+            a, b = a[i:], b[j:]
+        return 0
+    def split(v: str) -> tuple:
+        # Epoch ends at the first colon, upstream version may contain more
+        epoch, _, v = v.partition(":") if ":" in v else ("0", "", v)
+        upstream, _, revision = v.rpartition("-") if "-" in v else (v, "", "0")
+        return int(epoch or 0), upstream, revision
+    ea, ua, ra = split(a)
+    eb, ub, rb = split(b)
+    if ea != eb:
+        return ea - eb
+    return compare_part(ua, ub) or compare_part(ra, rb)
+
+
+def dpkg_installed(names: list, status: str = "/var/lib/dpkg/status") -> dict:
+    """Installed versions of the named packages, read from dpkg status."""
+    installed = {}
+    with open(status, "r", encoding = "utf-8", errors = "replace") as file:
+        for stanza in file.read().split("\n\n"):
+            fields = {}
+            for line in stanza.split("\n"):
+                key, sep, value = line.partition(": ")
+                if sep and key in ("Package", "Status", "Version"):
+                    fields[key] = value
+            if fields.get("Package") in names and \
+               fields.get("Status", "").endswith(" installed"):
+                installed[fields["Package"]] = fields.get("Version")
+    return installed
+
+
+def apt_candidates(names: list, lists: str = "/var/lib/apt/lists") -> dict:
+    """Highest available version of the named packages in the APT package
+    lists (pinning is not considered). Package lists are large (tens of MB),
+    so they are mmap()'ed and searched only for the wanted stanzas."""
+    import mmap
+    import glob
+    filenames = sorted(glob.glob(os.path.join(lists, "*_Packages")))
+    candidates = {}
+    for filename in filenames:
+        with open(filename, "rb") as file:
+            if not os.fstat(file.fileno()).st_size:
+                continue
+            with mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+                for name in names:
+                    key = b"Package: " + name.encode() + b"\n"
+                    pos = 0 if mm[:len(key)] == key else mm.find(b"\n" + key)
+                    while pos >= 0:
+                        end = mm.find(b"\n\n", pos + 1)
+                        end = len(mm) if end < 0 else end
+                        v = mm.find(b"\nVersion: ", pos + 1, end)
+                        if v >= 0:
+                            eol = mm.find(b"\n", v + 1)
+                            eol = end if eol < 0 or eol > end else eol
+                            version = mm[v + 10:eol].decode()
+                            if name not in candidates or \
+                               debian_version_compare(
+                                   version, candidates[name]
+                               ) > 0:
+                                candidates[name] = version
+                        pos = mm.find(b"\n" + key, end)
+    return candidates
+
+
+def git_local_head(path: str) -> str:
+    """Commit SHA of HEAD in the repository at 'path', or None."""
+    gitdir = os.path.join(path, ".git")
+    try:
+        with open(os.path.join(gitdir, "HEAD"), "r") as file:
+            head = file.read().strip()
+        if not head.startswith("ref: "):
+            return head
+        ref = head[5:]
+        try:
+            with open(os.path.join(gitdir, ref), "r") as file:
+                return file.read().strip()
+        except FileNotFoundError:
+            with open(os.path.join(gitdir, "packed-refs"), "r") as file:
+                for line in file:
+                    if line.rstrip("\n").endswith(" " + ref):
+                        return line.split(" ")[0]
+    except OSError:
+        pass
+    return None
+
+
+def git_remote_head(url: str, timeout: float) -> str:
+    """Commit SHA of remote HEAD, from the smart HTTP ref advertisement
+    (same request 'git ls-remote' makes). None on any failure."""
+    import urllib.request
+    request = urllib.request.Request(
+        url.rstrip("/") + "/info/refs?service=git-upload-pack",
+        headers = {"User-Agent" : "git/2.20.1"}
+    )
+    try:
+        with urllib.request.urlopen(request, timeout = timeout) as response:
+            data = response.read(65536)
+    except Exception:
+        return None
+    # pkt-lines: "<4 hex length><payload>", first ref line is HEAD
+    while data:
+        try:
+            length = int(data[:4], 16)
+        except ValueError:
+            return None
+        payload, data = data[4:length], data[max(length, 4):]
+        line = payload.split(b"\0")[0].rstrip(b"\n")
+        if line.endswith(b" HEAD"):
+            return line[:40].decode()
+    return None
+
+
+def plan() -> list:
+    """Returns a list of (step, description) tuples for everything that
+    differs from the desired state. Empty list means no drift."""
+    drift = []
+    #
+    # Users, groups and memberships (read-only, no lock needed)
+    #
+    accounts = AccountDB()
+    try:
+        for change in accounts.plan(users, memberships):
+            drift.append(("accounts", change))
+    except ValueError as e:
+        drift.append(("accounts", str(e)))
+    #
+    # Filesystem ownerships and modes
+    #
+    # Repository step runs last, its settings are the final ones
+    wanted = dict(initialfilesys)
+    for repo in repositories:
+        owner, _, group = repo[1][1].partition(".")
+        wanted[repo[1][2]] = (int(repo[1][0], 8), owner, group)
+    for path, (mode, owner, group) in wanted.items():
+        try:
+            stats = os.stat(path)
+        except FileNotFoundError:
+            drift.append(("filesystem", "'{}' does not exist".format(path)))
+            continue
+        if stats.st_mode & 0o777 != mode:
+            drift.append((
+                "filesystem",
+                "'{}' mode {} (want {})".format(
+                    path, oct(stats.st_mode & 0o777), oct(mode)
+                )
+            ))
+        user = accounts.user(owner)
+        if not user or stats.st_uid != int(user[2]):
+            drift.append(("filesystem", "'{}' owner not '{}'".format(path, owner)))
+        grp_entry = accounts.group(group)
+        if not grp_entry or stats.st_gid != int(grp_entry[2]):
+            drift.append(("filesystem", "'{}' group not '{}'".format(path, group)))
+    #
+    # APT packages
+    #
+    installed  = dpkg_installed(packages)
+    candidates = apt_candidates(packages)
+    for name in packages:
+        if name not in installed:
+            drift.append(("packages", "'{}' not installed".format(name)))
+        elif name in candidates and \
+             debian_version_compare(candidates[name], installed[name]) > 0:
+            drift.append((
+                "packages",
+                "'{}' {} outdated ({} available)".format(
+                    name, installed[name], candidates[name]
+                )
+            ))
+    #
+    # pip3 installed uwsgi
+    #
+    if not shutil.which("uwsgi"):
+        drift.append(("pip3", "'uwsgi' not installed"))
+    #
+    # Repositories (remote HEADs queried concurrently)
+    #
+    remote = {}
+    def query(url: str):
+        remote[url] = git_remote_head(url, Config.plan_timeout)
+    threads = [
+        threading.Thread(target = query, args = (repo[2],))
+        for repo in repositories
+    ]
+    for t in threads:
+        t.start()
+    for repo in repositories:
+        if not os.path.isdir(os.path.join(repo[1][2], ".git")):
+            drift.append(("repositories", "'{}' not cloned".format(repo[0])))
+    for t in threads:
+        t.join()
+    for repo in repositories:
+        local = git_local_head(repo[1][2])
+        if local is None:
+            continue
+        if remote.get(repo[2]) is None:
+            drift.append((
+                "repositories",
+                "'{}' remote HEAD unavailable".format(repo[0])
+            ))
+        elif remote[repo[2]] != local:
+            drift.append((
+                "repositories",
+                "'{}' {} is not at remote HEAD {}".format(
+                    repo[0], local[:8], remote[repo[2]][:8]
+                )
+            ))
+    return drift
 
 ###############################################################################
 #
@@ -436,8 +1449,48 @@ if __name__ == '__main__':
         help = 'Check installation.',
         action = 'store_true'
     )
+    parser.add_argument(
+        '--plan',
+        help = 'Show what would be changed, without changing anything.\n' +
+               'Exit code is 1 if there is something to change.',
+        action = 'store_true'
+    )
+    parser.add_argument(
+        '-v',
+        '--verbose',
+        help = 'Show command output on console.',
+        action = 'store_true'
+    )
+    parser.add_argument(
+        '--noprefetch',
+        help = 'Do not download packages and repositories in background.',
+        action = 'store_true'
+    )
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        '--record',
+        help = 'Record commands, their results and timings into FILE.',
+        metavar = "FILE"
+    )
+    group.add_argument(
+        '--replay',
+        help = 'Replay a recorded run from FILE. Nothing is executed or\n' +
+               'changed, files are written under \'{}/\'.'.format(
+                   Config.replay_dir
+               ),
+        metavar = "FILE"
+    )
+    parser.add_argument(
+        '--time-scale',
+        help = 'Replay: multiplier for recorded durations (0 = no waiting).\n' +
+               'Default: 1.0',
+        type = float,
+        default = 1.0,
+        metavar = "FACTOR"
+    )
     args = parser.parse_args()
     Config.logging_level = getattr(logging, args.logging_level)
+    Config.output_echo   = args.verbose
 
 
     #
@@ -451,6 +1504,23 @@ if __name__ == '__main__':
     )
     log = logging.getLogger()
 
+    #
+    # Command layer (live, recording or replaying)
+    #
+    if args.replay:
+        shell = Shell("replay", args.replay, args.time_scale)
+        # Run as it was on the unit
+        for key, value in shell.config.items():
+            setattr(Config, key, value)
+        Config.trace_file = shell.local(Config.trace_file)
+    else:
+        read_install_config(Config.install_config)
+        shell = Shell("record" if args.record else "live", args.record)
+        shell.config = {
+            key : getattr(Config, key)
+            for key in ("mode", "mirror_url", "mirror_hosts")
+        }
+
     #
     # Special feature - check and exit
     #
@@ -458,6 +1528,21 @@ if __name__ == '__main__':
         display_all()
         os._exit(0)
 
+    #
+    # Special feature - plan and exit
+    #
+    if args.plan:
+        start = time.monotonic()
+        drift = plan()
+        for step, description in drift:
+            print("[{}] {}".format(step, description))
+        log.info(
+            "Plan: {} change(s) in {:.3f}s".format(
+                len(drift), time.monotonic() - start
+            )
+        )
+        os._exit(1 if drift else 0)
+
 
     #
     # ELSE, we install...
@@ -469,6 +1554,69 @@ if __name__ == '__main__':
             datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         )
     )
+    trace = Tracer(Config.trace_file)
+    Config.output_log = shell.local(Config.output_log)
+    os.makedirs(os.path.dirname(Config.output_log), exist_ok = True)
+    Config.output_file = open(Config.output_log, "ab")
+
+
+    print_step_label("Updating package lists...")
+    do_or_die("apt update")
+    print("Package lists updated!\n")
+
+
+    #
+    # Background prefetch
+    #
+    #   Network would sit idle during the local configuration steps below.
+    #   Download everything that the later steps need now, so that upgrade,
+    #   install, pip and git find it already on disk. 'apt-get -d' takes only
+    #   the archive lock (not the dpkg lock), so it does not collide with
+    #   'dpkg-reconfigure' calls made meanwhile. The apt upgrade itself is
+    #   postponed until the prefetch has been joined.
+    #
+    prefetch = Prefetch(shell.local(Config.prefetch_dir))
+    if not args.noprefetch:
+        print_step_label("Starting background prefetch...")
+        prefetch.add(
+            "apt",
+            "apt-get -y -q --download-only upgrade",
+            "apt-get -y -q --download-only install " + " ".join(packages)
+        )
+        if shell.call("which git", shutil.which, "git"):
+            for repo in repositories:
+                mirror = repository_mirror(repo[2])
+                if shell.call("isdir " + mirror, os.path.isdir, mirror):
+                    prefetch.add(
+                        repo[0],
+                        "git{} --git-dir={} fetch --prune origin".format(
+                            git_mirror_options(), mirror
+                        )
+                    )
+                else:
+                    prefetch.add(
+                        repo[0],
+                        "git{} clone --quiet --mirror {} {}".format(
+                            git_mirror_options(), repo[2], mirror
+                        )
+                    )
+        else:
+            log.info("git not yet installed, repositories not prefetched")
+        if shell.call("which pip3", shutil.which, "pip3"):
+            prefetch.add(
+                "pip3",
+                # setuptools and wheel: build requirements of uwsgi (sdist)
+                "pip3 download --quiet --dest {} uwsgi setuptools wheel".format(
+                    wheelhouse()
+                )
+            )
+        else:
+            log.info("pip3 not yet installed, uwsgi not prefetched")
+        prefetch.start()
+        print("Prefetching {} in background\n".format(
+                ", ".join(name for name, _ in prefetch.jobs)
+            )
+        )
 
 
     # non-interactive timezone configuration
@@ -486,12 +1634,6 @@ if __name__ == '__main__':
     print("Done!")
 
 
-    print_step_label("Updating system packages....")
-    do_or_die("apt update")
-    do_or_die("apt -y upgrade")
-    print("System update done!\n")
-
-
     #
     # Check that necesary groups exist or will exist
     #
@@ -504,7 +1646,9 @@ if __name__ == '__main__':
         if user[3] is None:
             future_groups.append(user[0])
     # Get existing groups and merge both into one list
-    existing_groups = [g.gr_name for g in grp.getgrall()]
+    existing_groups = shell.call(
+        "group names", lambda: AccountDB().group_names()
+    )
     all_groups = [*future_groups, *existing_groups]
 
     # Generate a list of needed groups
@@ -517,53 +1661,35 @@ if __name__ == '__main__':
     if missing:
         log.error("Missing necessary group(s): {}".format(",".join(missing)))
         print("Missing necessary group(s): {}".format(",".join(missing)))
+        trace.finish("failed: missing groups")
         os._exit(-1)
     print("Groups OK!\n")
 
 
     #
-    # Create solution specific user accounts
+    # Create solution specific user accounts and assign group memberships
+    #
+    #   Desired state ('users' and 'memberships') is resolved against
+    #   in-memory copy of passwd/shadow/group/gshadow and all changes
+    #   are written at once, under the account file lock.
+    #   Re-runs find nothing to change and write nothing.
     #
-    print_step_label("Creating PATE Monitor specific user accounts...")
+    print_step_label(
+        "Creating PATE Monitor specific user accounts and group memberships..."
+    )
     try:
-        for usertuple in users:
-            user = User(*usertuple)
-            if not user.exits:
-                print(
-                    "User '{}' does not exist. Creating...".format(
-                        user.name
-                    ),
-                    end="",
-                    flush=True
-                )
-                user.create()
-                print("OK!")
-
-            # print(str(user.struct_passwd))
-            # print("exits" if user.exits else "does not exist")
+        changes = shell.call("accounts", provision_accounts)
+        for change in changes:
+            print("    " + change[:1].upper() + change[1:])
+            log.info("Account change: " + change)
     except Exception as e:
         log.exception("User account creation failed!")
         print("User account creation failed!")
         print(str(e))
+        trace.finish("failed: " + str(e))
         os._exit(-1)
-    print("")
-
-
-    #
-    # Assign group memberships
-    #
-    print_step_label("Assigning group memberships...")
-    for user, groups in memberships.items():
-        for group in groups:
-            print(
-                "    Adding user '{}' to group '{}'...".format(
-                    user, group
-                ),
-                end="",
-                flush=True
-            )
-            add2group(user, group)
-            print("Done!")
+    if not changes:
+        print("    Nothing to change.")
     print("")
 
 
@@ -573,18 +1699,36 @@ if __name__ == '__main__':
     print_step_label(
         "Setting up initial filesystem ownerships and permissions..."
     )
-    for path, values in initialfilesys.items():
-        if not os.path.exists(path):
-            os.makedirs(path)
-        elif not os.path.isdir(path):
-            print("ERROR! '{}' exists and is not a directory!".format(path))
-            os._exit(-1)
-        shutil.chown(path, values[1], values[2])
-        os.chmod(path, values[0])
+    try:
+        for path, values in initialfilesys.items():
+            shell.call(
+                "directory " + path,
+                make_directory, path, values[0], values[1], values[2]
+            )
+    except ValueError as e:
+        print("ERROR! " + str(e))
+        trace.finish("failed: " + str(e))
+        os._exit(-1)
     print("Ownerships and permissions OK!\n")
 
 
 
+    #
+    # Join prefetch and upgrade system packages
+    #
+    if prefetch.threads:
+        print_step_label("Waiting for background prefetch...")
+        prefetch.join()
+        log.info("Prefetch results:\n" + prefetch.report())
+        trace.add("prefetch", prefetch.summary())
+        print(prefetch.report() + "\n")
+
+
+    print_step_label("Upgrading system packages....")
+    do_or_die("apt -y upgrade")
+    print("System update done!\n")
+
+
     #
     # Install packages (required by Pate Monitor)
     #
@@ -603,7 +1747,19 @@ if __name__ == '__main__':
     # Pip install(s)
     #
     print_step_label("pip3 install uwsgi...")
-    do_or_die("pip3 install uwsgi")
+    # Offline install only if this run prefetched the wheelhouse completely
+    # (uwsgi and its build requirements), PyPI is then not contacted at all.
+    # Partial or stale wheelhouse, or failed offline install - use PyPI.
+    if not shell.call(
+        "prefetched pip3",
+        lambda: prefetch.results.get("pip3", (None, ))[0] == 0
+    ) or trace.run(
+        "pip3 install --no-index --find-links {} uwsgi".format(
+            wheelhouse()
+        ).split(" "),
+        RingBuffer(Config.output_tail)
+    ):
+        do_or_die("pip3 install uwsgi")
     print("uwsgi OK!\n")
 
 
@@ -621,25 +1777,48 @@ if __name__ == '__main__':
         repo_run = repo[3]
 
         # Create and change to target directory
-        if not os.path.exists(repo_dir):
-            os.makedirs(repo_dir)
-        elif not os.path.isdir(repo_dir):
-            print(
-                "ERROR! '{}' exists and is not a directory!".format(
-                    repo_dir
-                )
-            )
+        try:
+            shell.call("directory " + repo_dir, make_directory, repo_dir)
+        except ValueError as e:
+            print("ERROR! " + str(e))
+            trace.finish("failed: " + str(e))
             os._exit(-1)
         do_or_die("chown {} {}".format(repo_usr, repo_dir))
         do_or_die("chmod {} {}".format(repo_prm, repo_dir))
-        os.chdir(repo_dir)
+        shell.call("chdir " + repo_dir, os.chdir, repo_dir)
 
         print("-" * 79)
         print("Retrieving and setting up " + reponame)
         print("-" * 79)
 
-        # Run git clone
-        do_or_die("git clone --recurse-submodules " + repo_url + " .")
+        # Already cloned by an earlier (failed and retried) run?
+        # Clones are made by root into repo_dir owned by repo_usr, which
+        # git refuses to work in ("dubious ownership") unless it is trusted.
+        if shell.call("isdir " + repo_dir + "/.git", os.path.isdir, ".git"):
+            do_or_die(
+                "git -c safe.directory={} pull --ff-only "
+                "--recurse-submodules".format(repo_dir)
+            )
+        else:
+            # Run git clone (borrowing objects from prefetched mirror, if any)
+            clone = "clone --recurse-submodules "
+            mirror = repository_mirror(repo_url)
+            if shell.call("isdir " + mirror, os.path.isdir, mirror):
+                clone += "--reference-if-able " + mirror + " --dissociate "
+            clone += repo_url + " ."
+            # Failed clone is removed, so that the retried run clones again
+            # instead of pulling into a partial repository
+            clear = lambda: shell.call("clear " + repo_dir, clear_directory, ".")
+            # Through LAN git mirror, if configured. Origin if that fails.
+            if not Config.mirror_url:
+                do_or_die("git " + clone, clear)
+            elif trace.run(
+                ("git" + git_mirror_options() + " " + clone).split(" "),
+                RingBuffer(Config.output_tail)
+            ):
+                print("Clone through LAN mirror failed, using origin...")
+                clear()
+                do_or_die("git " + clone, clear)
 
         # Run post-clone script, if any
         if repo_run:
@@ -650,6 +1829,13 @@ if __name__ == '__main__':
 
 
     print("All repositories cloned!\n")
+    trace.finish("completed")
+    sd_notify("STATUS=Installation completed")
+    print("Step report written to '{}'".format(Config.trace_file))
+    if shell.replaying:
+        print(shell.summary())
+    elif args.record:
+        print("Recording written to '{}'".format(args.record))
 
 
 # EOF
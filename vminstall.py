@@ -10,6 +10,22 @@
 #   0.2.2   2019-12-20  Fix repository URL
 #   0.2.3   2019-12-20  Minor fix
 #   0.2.4   2019-12-23  Updated for v0.2.0 utu-vm-site
+#   0.3.0   2026-10-19  Command output captured into a bounded buffer and
+#                       'install.output.log', failures report its tail.
+#   0.4.0   2026-10-19  Command layer (Shell) with --record and --replay.
+#   0.5.0   2026-10-19  SSH key and TLS certificate generated in background
+#                       during package installation, --fast-keys.
+#   0.5.1   2026-10-19  Use TLS certificate pre-generated by writesd.py.
+#   0.6.0   2026-10-19  nginx and uWSGI sized by tuning profile (--profile).
+#   0.7.0   2026-10-19  Static files served by Nginx (open_file_cache,
+#                       gzip_static, immutable fingerprinted assets).
+#   0.8.0   2026-10-19  Optional Nginx response cache (--cache).
+#   0.9.0   2026-10-19  application.sqlite3 in WAL mode, ANALYZEd, indexes
+#                       checked.
+#   0.10.0  2026-10-19  Config files replaced atomically, only if changed.
+#                       Only services with changed configuration reloaded.
+#   0.11.0  2026-10-19  Graceful uWSGI (master FIFO) and nginx reloads.
+#   0.11.1  2026-10-19  tuning() for given core count and memory (benchvm.py).
 #
 #   MUST have Python 3.5+ (subprocess.run())
 #
@@ -21,16 +37,18 @@ import os
 import sys
 import pwd
 import grp
+import time
 import getpass
 import sqlite3
 import logging
 import platform
 import argparse
 import datetime
+import threading
 import subprocess
 
 # PEP 396 -- Module Version Numbers https://www.python.org/dev/peps/pep-0396/
-__version__ = "0.2.4"
+__version__ = "0.11.1"
 __author__  = "Jani Tammi <jasata@utu.fi>"
 VERSION = __version__
 HEADER  = """
@@ -43,6 +61,41 @@ Version {}, 2019 {}
 
 class Config:
     logging_level = "DEBUG"
+    # Command output; last 'output_tail' bytes are reported on failure,
+    # everything is appended to 'output_log' (opened as 'output_file').
+    output_tail   = 16 * 1024
+    output_log    = "install.output.log"
+    output_file   = None
+    # Key types. RSA 4096 by default, '--fast-keys' selects Ed25519 (SSH)
+    # and ECDSA P-256 (TLS), which are generated in milliseconds.
+    ssh_key       = "-b 4096 -t rsa"
+    tls_key       = "rsa:4096"
+    # Nginx response cache (--cache). Anonymous GET/HEAD requests to URLs
+    # beginning with one of 'cache_routes' are cached 'cache_ttl' seconds,
+    # unless the response sets a cookie or its own caching headers.
+    # Any non-empty 'cache_bypass' value (session, SSO) bypasses the cache.
+    cache         = False
+    cache_routes  = ["/"]
+    cache_ttl     = 60          # Seconds
+    cache_size    = 64          # Megabytes, on disk
+    cache_dir     = "/var/cache/nginx/vm.utu.fi"   # Created by vminstall.py
+    cache_bypass  = [
+        "$cookie_ssoUTUauth",
+        "$cookie_FLASKSESSION",
+        "$http_authorization",
+        "$arg_nocache"
+    ]
+    # application.sqlite3 profile. Page size and WAL journal are stored in
+    # the database file, 'synchronous' and 'mmap_size' are per connection
+    # (used for the creation only).
+    sqlite_page_size    = 4096
+    sqlite_mmap_size    = 64 * 1024**2
+    # Graceful reloads (uWSGI master FIFO, nginx -t + reload). Seconds to
+    # wait for new workers to be ready (uWSGI) / old workers to finish.
+    reload_timeout      = 60
+    uwsgi_fifo          = "/run/uwsgi/app/vm.utu.fi/master.fifo"
+    uwsgi_stats         = "/run/uwsgi/app/vm.utu.fi/stats.socket"
+    nginx_pidfile       = "/run/nginx.pid"
 
 class ConfigFile:
     """As everything in this script, assumes superuser privileges. Only filename and content are required. User and group will default to effective user and group values on creation time and permissions default to common text file permissions wrxwr-wr- (0o644).
@@ -54,11 +107,13 @@ class ConfigFile:
     gid             int     Group ID
     permissions     int     File permissions. Use octal; 0o644
     content         str     This class was written to handle config files
+    services        list    Services that need a reload when file changes
 
     Once properties and content are satisfactory, write the file to disk:
     myFile = File(...)
     myFile.create(overwrite = True)
     If you wish the write to fail when the target file already exists, just leave out the 'overwrite'.
+    Existing file is replaced (atomically) only if the content differs, and create() returns True if it was written.
     """
     def __init__(
         self,
@@ -66,19 +121,21 @@ class ConfigFile:
         content: str,
         owner: str = None,
         group: str = None,
-        permissions: int = 0o644
+        permissions: int = 0o644,
+        services: list = None
     ):
         # Default to effective UID/GID
         owner = pwd.getpwuid(os.geteuid()).pw_name if not owner else owner
         group = grp.getgrgid(os.getegid()).gr_name if not group else group
+        # IDs are looked up when needed (owner may not exist yet, or at all
+        # when a recorded run is replayed elsewhere)
         self.name           = name
         self._owner         = owner
         self._group         = group
-        self._uid           = pwd.getpwnam(owner).pw_uid
-        self._gid           = grp.getgrnam(group).gr_gid
         self.permissions    = permissions
         self.content        = content
-    def create(self, overwrite = False, createdirs = True):
+        self.services       = services or []
+    def create(self, overwrite = False, createdirs = True) -> bool:
         def createpath(path, uid, gid, permissions = 0o775):
             """Give path part only as an argument"""
             head, tail = os.path.split(path)
@@ -86,7 +143,7 @@ class ConfigFile:
                 head, tail = os.path.split(head)
             if head and tail and not os.path.exists(head):
                 try:
-                    createpath(head)
+                    createpath(head, uid, gid)
                 except FileExistsError:
                     pass
                 cdir = os.curdir
@@ -105,13 +162,30 @@ class ConfigFile:
         if createdirs:
             path = os.path.split(self.name)[0]
             if path:
-                createpath(path, self._uid, self._gid)
+                createpath(path, self.uid, self.gid)
                 #os.makedirs(path, exist_ok = True)
-        mode = "x" if not overwrite else "w+"
-        with open(self.name, mode) as file:
-            file.write(self.content)
-        os.chmod(self.name, self.permissions)
-        os.chown(self.name, self._uid, self._gid)
+        import hashlib
+        try:
+            with open(self.name, "rb") as file:
+                if not overwrite:
+                    raise FileExistsError("File '{}' exists".format(self.name))
+                current = hashlib.sha256(file.read()).hexdigest()
+        except FileNotFoundError:
+            current = None
+        changed = current != hashlib.sha256(
+            self.content.encode("utf-8")
+        ).hexdigest()
+        target = self.name + ".tmp" if changed else self.name
+        if changed:
+            with open(target, "w") as file:
+                file.write(self.content)
+                file.flush()
+                os.fsync(file.fileno())
+        os.chmod(target, self.permissions)
+        os.chown(target, self.uid, self.gid)
+        if changed:
+            os.replace(target, self.name)
+        return changed
     def replace(self, key: str, value: str):
         self.content = self.content.replace(key, value)
     @property
@@ -119,34 +193,30 @@ class ConfigFile:
         return self._owner
     @owner.setter
     def owner(self, name: str):
-        self._uid           = pwd.getpwnam(name).pw_uid
         self._owner         = name
     @property
     def group(self) -> str:
         return self._group
     @group.setter
     def group(self, name: str):
-        self._gid           = grp.getgrnam(name).gr_gid
         self._group         = name
     @property
     def uid(self) -> int:
-        return self._uid
+        return pwd.getpwnam(self._owner).pw_uid
     @uid.setter
     def uid(self, uid: int):
-        self._uid           = uid
         self._owner         = pwd.getpwuid(uid).pw_name
     @property
     def gid(self) -> int:
-        return self._gid
+        return grp.getgrnam(self._group).gr_gid
     @gid.setter
     def gid(self, gid: int):
-        self._gid           = gid
         self._group         = grp.getgrgid(gid).gr_name
     def __str__(self):
         return "{} {}({}).{}({}) {} '{}'". format(
             oct(self.permissions),
-            self._owner, self._uid,
-            self._group, self._gid,
+            self._owner, self.uid,
+            self._group, self.gid,
             self.name,
             (self.content[:20] + '..') if len(self.content) > 20 else self.content
         )
@@ -184,6 +254,14 @@ files['nginx.site'] = ConfigFile(
 ssl_certificate /etc/ssl/certs/vm.utu.fi.crt;
 ssl_certificate_key /etc/ssl/private/vm.utu.fi.key;
 
+# Tuning profile '{{profile}}' ({{cores}} cores, {{memory_mb}} MB), vminstall.py
+{{cache_http}}
+# NOTE: uwsgi protocol closes the connection after each request, so there is
+#       no upstream 'keepalive' (unix socket connects are cheap).
+upstream vm_utu_fi {
+    server unix:/run/uwsgi/app/vm.utu.fi/vm.utu.fi.socket;
+}
+
 server {
     listen       80;
     listen       [::]:80;
@@ -202,9 +280,40 @@ server {
     server_name vm.utu.fi;
     index index.html;
 
+    keepalive_timeout {{keepalive_timeout}};
+    keepalive_requests {{keepalive_requests}};
+
+    open_file_cache max={{open_file_cache}} inactive=60s;
+    open_file_cache_valid 60s;
+    open_file_cache_min_uses 2;
+    open_file_cache_errors on;
+
+    include uwsgi_params;
+    uwsgi_read_timeout {{harakiri}};
+    uwsgi_buffer_size {{buffer_size}};
+    uwsgi_buffers 8 {{buffer_size}};
+{{cache_server}}
+
     location / {
-        include uwsgi_params;
-        uwsgi_pass unix:/run/uwsgi/app/vm.utu.fi/vm.utu.fi.socket;
+        uwsgi_pass vm_utu_fi;
+    }
+    location @uwsgi {
+        uwsgi_pass vm_utu_fi;
+    }
+    # Static files directly from disk (Flask, if not found).
+    # '.gz' variants are created by vminstall.py (gzip_static).
+    location /static/ {
+        try_files $uri @uwsgi;
+        sendfile on;
+        tcp_nopush on;
+        gzip_static on;
+        expires 1h;
+        # Fingerprinted assets (name.0123abcd.css) never change
+        location ~* "\.[0-9a-f]{8,}\.(css|js|map|svg|png|jpe?g|gif|ico|woff2?|ttf)$" {
+            try_files $uri @uwsgi;
+            expires off;
+            add_header Cache-Control "public, max-age=31536000, immutable";
+        }
     }
     location /sqlite/ {
         #return 200 "location sqlite";
@@ -220,7 +329,8 @@ server {
     }
 }
 
-"""
+""",
+    services = ["nginx"]
 )
 
 files['uwsgi.ini'] = ConfigFile(
@@ -234,9 +344,23 @@ callable = app
 chdir = /var/www/vm.utu.fi/
 
 # Execution parameters
+# Tuning profile '{{profile}}' ({{cores}} cores, {{memory_mb}} MB), vminstall.py
 master = true
-processes = 1
-threads = 4
+processes = {{processes}}
+threads = {{threads}}
+# Socket backlog (may not exceed net.core.somaxconn)
+listen = {{listen}}
+# Request header buffer (bytes), request timeout (s), worker recycling
+buffer-size = {{buffer_size}}
+harakiri = {{harakiri}}
+max-requests = {{max_requests}}
+
+# Graceful reloads by vminstall.py: master FIFO ('c' chain reloads workers
+# one by one, 'r' reloads master and config), stats for worker readiness.
+# Chain reload requires each worker to load the application (lazy-apps).
+master-fifo = /run/uwsgi/app/vm.utu.fi/master.fifo
+stats = /run/uwsgi/app/vm.utu.fi/stats.socket
+lazy-apps = true
 
 # Logging (cmdline logging directive overrides this, unfortunately)
 logto=/var/log/uwsgi/uwsgi.log
@@ -258,6 +382,15 @@ vacuum = true
 # Setting this aligns the two system components, implementing
 # the expected behavior:
 die-on-term = true
+""",
+    services = ["uwsgi"]
+)
+
+files['sysctl.conf'] = ConfigFile(
+    '/etc/sysctl.d/60-vm.utu.fi.conf',
+    """
+# uWSGI 'listen' backlog (vminstall.py tuning profile '{{profile}}')
+net.core.somaxconn = {{listen}}
 """
 )
 
@@ -325,47 +458,722 @@ ALLOWED_EXTENSIONS      = ['ova', 'img', 'zip', 'jpg', 'png']  # Use lowercase!
 # EOF
 
 """,
-    'pi', 'www-data'
+    'pi', 'www-data',
+    services = ["uwsgi"]
 )
 
 
+#
+# Tuning profiles for nginx and uWSGI
+#
+#   'pi'    Raspberry Pi and other low memory (< 2 GB) machines. Few uWSGI
+#           processes, small buffers and connection counts, short keepalive.
+#   'vm'    Virtual machines and servers. Two uWSGI processes per core
+#           (requests mostly wait for SQLite and the network), larger
+#           backlog and buffers.
+#
+#   uWSGI processes are limited also by memory: at most 'memory_share' of
+#   RAM, 'worker_memory' bytes per process. nginx runs one worker per core.
+#
+profiles = {
+    "pi": {
+        "processes_per_core"    : 1,
+        "threads"               : 2,
+        "worker_memory"         : 48 * 1024**2,
+        "memory_share"          : 0.25,
+        "listen"                : 128,
+        "buffer_size"           : 8192,
+        "harakiri"              : 60,
+        "max_requests"          : 1000,
+        "worker_connections"    : 256,
+        "keepalive_timeout"     : 15,
+        "keepalive_requests"    : 100,
+        "open_file_cache"       : 1000
+    },
+    "vm": {
+        "processes_per_core"    : 2,
+        "threads"               : 4,
+        "worker_memory"         : 64 * 1024**2,
+        "memory_share"          : 0.5,
+        "listen"                : 1024,
+        "buffer_size"           : 32768,
+        "harakiri"              : 30,
+        "max_requests"          : 5000,
+        "worker_connections"    : 1024,
+        "keepalive_timeout"     : 65,
+        "keepalive_requests"    : 1000,
+        "open_file_cache"       : 10000
+    }
+}
+
+
 ###############################################################################
 # FUNCTIONS ETC
 
 class Identity():
     def __init__(self, user: str, group: str = None):
-        self.uid = pwd.getpwnam(user).pw_uid
-        if not group:
-            self.gid = pwd.getpwnam(user).pw_gid
-        else:
-            self.gid = grp.getgrnam(group).gr_gid
+        self.user  = user
+        self.group = group
     def __enter__(self):
+        # Commands are not executed on replay, no identity to assume
+        if shell.replaying:
+            return
+        self.uid = pwd.getpwnam(self.user).pw_uid
+        if not self.group:
+            self.gid = pwd.getpwnam(self.user).pw_gid
+        else:
+            self.gid = grp.getgrnam(self.group).gr_gid
         self.original_uid = os.getuid()
         self.original_gid = os.getgid()
         os.setegid(self.uid)
         os.seteuid(self.gid)
     def __exit__(self, type, value, traceback):
+        if shell.replaying:
+            return
         os.seteuid(self.original_uid)
         os.setegid(self.original_gid)
 
 
 
-def do_or_die(cmd: str, out = subprocess.DEVNULL):
-    """call do_or_die("ls", out = None), if you want output. Alternatively, subprocess.PIPE will also work."""
+# RingBuffer, pump_output() and Shell: copies of install.py (the reference,
+# see README.md "Record and Replay"). Shell.run() returns only the exit code.
+class RingBuffer:
+    """Keeps (at least) the last 'size' bytes written into it. Memory use is
+    bounded to 2 * size, regardless of how much is written."""
+    def __init__(self, size: int):
+        self.size   = size
+        self.total  = 0
+        self.buffer = bytearray()
+    def write(self, data: bytes):
+        self.total  += len(data)
+        self.buffer += data
+        if len(self.buffer) > 2 * self.size:
+            del self.buffer[:-self.size]
+    def tail(self) -> str:
+        """Last 'size' bytes as text. If older output has been discarded,
+        the partial first line is dropped."""
+        data = bytes(self.buffer[-self.size:])
+        if self.total > len(data):
+            data = data[data.find(b"\n") + 1:]
+        return data.decode("utf-8", errors = "replace")
+
+
+def pump_output(proc, ring: RingBuffer, tee = None, echo: bool = False):
+    """Reads merged stdout/stderr of 'proc' (Popen(stdout = PIPE)) into
+    'ring' and optionally into 'tee' (binary file) and to console, until EOF.
+    Non-blocking reads, so the child never stalls on a full pipe. The child
+    is not reaped (waitid(WNOWAIT)). If it has exited, but a daemonized
+    descendant still holds the pipe open, reading stops once it goes quiet."""
+    import selectors
+    fd = proc.stdout.fileno()
+    os.set_blocking(fd, False)
+    selector = selectors.DefaultSelector()
+    selector.register(fd, selectors.EVENT_READ)
+    exited = False
+    try:
+        while True:
+            if selector.select(timeout = 0.2 if exited else 0.5):
+                try:
+                    data = os.read(fd, 65536)
+                except BlockingIOError:
+                    continue
+                if not data:
+                    break
+                ring.write(data)
+                if tee:
+                    tee.write(data)
+                if echo:
+                    sys.stdout.buffer.write(data)
+                    sys.stdout.flush()
+            elif exited:
+                break
+            else:
+                exited = os.waitid(
+                    os.P_PID, proc.pid,
+                    os.WEXITED | os.WNOHANG | os.WNOWAIT
+                ) is not None
+    finally:
+        selector.close()
+        proc.stdout.close()
+
+
+class Shell:
+    """Command layer. Every command the installer runs (do_or_die()) and every in-process change to the system (call()) goes through here, so that a run can be recorded on a unit and replayed anywhere (without root, the Pi or the network).
+
+    live    Run commands (default). Nothing is recorded.
+    record  Run commands and record each command and call: start offset,
+            duration, thread, exit code or return value and output tail.
+            Written into 'filename' (JSON) by save().
+    replay  Nothing is run. Results come from a recording, and the recorded
+            duration is slept (multiplied by 'scale', 0 = no waiting).
+            Commands are matched by commandline (calls by name) in recorded
+            order, so that concurrent jobs may complete in any order.
+            Anything not found in the recording succeeds immediately and is
+            listed by summary()."""
+    def __init__(self, mode: str = "live", filename: str = None,
+                 scale: float = 1.0):
+        import collections
+        self.mode       = mode
+        self.filename   = filename
+        self.scale      = scale
+        self.config     = {}        # Recorded Config values
+        self.entries    = []        # Recorded (record mode)
+        self.recorded   = {}        # key : deque of entries (replay mode)
+        self.missing    = []        # Keys not found in recording
+        self._lock      = threading.Lock()
+        self._started   = time.monotonic()
+        if mode == "replay":
+            import json
+            with open(filename, "r") as file:
+                data = json.load(file)
+            self.config = data.get("config", {})
+            for entry in data["entries"]:
+                self.recorded.setdefault(
+                    entry["key"], collections.deque()
+                ).append(entry)
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+    def _replay(self, key: str) -> dict:
+        with self._lock:
+            queue = self.recorded.get(key)
+            entry = queue.popleft() if queue else None
+            if entry is None:
+                self.missing.append(key)
+        if entry is None:
+            log.warning("Replay: '{}' not in recording".format(key))
+            return {}
+        if self.scale:
+            time.sleep(entry["duration"] * self.scale)
+        return entry
+    def _record(self, key: str, start: float, **values):
+        if self.mode != "record":
+            return
+        entry = dict(
+            key         = key,
+            start       = round(start - self._started, 3),
+            duration    = round(time.monotonic() - start, 3),
+            thread      = threading.current_thread().name,
+            **values
+        )
+        with self._lock:
+            self.entries.append(entry)
+    def run(self, cmd: list, output: RingBuffer, tee = None,
+            echo: bool = False) -> int:
+        """Run command, capturing stdout and stderr into 'output' (and into
+        'tee', a binary file, and to console if 'echo'). Returns exit code."""
+        key = " ".join(cmd)
+        if self.replaying:
+            entry = self._replay(key)
+            data = entry.get("output", "").encode("utf-8")
+            output.write(data)
+            if tee:
+                tee.write(data)
+            if echo:
+                sys.stdout.buffer.write(data)
+                sys.stdout.flush()
+            return entry.get("returncode", 0)
+        start = time.monotonic()
+        proc = subprocess.Popen(
+            cmd,
+            stdout = subprocess.PIPE,
+            stderr = subprocess.STDOUT
+        )
+        pump_output(proc, output, tee, echo)
+        returncode = proc.wait()
+        self._record(
+            key, start, returncode = returncode, output = output.tail()
+        )
+        return returncode
+    def call(self, name: str, function, *args):
+        """Call 'function' (which changes or queries the system) and return
+        its value. Value must be JSON serializable, for the recording.
+        Exceptions are recorded and raised again (as ValueError) on replay."""
+        if self.replaying:
+            entry = self._replay(name)
+            if entry.get("error"):
+                raise ValueError(entry["error"])
+            return entry.get("value")
+        start = time.monotonic()
+        try:
+            value = function(*args)
+        except Exception as e:
+            self._record(name, start, error = str(e) or repr(e))
+            raise
+        self._record(name, start, value = value)
+        return value
+    def save(self):
+        """Write the recording (record mode only)."""
+        if self.mode != "record":
+            return
+        import json
+        with self._lock:
+            data = {
+                "script"    : os.path.basename(__file__),
+                "version"   : __version__,
+                "host"      : platform.node(),
+                "recorded"  : datetime.datetime.now().isoformat(),
+                "total"     : round(time.monotonic() - self._started, 3),
+                "config"    : self.config,
+                "entries"   : sorted(self.entries, key = lambda e: e["start"])
+            }
+        with open(self.filename + ".tmp", "w") as file:
+            json.dump(data, file, indent = 2)
+        os.replace(self.filename + ".tmp", self.filename)
+    def summary(self) -> str:
+        """Replay result: time and differences against the recording."""
+        lines = [
+            "Replayed in {:.1f}s (time scale {})".format(
+                time.monotonic() - self._started, self.scale
+            )
+        ]
+        unused = [k for k, queue in self.recorded.items() for _ in queue]
+        for title, keys in (("Not in recording", self.missing),
+                            ("Recorded, not replayed", unused)):
+            if keys:
+                lines.append("{} ({}):".format(title, len(keys)))
+                lines += ["    " + key for key in keys]
+        return "\n".join(lines)
+
+
+def do_or_die(cmd: str, echo: bool = False):
+    """Output (stdout and stderr) is captured, appended to Config.output_log and the last Config.output_tail bytes of it are included in the ValueError raised on non-zero exit code. Call do_or_die("ls", echo = True), if you want to see the output."""
     # Set empty double-quotes as empty list item
     # Required for commands like; ssh-keygen ... -N ""
     cmd = ['' if i == '""' or i == "''" else i for i in cmd.split(" ")]
-    prc = subprocess.run(
-        cmd,
-        stdout = out,
-        stderr = out
+    output = RingBuffer(Config.output_tail)
+    tee = Config.output_file
+    if tee:
+        tee.write("### {}\n".format(" ".join(cmd)).encode("utf-8"))
+    returncode = shell.run(cmd, output, tee, echo)
+    if tee:
+        tee.flush()
+    if returncode:
+        raise ValueError(
+            "code {}, command: {}\n{}".format(returncode, cmd, output.tail())
+        )
+
+
+class Background:
+    """CPU-bound commands (key generation) run in worker threads, while the
+    main sequence continues with I/O and network bound steps. Commands of a
+    job run sequentially, jobs concurrently. join() waits for all jobs and
+    raises the first failure.
+
+    Jobs must not rely on Identity(), because it changes the effective user
+    of the whole process (all threads)."""
+    def __init__(self):
+        self.threads    = {}    # name : Thread
+        self.errors     = {}    # name : Exception
+        self.times      = {}    # name : seconds
+    def start(self, name: str, *cmds):
+        def job():
+            start = time.monotonic()
+            try:
+                for cmd in cmds:
+                    do_or_die(cmd)
+            except Exception as e:
+                self.errors[name] = e
+            self.times[name] = time.monotonic() - start
+        thread = threading.Thread(target = job, name = name)
+        thread.daemon = True
+        thread.start()
+        self.threads[name] = thread
+    def join(self) -> float:
+        """Wait for all jobs. Returns the time spent waiting."""
+        start = time.monotonic()
+        for thread in self.threads.values():
+            thread.join()
+        waited = time.monotonic() - start
+        for name in self.threads:
+            log.debug("Background '{}' took {:.1f}s".format(
+                    name, self.times.get(name, 0)
+                )
+            )
+        for name, e in self.errors.items():
+            raise ValueError("Background job '{}' failed: {}".format(name, e))
+        return waited
+
+
+def write_file(path: str, content: str):
+    with open(path, "w") as file:
+        file.write(content)
+
+
+def tuning(profile: str = "auto", cores: int = None, memory: int = None) -> dict:
+    """Values for the nginx and uWSGI configuration templates, from 'profile'
+    ('auto' selects by memory) and the core count and memory (bytes) of this
+    machine, unless given."""
+    cores  = cores or os.cpu_count() or 1
+    memory = memory or os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    if profile == "auto":
+        profile = "pi" if memory < 2 * 1024**3 else "vm"
+    values = dict(profiles[profile])
+    with open("/proc/sys/net/core/somaxconn", "r") as file:
+        somaxconn = int(file.read())
+    values.update(
+        profile             = profile,
+        cores               = cores,
+        memory_mb           = memory // 1024**2,
+        somaxconn           = somaxconn,
+        processes           = max(
+            1,
+            min(
+                cores * values["processes_per_core"],
+                int(memory * values["memory_share"] // values["worker_memory"])
+            )
+        ),
+        worker_processes    = cores,
+        worker_rlimit_nofile = 2 * values["worker_connections"]
     )
-    if out == subprocess.PIPE:
-        print(prc.stdout.decode("utf-8"))
-        print(prc.stderr.decode("utf-8"))
-    if prc.returncode:
-        #print("Command '{}' failed!".format(cmd))
-        raise ValueError("code {}, command: {}".format(prc.returncode, cmd))
+    return values
+
+
+def cache_config(enabled: bool) -> dict:
+    """Nginx site template values for the uwsgi response cache (Config.cache*).
+    Empty, when not enabled. Routes are selected with a 'map', so that the
+    cache directives can stay at server level."""
+    import re
+    if not enabled:
+        return {"cache_http" : "", "cache_server" : ""}
+    routes = "\n".join(
+        "    ~^{} 0;".format(re.escape(route)) for route in Config.cache_routes
+    )
+    bypass = " ".join(["$vm_utu_fi_nocache"] + Config.cache_bypass)
+    http = """uwsgi_cache_path {dir} levels=1:2 keys_zone=vm_utu_fi:8m max_size={size}m inactive=10m use_temp_path=off;
+map $uri $vm_utu_fi_nocache {{
+    default 1;
+{routes}
+}}""".format(dir = Config.cache_dir, size = Config.cache_size, routes = routes)
+    server = """
+    # Response cache (anonymous requests only)
+    uwsgi_cache vm_utu_fi;
+    uwsgi_cache_key $scheme$host$request_uri;
+    uwsgi_cache_valid 200 301 302 {ttl}s;
+    uwsgi_cache_bypass {bypass};
+    uwsgi_no_cache {bypass};
+    uwsgi_cache_lock on;
+    uwsgi_cache_use_stale error timeout updating http_500 http_503;
+    uwsgi_cache_background_update on;
+    add_header X-Cache-Status $upstream_cache_status;""".format(
+        ttl = Config.cache_ttl, bypass = bypass
+    )
+    return {"cache_http" : http, "cache_server" : server}
+
+
+def configure_nginx(cfg: str, values: dict) -> bool:
+    """Set worker processes and connections (tuning()) in main nginx.conf.
+    Original is kept as '<cfg>.original'. Directives missing from it are
+    added (main context, 'events' block). File is replaced (atomically)
+    only if it changes. Returns True if it was written."""
+    import re
+    import shutil
+    r_processes     = re.compile('^\\s*worker_processes\\s')
+    r_rlimit        = re.compile('^\\s*worker_rlimit_nofile\\s')
+    r_connections   = re.compile('^\\s*worker_connections\\s')
+    r_events        = re.compile('^\\s*events\\s*{')
+    old             = cfg + ".original"
+    if not os.path.exists(old):
+        # Copy (not rename), so that nginx.conf exists at all times
+        shutil.copy2(cfg, old + ".tmp")
+        os.replace(old + ".tmp", old)
+    main = [
+        "worker_processes {};\n".format(values["worker_processes"]),
+        "worker_rlimit_nofile {};\n".format(values["worker_rlimit_nofile"])
+    ]
+    connections = "\tworker_connections {};\n".format(
+        values["worker_connections"]
+    )
+    lines = []
+    events = None
+    with open(old, "r") as src:
+        for line in src:
+            if r_processes.search(line):
+                lines += main
+                main = []
+            elif r_rlimit.search(line):
+                pass
+            elif r_connections.search(line):
+                lines.append(connections)
+                connections = None
+            else:
+                if events is None and r_events.search(line):
+                    events = len(lines) + 1
+                lines.append(line)
+    if connections and events is not None:
+        lines.insert(events, connections)
+    elif connections:
+        lines.append("events {{\n{}}}\n".format(connections))
+    content = "".join(main + lines)
+    try:
+        with open(cfg, "r") as file:
+            if file.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    with open(cfg + ".tmp", "w") as tgt:
+        tgt.write(content)
+    os.chmod(cfg + ".tmp", 0o644)
+    os.replace(cfg + ".tmp", cfg)
+    return True
+
+
+def precompress(directory: str, min_size: int = 1024) -> int:
+    """Create '<file>.gz' next to compressible static files (for nginx
+    'gzip_static'), with the original's timestamps and ownership. Files
+    whose '.gz' already has their modification time are skipped. Variants
+    that are not smaller are not kept. '.gz' is replaced atomically, so
+    nginx never serves a partial one. Returns number of files compressed."""
+    import gzip
+    import shutil
+    extensions = (".css", ".js", ".map", ".svg", ".html", ".json", ".txt", ".xml")
+    count = 0
+    for path, dirs, filenames in os.walk(directory):
+        for filename in filenames:
+            src = os.path.join(path, filename)
+            if not filename.lower().endswith(extensions):
+                continue
+            st = os.stat(src)
+            if st.st_size < min_size:
+                continue
+            try:
+                if os.stat(src + ".gz").st_mtime == st.st_mtime:
+                    continue
+            except FileNotFoundError:
+                pass
+            tmp = src + ".gz.tmp"
+            with open(src, "rb") as file, \
+                 gzip.open(tmp, "wb", compresslevel = 9) as gz:
+                shutil.copyfileobj(file, gz)
+            if os.path.getsize(tmp) >= st.st_size:
+                os.remove(tmp)
+                try:
+                    # Stale variant of an earlier version
+                    os.remove(src + ".gz")
+                except FileNotFoundError:
+                    pass
+                continue
+            os.utime(tmp, (st.st_atime, st.st_mtime))
+            os.chown(tmp, st.st_uid, st.st_gid)
+            os.replace(tmp, src + ".gz")
+            count += 1
+    return count
+
+
+def create_config(config: ConfigFile, reload: set) -> bool:
+    """Create or update 'config'. If it changed, its services are added into
+    'reload' and True is returned."""
+    if shell.call("create " + config.name, config.create, True):
+        log.info("'{}' written".format(config.name))
+        reload.update(config.services)
+        return True
+    log.info("'{}' unchanged".format(config.name))
+    return False
+
+
+def uwsgi_workers(stats: str) -> list:
+    """[(pid, status, apps), ...] of uWSGI workers, from the stats socket.
+    'apps' is the number of loaded applications (0 while a lazy-apps worker
+    is still loading). None if uWSGI (the application) is not running."""
+    import json
+    import socket
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(5)
+            sock.connect(stats)
+            data = b""
+            for chunk in iter(lambda: sock.recv(65536), b""):
+                data += chunk
+        return [
+            (w["pid"], w["status"], len(w["apps"]))
+            for w in json.loads(data.decode())["workers"]
+        ]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def uwsgi_command(fifo: str, command: str) -> bool:
+    """Write command into uWSGI master FIFO. False if there is no FIFO
+    (running instance was started without 'master-fifo')."""
+    import stat
+    try:
+        if not stat.S_ISFIFO(os.stat(fifo).st_mode):
+            return False
+        fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+    except OSError:
+        return False
+    try:
+        os.write(fd, command.encode())
+    finally:
+        os.close(fd)
+    return True
+
+
+def wait_uwsgi(stats: str, old: list, timeout: float) -> float:
+    """Wait until no worker pid in 'old' remains and all workers have loaded
+    the application. Returns seconds waited. Raises ValueError on timeout."""
+    old   = set(worker[0] for worker in old)
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        workers = uwsgi_workers(stats)
+        if workers and all(
+            pid not in old and status in ("idle", "busy") and apps
+            for pid, status, apps in workers
+        ):
+            return time.monotonic() - start
+        time.sleep(0.1)
+    raise ValueError("uWSGI workers not ready in {}s".format(timeout))
+
+
+def nginx_workers(pidfile: str) -> list:
+    """Worker process ids of running nginx master. None if not running."""
+    try:
+        with open(pidfile, "r") as file:
+            master = int(file.read())
+        os.kill(master, 0)
+    except (OSError, ValueError):
+        return None
+    workers = []
+    for pid in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            with open("/proc/{}/stat".format(pid), "r") as file:
+                # ppid follows the ')' that ends the command name
+                if int(file.read().rsplit(")", 1)[1].split()[1]) == master:
+                    workers.append(int(pid))
+        except (OSError, IndexError, ValueError):
+            pass
+    return workers
+
+
+def wait_exit(pids: list, timeout: float) -> float:
+    """Wait until processes 'pids' have exited (old nginx workers finishing
+    their requests). Returns seconds waited, or timeout if some remain."""
+    start = time.monotonic()
+    while pids and time.monotonic() - start < timeout:
+        pids = [
+            pid for pid in pids if os.path.exists("/proc/{}".format(pid))
+        ]
+        if pids:
+            time.sleep(0.1)
+    return time.monotonic() - start
+
+
+def existing_secret_key(filename: str) -> str:
+    """SECRET_KEY value of an existing Flask instance configuration, so that
+    re-runs keep sessions (and the file) unchanged. None if not found."""
+    try:
+        with open(filename, "r") as file:
+            for line in file:
+                key, sep, value = line.partition("=")
+                if sep and key.strip() == "SECRET_KEY":
+                    return value.strip()
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def files_exist(*paths) -> bool:
+    return all(os.path.exists(path) for path in paths)
+
+
+def remove_files(*paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def configure_phpliteadmin(cfg: str, password: str, directory: str):
+    """Set password, database directory and theme. The variables may or may
+    not be commented out, thus we match '//' before the variable name.
+    Original is kept as '<cfg>.original'."""
+    import re
+    r_pwd       = re.compile('^.*(\/\/)?.*\$password.*=')
+    r_dir       = re.compile('^.*(\/\/)?.*\$directory.*=')
+    r_theme     = re.compile('^.*(\/\/)?.*\$theme.*=')
+    old         = cfg + ".original"
+    try:
+        os.remove(old)
+    except FileNotFoundError:
+        pass
+    os.rename(cfg, old)
+    with    open(old, "r") as src, \
+            open(cfg, "w") as tgt:
+        for line in src:
+            if r_pwd.search(line):
+                tgt.write("$password = '{}';\n".format(password))
+            elif r_dir.search(line):
+                tgt.write("$directory = '{}';\n".format(directory))
+            elif r_theme.search(line):
+                tgt.write("$theme = 'phpliteadmin.css';\n")
+            else:
+                tgt.write(line)
+
+
+def check_indexes(cursor) -> list:
+    """Foreign keys without an index (beginning with the key column).
+    Returns a list of warnings."""
+    warnings = []
+    tables = [
+        row[0] for row in cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' "
+            "AND name NOT LIKE 'sqlite_%'"
+        ).fetchall()
+    ]
+    for table in tables:
+        indexed = set()
+        for index in cursor.execute(
+            "PRAGMA index_list('{}')".format(table)
+        ).fetchall():
+            columns = cursor.execute(
+                "PRAGMA index_info('{}')".format(index[1])
+            ).fetchall()
+            if columns:
+                indexed.add(columns[0][2])
+        for fk in cursor.execute(
+            "PRAGMA foreign_key_list('{}')".format(table)
+        ).fetchall():
+            if fk[3] not in indexed:
+                warnings.append(
+                    "Foreign key {}.{} has no index".format(table, fk[3])
+                )
+    return warnings
+
+
+def create_database(script_file: str, database_file: str) -> list:
+    """Execute SQL script into (new) SQLite3 database, with a performance
+    profile (Config.sqlite_*): page size and WAL journal (concurrent readers
+    while writing - uWSGI workers and phpLiteAdmin), 'synchronous = NORMAL'
+    and memory mapped I/O for the load, and ANALYZE statistics for the
+    query planner. Returns index warnings (check_indexes())."""
+    with    open(script_file, "r") as file, \
+            sqlite3.connect(database_file) as db:
+        script = file.read()
+        cursor = db.cursor()
+        try:
+            # Page size must be set before anything is written
+            cursor.execute(
+                "PRAGMA page_size = {}".format(Config.sqlite_page_size)
+            )
+            mode = cursor.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+            if mode.lower() != "wal":
+                raise ValueError("WAL journal not supported ('{}')".format(mode))
+            cursor.execute("PRAGMA synchronous = NORMAL")
+            cursor.execute(
+                "PRAGMA mmap_size = {}".format(Config.sqlite_mmap_size)
+            )
+            cursor.executescript(script)
+            db.commit()
+            cursor.execute("ANALYZE")
+            db.commit()
+            return check_indexes(cursor)
+        except Exception as e:
+            log.exception(str(e))
+            log.exception("SQL script failed!")
+            raise
+        finally:
+            cursor.close()
 
 
 def localize_timezone():
@@ -381,8 +1189,10 @@ def localize_keymap(model = "pc105", layout = "fi", variant = "", options = ""):
         "XKBMODEL=\"{}\"\nXKBLAYOUT=\"{}\"\n".format(model, layout) + \
         "XKBVARIANT=\"{}\"\nXKBOPTIONS=\"{}\"\n\n".format(variant, options) + \
         "BACKSPACE=\"guess\""
-    with open("/etc/default/keyboard", 'w') as kfile:
-        kfile.write(keyboard_config_file)
+    shell.call(
+        "write /etc/default/keyboard",
+        write_file, "/etc/default/keyboard", keyboard_config_file
+    )
     # Apply changes
     do_or_die('dpkg-reconfigure -f noninteractive keyboard-configuration')
     do_or_die('invoke-rc.d keyboard-setup start')
@@ -425,8 +1235,70 @@ if __name__ == '__main__':
         help = 'Check installation.',
         action = 'store_true'
     )
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        '--record',
+        help = 'Record commands, their results and timings into FILE.',
+        metavar = "FILE"
+    )
+    group.add_argument(
+        '--replay',
+        help = 'Replay a recorded run from FILE. Nothing is executed or\n' +
+               'changed on this system.',
+        metavar = "FILE"
+    )
+    parser.add_argument(
+        '--time-scale',
+        help = 'Replay: multiplier for recorded durations (0 = no waiting).\n' +
+               'Default: 1.0',
+        type = float,
+        default = 1.0,
+        metavar = "FACTOR"
+    )
+    parser.add_argument(
+        '--profile',
+        help = "nginx and uWSGI tuning profile: 'pi' (low memory), 'vm' or\n" +
+               "'auto' (by memory). Default: 'auto'",
+        choices = ["auto"] + list(profiles),
+        default = "auto"
+    )
+    parser.add_argument(
+        '--cache',
+        help = "Cache anonymous responses in Nginx (uwsgi_cache).",
+        action = 'store_true'
+    )
+    parser.add_argument(
+        '--cache-ttl',
+        help = "Response cache time in seconds. Default: {}".format(
+            Config.cache_ttl
+        ),
+        type = int,
+        default = Config.cache_ttl,
+        metavar = "SECONDS"
+    )
+    parser.add_argument(
+        '--cache-size',
+        help = "Response cache size in megabytes. Default: {}".format(
+            Config.cache_size
+        ),
+        type = int,
+        default = Config.cache_size,
+        metavar = "MB"
+    )
+    parser.add_argument(
+        '--fast-keys',
+        help = 'Generate Ed25519 SSH key and ECDSA (P-256) TLS certificate\n' +
+               'instead of 4096-bit RSA.',
+        action = 'store_true'
+    )
     args = parser.parse_args()
     Config.logging_level = getattr(logging, args.logging_level)
+    Config.cache      = args.cache
+    Config.cache_ttl  = args.cache_ttl
+    Config.cache_size = args.cache_size
+    if args.fast_keys:
+        Config.ssh_key = "-t ed25519"
+        Config.tls_key = "ec -pkeyopt ec_paramgen_curve:prime256v1"
 
 
     #
@@ -442,6 +1314,13 @@ if __name__ == '__main__':
     log.addHandler(logging.StreamHandler(sys.stdout))
     #logger.setLevel(logging.DEBUG)
     log.setLevel(getattr(logging, args.logging_level))
+    # Opened here, as root, because some commands run under Identity()
+    Config.output_file = open(Config.output_log, "ab")
+
+    if args.replay:
+        shell = Shell("replay", args.replay, args.time_scale)
+    else:
+        shell = Shell("record" if args.record else "live", args.record)
 
 
     log.info(
@@ -451,8 +1330,67 @@ if __name__ == '__main__':
         )
     )
 
+    #
+    # Size nginx and uWSGI for this machine
+    #
+    profile = shell.call("tuning " + args.profile, tuning, args.profile)
+    log.info(
+        "Tuning profile '{}' ({} cores, {} MB): uWSGI {} x {} threads, nginx {} x {} connections".format(
+            profile["profile"], profile["cores"], profile["memory_mb"],
+            profile["processes"], profile["threads"],
+            profile["worker_processes"], profile["worker_connections"]
+        )
+    )
+    for name in ("nginx.site", "uwsgi.ini", "sysctl.conf"):
+        for key, value in profile.items():
+            files[name].replace("{{" + key + "}}", str(value))
+    for key, value in cache_config(Config.cache).items():
+        files['nginx.site'].replace("{{" + key + "}}", value)
+
 
+    background = Background()
+    reload = set()      # Services whose configuration changed
     try:
+        #
+        # Generate SSH keys and self-signed SSL certificate for Nginx
+        # CPU bound, run in background while packages are installed.
+        # ssh-keygen runs as 'pi' through runuser, not Identity().
+        # NOTE: the -subj argument would need to be quoted (") as a shell
+        #       command, but when fed to subprocess, it cannot be, as it
+        #       would retain the quotation marks.
+        #
+        key = "/home/pi/.ssh/id_" + Config.ssh_key.split()[-1]
+        log.info("Generating SSH keys for user 'pi' (background)...")
+        shell.call(
+            "remove /home/pi/.ssh/id_*",
+            remove_files,
+            "/home/pi/.ssh/id_rsa", "/home/pi/.ssh/id_rsa.pub",
+            "/home/pi/.ssh/id_ed25519", "/home/pi/.ssh/id_ed25519.pub"
+        )
+        background.start(
+            "ssh-keygen",
+            'runuser -u pi -- ssh-keygen {} -f {} -q -N ""'.format(
+                Config.ssh_key, key
+            )
+        )
+        # writesd.py may have installed a pre-generated certificate
+        if shell.call(
+            "exists /etc/ssl/certs/vm.utu.fi.crt",
+            files_exist,
+            "/etc/ssl/private/vm.utu.fi.key", "/etc/ssl/certs/vm.utu.fi.crt"
+        ):
+            log.info("Using pre-generated SSL certificate for Nginx")
+        else:
+            log.info("Generating self-signed SSL certificate for Nginx (background)")
+            reload.add("nginx")
+            background.start(
+                "openssl",
+                "openssl req -new -newkey {} -days 365 -nodes -x509 -subj /C=FI/ST=./L=./O=./CN=vm.utu.fi -keyout /etc/ssl/private/vm.utu.fi.key -out /etc/ssl/certs/vm.utu.fi.crt".format(
+                    Config.tls_key
+                )
+            )
+
+
         #
         # BASIC
         #
@@ -476,69 +1414,20 @@ if __name__ == '__main__':
         log.info("Package installations complete!")
 
 
-        #
-        # Generate SSH keys
-        #
-        log.info("Generating SSH keys for user 'pi'...")
-        try:
-            os.remove("/home/pi/.ssh/id_rsa")
-        except FileNotFoundError:
-            pass
-        try:
-            os.remove("/home/pi/.ssh/id_rsa.pub")
-        except FileNotFoundError:
-            pass
-        with Identity("pi"):
-            do_or_die(
-                'ssh-keygen -b 4096 -t rsa -f /home/pi/.ssh/id_rsa -q -N ""'
-            ) # out = subprocess.PIPE
-        log.info("SSH keys generated!")
-
-
         #
         # Setup phpLiteAdmin (pla)
-        #       The variables may or may not be commented out,
-        #       thus we match '//' before the variable name.
         #
         pla_pwd     = "indiscretion"
         pla_dir     = "/var/www/vm.utu.fi"
-        import re
-        r_pwd       = re.compile('^.*(\/\/)?.*\$password.*=')
-        r_dir       = re.compile('^.*(\/\/)?.*\$directory.*=')
-        r_theme     = re.compile('^.*(\/\/)?.*\$theme.*=')
-        cfg         = "/etc/phpliteadmin.config.php"
-        old         = cfg + ".original"
-        try:
-            os.remove(old)
-        except FileNotFoundError:
-            pass
-        os.rename(cfg, old)
-        with    open(old, "r") as src, \
-                open(cfg, "w") as tgt:
-            for line in src:
-                if r_pwd.search(line):
-                    tgt.write("$password = '{}';\n".format(pla_pwd))
-                elif r_dir.search(line):
-                    tgt.write("$directory = '{}';\n".format(pla_dir))
-                elif r_theme.search(line):
-                    tgt.write("$theme = 'phpliteadmin.css';\n")
-                else:
-                    tgt.write(line)
+        shell.call(
+            "configure /etc/phpliteadmin.config.php",
+            configure_phpliteadmin,
+            "/etc/phpliteadmin.config.php", pla_pwd, pla_dir
+        )
         # Link a theme
         do_or_die("ln -s -f /usr/share/phpliteadmin/themes/Modern/phpliteadmin.css /usr/share/phpliteadmin/phpliteadmin.css")
 
 
-        #
-        # Create self-signed SSL certificate for Nginx
-        # NOTE: the -subj argument would need to be quoted (") as a shell
-        #       command, but when fed to subprocess, it cannot be, as it
-        #       would retain the quotation marks.
-        #
-        log.info("Generating self-signed SSL certificate for Nginx")
-        do_or_die("openssl req -new -newkey rsa:4096 -days 365 -nodes -x509 -subj /C=FI/ST=./L=./O=./CN=vm.utu.fi -keyout /etc/ssl/private/vm.utu.fi.key -out /etc/ssl/certs/vm.utu.fi.crt")
-
-
-
         #
         # Add user 'www-data' to group 'pi'
         #
@@ -551,82 +1440,206 @@ if __name__ == '__main__':
         # Ownership as pi.www-data to allow .sqlite3 db file access
         #
         log.info("Creating /var/www/vm.utu.fi")
-        do_or_die("mkdir /var/www/vm.utu.fi")
+        do_or_die("mkdir -p /var/www/vm.utu.fi")
         do_or_die("chown pi.www-data /var/www/vm.utu.fi")
         do_or_die("chmod 775 /var/www/vm.utu.fi")
 
 
+        #
+        # Nginx workers, uWSGI listen backlog (net.core.somaxconn)
+        #
+        log.info("Configuring Nginx workers")
+        if shell.call(
+            "configure /etc/nginx/nginx.conf",
+            configure_nginx, "/etc/nginx/nginx.conf", profile
+        ):
+            reload.add("nginx")
+        if profile["listen"] > profile["somaxconn"]:
+            log.info(
+                "Raising net.core.somaxconn to {}".format(profile["listen"])
+            )
+            if shell.call(
+                "create " + files['sysctl.conf'].name,
+                files['sysctl.conf'].create, True
+            ):
+                do_or_die("sysctl -p " + files['sysctl.conf'].name)
+
+
+        #
+        # Join point: Nginx site needs the certificate. Also, nothing runs
+        # in background when Identity() is assumed (git clone).
+        #
+        waited = background.join()
+        log.info(
+            "SSH key and SSL certificate generated (waited {:.1f}s)".format(
+                waited
+            )
+        )
+
+
         #
         # Create Virtual Host into Nginx
         #
         log.info("Creating virtual host into Nginx")
-        files['nginx.site'].create()
-        do_or_die("ln -s /etc/nginx/sites-available/vm.utu.fi /etc/nginx/sites-enabled/vm.utu.fi")
+        if Config.cache:
+            # Debian/Raspbian nginx packages do not create /var/cache/nginx
+            do_or_die(
+                "install -d -o www-data -g www-data -m 0700 " + Config.cache_dir
+            )
+        create_config(files['nginx.site'], reload)
+        do_or_die("ln -s -f /etc/nginx/sites-available/vm.utu.fi /etc/nginx/sites-enabled/vm.utu.fi")
 
 
         #
         # Configure uswgi
         #
         log.info("Creating uWSGI application config")
-        files['uwsgi.ini'].create()
-        do_or_die("ln -s /etc/uwsgi/apps-available/vm.utu.fi.ini /etc/uwsgi/apps-enabled/vm.utu.fi.ini")
+        uwsgi_ini_changed = create_config(files['uwsgi.ini'], reload)
+        do_or_die("ln -s -f /etc/uwsgi/apps-available/vm.utu.fi.ini /etc/uwsgi/apps-enabled/vm.utu.fi.ini")
 
 
         #
         # TODO: use git@github.com/jasata/utu-vm-site.git
         #       ..but that requires a key (or perhaps )
         #
-        log.info("Cloning vm.utu.fi from GitHub")
-        with Identity('pi'):
-            do_or_die("git clone https://github.com/jasata/utu-vm-site /var/www/vm.utu.fi")
-            # Fix remote url
-            do_or_die("git --git-dir=/var/www/vm.utu.fi/.git --work-tree=/var/www/vm.utu.fi/ remote set-url origin git@github.com:jasata/utu-vm-site.git")
+        if shell.call(
+            "exists /var/www/vm.utu.fi/.git",
+            files_exist, "/var/www/vm.utu.fi/.git"
+        ):
+            log.info("vm.utu.fi already cloned")
+        else:
+            log.info("Cloning vm.utu.fi from GitHub")
+            reload.add("uwsgi")
+            with Identity('pi'):
+                do_or_die("git clone https://github.com/jasata/utu-vm-site /var/www/vm.utu.fi")
+                # Fix remote url
+                do_or_die("git --git-dir=/var/www/vm.utu.fi/.git --work-tree=/var/www/vm.utu.fi/ remote set-url origin git@github.com:jasata/utu-vm-site.git")
+
+
+        #
+        # Precompressed static files for Nginx (gzip_static)
+        #
+        log.info("Precompressing static files")
+        count = shell.call(
+            "precompress /var/www/vm.utu.fi/static",
+            precompress, "/var/www/vm.utu.fi/static"
+        )
+        log.info("{} static files precompressed".format(count))
 
 
         #
         # Create instance/application.conf
         #
         log.info("Creating configuration file for Flask application instance")
-        files['flask.conf'].replace('{{secret_key}}', str(os.urandom(24)))
-        files['flask.conf'].create()
+        secret_key = shell.call(
+            "read SECRET_KEY",
+            existing_secret_key, files['flask.conf'].name
+        )
+        files['flask.conf'].replace(
+            '{{secret_key}}', secret_key or str(os.urandom(24))
+        )
+        create_config(files['flask.conf'], reload)
 
 
         #
         # Create application.sqlite3
         #
-        log.info("Creating application database")
         script_file     = '/var/www/vm.utu.fi/create.sql'
         database_file   = '/var/www/vm.utu.fi/application.sqlite3'
-        with    open(script_file, "r") as file, \
-                sqlite3.connect(database_file) as db:
-            script = file.read()
-            cursor = db.cursor()
-            try:
-                cursor.executescript(script)
-                db.commit()
-            except Exception as e:
-                log.exception(str(e))
-                log.exception("SQL script failed!")
-                raise
-            finally:
-                cursor.close()
-        do_or_die("chown pi.www-data " + database_file)
-        do_or_die("chmod 664 " + database_file)
+        if shell.call("exists " + database_file, files_exist, database_file):
+            log.info("Application database exists, not created")
+        else:
+            log.info("Creating application database")
+            warnings = shell.call(
+                "create " + database_file,
+                create_database, script_file, database_file
+            )
+            for warning in warnings or []:
+                log.warning("application.sqlite3: " + warning)
+            do_or_die("chown pi.www-data " + database_file)
+            do_or_die("chmod 664 " + database_file)
 
 
         #
-        # Only now can the nginx and uwsgi services be restarted
+        # Only now can the nginx and uwsgi services be reloaded,
+        # and only those whose configuration changed
         #
-        log.info("Restarting uwsgi and nginx")
-        do_or_die("systemctl restart uwsgi")
-        do_or_die("systemctl restart nginx")
+        # uWSGI: chain reload (worker by worker) for application changes,
+        # graceful master reload for uwsgi.ini changes. Listening socket
+        # stays open meanwhile, so requests wait instead of getting 502.
+        #
+        if "uwsgi" in reload:
+            workers = shell.call(
+                "uwsgi workers", uwsgi_workers, Config.uwsgi_stats
+            )
+            command = "r" if uwsgi_ini_changed else "c"
+            start = time.monotonic()
+            if not workers:
+                log.info("Starting uwsgi")
+                do_or_die("systemctl restart uwsgi")
+            elif shell.call(
+                "uwsgi " + command,
+                uwsgi_command, Config.uwsgi_fifo, command
+            ):
+                shell.call(
+                    "uwsgi ready",
+                    wait_uwsgi, Config.uwsgi_stats, workers,
+                    Config.reload_timeout
+                )
+                log.info(
+                    "uWSGI {} reload of {} workers took {:.1f}s".format(
+                        "graceful" if command == "r" else "chain",
+                        len(workers),
+                        time.monotonic() - start
+                    )
+                )
+            else:
+                log.info("No uWSGI master FIFO, reloading through systemd")
+                do_or_die("systemctl reload uwsgi")
+        else:
+            log.info("uwsgi configuration unchanged, not reloaded")
+        #
+        # nginx: configuration test, then reload (new workers start, old
+        # ones finish their requests)
+        #
+        if "nginx" in reload:
+            do_or_die("nginx -t")
+            workers = shell.call(
+                "nginx workers", nginx_workers, Config.nginx_pidfile
+            )
+            start = time.monotonic()
+            if workers is None:
+                log.info("Starting nginx")
+                do_or_die("systemctl restart nginx")
+            else:
+                do_or_die("systemctl reload nginx")
+                shell.call(
+                    "nginx old workers exited",
+                    wait_exit, workers, Config.reload_timeout
+                )
+                log.info(
+                    "nginx reload took {:.1f}s ({} old workers)".format(
+                        time.monotonic() - start, len(workers)
+                    )
+                )
+        else:
+            log.info("nginx configuration unchanged, not reloaded")
 
 
     except Exception as e:
         log.exception(e)
         log.error("Install script FAILED!!")
+        shell.save()
+        if shell.replaying:
+            print(shell.summary())
         os._exit(1)
 
+    shell.save()
+    if shell.replaying:
+        print(shell.summary())
+    elif args.record:
+        print("Recording written to '{}'".format(args.record))
+
 
     print("vm.utu.fi development instance creation completed")
     print("NOTE: Remember to create hosts -file entry for vm.utu.fi!")
@@ -34,6 +34,25 @@
 #                       installation scripts to /boot ("Installer" in
 #                       the writesd.config file).
 #   0.6.1   2019-12-20  Run-once implementation. Better install script handling
+#   0.7.0   2026-10-19  Command output captured into a bounded buffer,
+#                       shown only on failure.
+#   0.8.0   2026-10-19  APT caching proxy (--serve-proxy) and its
+#                       configuration into the image ([Proxy], --proxy).
+#   0.9.0   2026-10-19  Git mirror of installer repositories (--serve-git),
+#                       its URL into install.config ([Mirror]).
+#   0.10.0  2026-10-19  Run-once as systemd service (does not block boot,
+#                       retries on failure) instead of init.d script.
+#   0.11.0  2026-10-19  Native image writer (--writer native), --verify.
+#   0.12.0  2026-10-19  Capture installed card into the image store
+#                       (--capture), writing compressed images.
+#   0.13.0  2026-10-19  Image shrinking (--shrink, --optimise), root
+#                       partition expansion after writing.
+#   0.14.0  2026-10-19  Discard (TRIM) before writing (--discard), sparse
+#                       writing onto discarded cards.
+#   0.15.0  2026-10-19  Write block size probed and cached per card model.
+#   0.16.0  2026-10-19  Card registry (SQLite) of writes, --registry reports.
+#   0.17.0  2026-10-19  Pre-generated SSH host keys and TLS certificate from
+#                       a pool on the station (--fill-keys, --nohostkeys).
 #
 #
 #   Commandline options:
@@ -42,6 +61,25 @@
 #       --device        Block device (disk) to write into
 #       --noddns        Do not create DDNS client
 #       --ddns          Create DDNS client
+#       --proxy URL     APT caching proxy for the instance
+#       --noproxy       Do not configure APT proxy
+#       --serve-proxy   Run APT caching proxy (on the station)
+#       --serve-git     Run git mirror of installer repositories (station)
+#       --writer W      Image writer, 'dd' (default) or 'native'
+#       --verify        Read back and compare the written image
+#       --discard [M]   Discard (TRIM) card before writing ('all', 'unwritten')
+#       --probe         Probe card model's fastest write block size
+#       --noprobe       Do not probe unseen card models
+#       --registry R    Card registry report ('models', 'degraded', 'card')
+#       --card CID      Card for '--registry card' (default: --device card)
+#       --capture NAME  Read card back into the image store (images/)
+#       --shrink        With --capture, shrink root filesystem and image
+#       --optimise IMG  Shrink root filesystem of an image file
+#       --expand        Grow root partition to fill the card (default for
+#                       shrunk store images)
+#       --noexpand      Do not grow root partition, not even for shrunk images
+#       --nohostkeys    Do not install pre-generated SSH host keys
+#       --fill-keys     Generate SSH host key sets into the pool
 #
 #
 #   For home.net development:
@@ -88,7 +126,7 @@ if sys.version_info < (3, 5):
 
 
 # PEP 396 -- Module Version Numbers https://www.python.org/dev/peps/pep-0396/
-__version__ = "0.6.0"
+__version__ = "0.17.0"
 __author__  = "Jani Tammi <jasata@utu.fi>"
 VERSION = __version__
 HEADER  = """
@@ -124,13 +162,60 @@ class App:
         name        = None
         email       = None
         editor      = None
+    class Proxy:
+        url         = None          # http://station:port written into image
+        port        = 3142          # --serve-proxy listening port
+        bind        = None          # LAN address (default: host of 'url')
+        hosts       = [             # Upstream mirrors the proxy serves
+            "raspbian.raspberrypi.org",
+            "archive.raspberrypi.org",
+            "deb.debian.org",
+            "security.debian.org"
+        ]
+        cache       = "/var/cache/writesd/apt"
+        maxsize     = 4 * 1024**3   # Bytes
+        detect      = None          # Proxy-Auto-Detect script File object
+        aptconf     = None          # /etc/apt/apt.conf.d/ File object
+    class Mirror:
+        url         = None          # git://station/ written to install.config
+        port        = 9418          # --serve-git listening port
+        directory   = "/var/cache/writesd/git"
+        interval    = 300           # Seconds between upstream fetches
+        repositories = []           # In addition to installer's repositories
     class Installer:
         copy: list  = ["install.py"]
-        run         = None          # Script to run by /etc/init.d/run-once
-        initdscript = None          # /etc/init.d/run-once script File object
+        run         = None          # Script to run by run-once.service
+        service     = None          # run-once.service unit File object
+    class Store:
+        directory   = "images"      # Relative to script directory
+        compression = "xz"          # For --capture: "xz", "gz" or "none"
+        headroom    = 256 * 1024**2 # Free space left in shrunk root fs
+    class Tuning:
+        cache       = "/var/cache/writesd/cards.json"
+        probe       = "auto"        # "auto" (unseen models), "always", "never"
+        sizes       = [2**n * 1024**2 // 4 for n in range(0, 7)] # 256k..16M
+        offset      = 64 * 1024**2  # Probed area (overwritten by the image)
+        length      = 32 * 1024**2  # Bytes written per chunk size
+    class Registry:
+        database    = "/var/lib/writesd/registry.sqlite3"
+        degraded    = 0.7           # Throughput ratio to best write
+    class Keys:
+        selected    = True          # --nohostkeys disables
+        pool        = "/var/cache/writesd/keys"
+        size        = 4             # Ready-made sets kept in the pool
+        types       = ["rsa", "ecdsa", "ed25519"]
+        tls_cn      = "vm.utu.fi"   # TLS certificate CN (None = no TLS)
+        tls_key     = "rsa:4096"    # openssl req -newkey argument
+        stale       = 3600          # Seconds, then unfinished (.new-*) and
+                                    # unreleased (.taken-*) sets are removed
     image           = None          # Rasbian image filename
+    blocksize       = 4 * 1024**2   # Write size (dd bs=), tuned per model
     blkdev          = None          # Device file to write into
+    writer          = "dd"          # "dd" or "native" (write_image())
+    verify          = False         # Read back and compare after writing
+    discard         = None          # None, "all" or "unwritten" (--discard)
     summary         = ""            # Report of actions
+    output_tail     = 16 * 1024     # Bytes of command output kept for errors
     @staticmethod
     def report(msg: str):
         App.summary += "  - " + msg + "\n"
@@ -205,6 +290,118 @@ class App:
             print("read-config():", e)
             os._exit(-1)
         #
+        # Section "Proxy"
+        #
+        try:
+            if cfg.has_section("Proxy"):
+                section = cfg["Proxy"]
+                App.Proxy.url       = section.get("url") or None
+                App.Proxy.port      = section.getint("port", App.Proxy.port)
+                App.Proxy.bind      = section.get("bind") or None
+                if section.get("hosts"):
+                    App.Proxy.hosts = [
+                        h.strip() for h in section["hosts"].split(",")
+                        if h.strip()
+                    ]
+                App.Proxy.cache     = section.get("cache", App.Proxy.cache)
+                App.Proxy.maxsize   = int(
+                    section.getfloat("size", App.Proxy.maxsize / 1024**3) * \
+                    1024**3
+                )
+        except Exception as e:
+            print("read-config():", e)
+            os._exit(-1)
+        #
+        # Section "Mirror"
+        #
+        try:
+            if cfg.has_section("Mirror"):
+                section = cfg["Mirror"]
+                App.Mirror.url       = section.get("url") or None
+                App.Mirror.port      = section.getint("port", App.Mirror.port)
+                App.Mirror.directory = section.get(
+                    "directory", App.Mirror.directory
+                )
+                App.Mirror.interval  = section.getint(
+                    "interval", App.Mirror.interval
+                )
+                App.Mirror.repositories = [
+                    x.strip()
+                    for x in section.get("repositories", "").split(",")
+                    if x.strip()
+                ]
+        except Exception as e:
+            print("read-config():", e)
+            os._exit(-1)
+        #
+        # Section "Store"
+        #
+        try:
+            if cfg.has_section("Store"):
+                section = cfg["Store"]
+                App.Store.directory   = section.get(
+                    "directory", App.Store.directory
+                )
+                App.Store.compression = section.get(
+                    "compression", App.Store.compression
+                )
+                App.Store.headroom    = section.getint(
+                    "headroom", App.Store.headroom // 1024**2
+                ) * 1024**2
+        except Exception as e:
+            print("read-config():", e)
+            os._exit(-1)
+        #
+        # Section "Tuning"
+        #
+        try:
+            if cfg.has_section("Tuning"):
+                section = cfg["Tuning"]
+                App.Tuning.cache  = section.get("cache", App.Tuning.cache)
+                App.Tuning.probe  = section.get("probe", App.Tuning.probe)
+                App.Tuning.length = section.getint(
+                    "length", App.Tuning.length // 1024**2
+                ) * 1024**2
+        except Exception as e:
+            print("read-config():", e)
+            os._exit(-1)
+        #
+        # Section "Registry"
+        #
+        try:
+            if cfg.has_section("Registry"):
+                section = cfg["Registry"]
+                App.Registry.database = section.get(
+                    "database", App.Registry.database
+                )
+                App.Registry.degraded = section.getint(
+                    "degraded", int(App.Registry.degraded * 100)
+                ) / 100
+        except Exception as e:
+            print("read-config():", e)
+            os._exit(-1)
+        #
+        # Section "Keys"
+        #
+        try:
+            if cfg.has_section("Keys"):
+                section = cfg["Keys"]
+                App.Keys.pool   = section.get("pool", App.Keys.pool)
+                App.Keys.size   = section.getint("size", App.Keys.size)
+                App.Keys.types  = [
+                    t.strip()
+                    for t in section.get(
+                        "types", ", ".join(App.Keys.types)
+                    ).split(",") if t.strip()
+                ]
+                App.Keys.tls_cn = section.get(
+                    "tls", App.Keys.tls_cn
+                ).strip() or None
+                App.Keys.tls_key = section.get("tls key", App.Keys.tls_key)
+        except Exception as e:
+            print("read-config():", e)
+            os._exit(-1)
+        #
         # Section "Git"
         #
         try:
@@ -358,36 +555,65 @@ WantedBy=multi-user.target
 """
 )
 
-App.Installer.initdscript = File(
-    "/etc/init.d/run-once",
-    0o774,
-    """#! /bin/sh
-
-### BEGIN INIT INFO
-# Provides:             run-once
-# Required-Start:       $remote_fs $syslog
-# Required-Stop:        $remote_fs $syslog
-# Default-Start:        2 3 4 5
-# Default-Stop:
-# Short-Description:    Execute installer script once
-### END INIT INFO
-
-ETCFILE="/etc/run-once.executed"
-INSTALLER="{{installer}}"
-
-set -e
+App.Proxy.detect = File(
+    "/usr/local/bin/apt-proxy-detect",
+    0o755,
+    """#!/bin/bash
+# Used by APT (Acquire::http::Proxy-Auto-Detect) to select the proxy for
+# the URL given as $1. Prints DIRECT for hosts that the flashing station's
+# proxy does not serve, or if the proxy is not reachable.
+host="${1#*://}"
+host="${host%%/*}"
+host="${host%%:*}"
+case "$host" in
+    {{mirrors}})
+        if timeout 2 bash -c "</dev/tcp/{{host}}/{{port}}" 2>/dev/null; then
+            echo "http://{{host}}:{{port}}"
+            exit 0
+        fi
+        ;;
+esac
+echo "DIRECT"
+"""
+)
 
-# If /etc/ file exists, this has already been executed
-test -e $ETCFILE && exit 0
+App.Proxy.aptconf = File(
+    "/etc/apt/apt.conf.d/01proxy",
+    0o644,
+    """// Created by writesd.py - caching proxy on the flashing station
+Acquire::http::Proxy-Auto-Detect "/usr/local/bin/apt-proxy-detect";
+"""
+)
 
-umask 022
+App.Installer.service = File(
+    "/lib/systemd/system/run-once.service",
+    0o644,
+    """[Unit]
+Description=Run installer script once ({{installer}})
+# Boot does not wait for this - login and SSH are available meanwhile
+After=network-online.target
+Wants=network-online.target
+ConditionPathExists=!/etc/run-once.executed
+ConditionPathExists={{installer}}
+# Retry failed installs, at most 5 times in 6 hours
+StartLimitIntervalSec=6h
+StartLimitBurst=5
 
-if test -f $INSTALLER; then
-    date --iso-8601=seconds > $ETCFILE
-    python3 $INSTALLER
-fi
+[Service]
+Type=simple
+# Installer reports its progress with sd_notify(STATUS=...)
+# (see 'systemctl status run-once')
+NotifyAccess=main
+WorkingDirectory=/root
+UMask=0022
+ExecStart=/usr/bin/python3 {{installer}}
+Restart=on-failure
+RestartSec=2min
+# Only a successful run is marked as executed
+ExecStopPost=/bin/sh -c 'if [ "$SERVICE_RESULT" = "success" ]; then date --iso-8601=seconds > /etc/run-once.executed; fi'
 
-exit 0
+[Install]
+WantedBy=multi-user.target
 """
 )
 
@@ -456,6 +682,29 @@ def setup_ddns(path: str, usr: str, pwd: str):
 
 
 
+def setup_apt_proxy(url: str):
+    """Configure APT in the image (mounted to /mnt) to use caching proxy."""
+    import urllib.parse
+    location = urllib.parse.urlsplit(url)
+    file = App.Proxy.detect
+    content = file.content.replace("{{host}}", location.hostname)
+    content = content.replace("{{port}}", str(location.port or 80))
+    content = content.replace("{{mirrors}}", "|".join(App.Proxy.hosts))
+    with open("/mnt" + file.name, "w") as handle:
+        handle.write(content)
+    os.chmod("/mnt" + file.name, file.permissions)
+    file = App.Proxy.aptconf
+    with open("/mnt" + file.name, "w") as handle:
+        handle.write(file.content)
+    os.chmod("/mnt" + file.name, file.permissions)
+    App.report(
+        "APT proxy '{}' for {} (when reachable)".format(
+            url, ", ".join(App.Proxy.hosts)
+        )
+    )
+
+
+
 def smb_setup(path: str):
     """Obsoleted by VSC Remote SSH. Left in case this becomes necessary again."""
     smb_conf = r"""[global]
@@ -501,6 +750,465 @@ def smb_setup(path: str):
 
 
 
+##############################################################################
+#
+# APT caching proxy (./writesd.py --serve-proxy)
+#
+#   Station runs this proxy and the written images are configured to use it
+#   (Proxy-Auto-Detect, falls back to DIRECT if the station is unreachable).
+#   Package files (.deb etc.) never change once published, so they are
+#   cached on disk and served to the 2nd..Nth unit from there. Index files
+#   (Release, Packages, ...) change and are always passed through.
+#
+#   Concurrent requests for a file that is still being downloaded do not
+#   start another download - they are streamed from the partial file while
+#   the one download progresses. Cache size is kept under the configured
+#   limit by evicting least recently used files (mtime is updated on hit).
+#
+class PackageCache:
+    cacheable   = (
+        ".deb", ".udeb", ".dsc", ".tar.gz", ".tar.xz", ".tar.bz2", ".diff.gz"
+    )
+    chunk       = 64 * 1024
+    timeout     = 30
+    def __init__(self, directory: str, maxsize: int):
+        import threading
+        import urllib.request
+        self.directory  = directory
+        self.maxsize    = maxsize
+        self.lock       = threading.Lock()
+        self.inflight   = {}            # url : Download
+        self.hits       = 0
+        self.misses     = 0
+        self.passes     = 0
+        # Never use environment proxy settings - that could loop back here
+        self.opener     = urllib.request.build_opener(
+            urllib.request.ProxyHandler({})
+        )
+        os.makedirs(directory, exist_ok = True)
+        self.size = sum(size for _, size, _ in self._files())
+    def is_allowed(self, url: str, hosts: list) -> bool:
+        """Only repository files ('dists/' and 'pool/' trees) from the given
+        mirror hosts (port 80). Anything else would make the station an open
+        proxy into its LAN."""
+        import re
+        import urllib.parse
+        try:
+            parts = urllib.parse.urlsplit(url)
+            port = parts.port
+        except ValueError:
+            return False
+        return parts.scheme == "http" and \
+               parts.hostname in hosts and \
+               port in (None, 80) and \
+               not parts.username and \
+               ".." not in parts.path.split("/") and \
+               re.match(r"^(/[\w.+~-]+)*/(dists|pool)/", parts.path) is not None
+    def is_cacheable(self, url: str) -> bool:
+        import urllib.parse
+        path = urllib.parse.urlsplit(url).path
+        return path.endswith(PackageCache.cacheable) or "/by-hash/" in path
+    def path(self, url: str) -> str:
+        import hashlib
+        digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+    def _files(self) -> list:
+        """(mtime, size, path) of all cached files."""
+        files = []
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith(".part"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stats = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stats.st_mtime, stats.st_size, path))
+        return files
+    def evict(self):
+        """Remove least recently used files until 90% of maxsize is reached."""
+        with self.lock:
+            if self.size <= self.maxsize:
+                return
+            for _, size, path in sorted(self._files()):
+                if self.size <= self.maxsize * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                    self.size -= size
+                except FileNotFoundError:
+                    pass
+    def open(self, url: str, headers: dict = None):
+        """Upstream request (no caching). Returns response or HTTPError."""
+        import urllib.request
+        import urllib.error
+        request = urllib.request.Request(url, headers = headers or {})
+        try:
+            return self.opener.open(request, timeout = PackageCache.timeout)
+        except urllib.error.HTTPError as e:
+            return e
+    def download(self, url: str):
+        """Returns in-flight Download for the URL, starting one if needed."""
+        with self.lock:
+            download = self.inflight.get(url)
+            if download is None:
+                self.misses += 1
+                download = PackageCache.Download(self, url)
+                self.inflight[url] = download
+                download.start()
+            return download
+
+    class Download:
+        """One upstream download into '<path>.part', renamed when complete.
+        Readers follow the partial file through the 'changed' condition."""
+        def __init__(self, cache, url: str):
+            import threading
+            self.cache      = cache
+            self.url        = url
+            self.path       = cache.path(url)
+            self.status     = None      # Upstream HTTP status
+            self.headers    = {}
+            self.written    = 0
+            self.done       = False
+            self.error      = None
+            self.changed    = threading.Condition()
+        def start(self):
+            import threading
+            thread = threading.Thread(target = self._run)
+            thread.daemon = True
+            thread.start()
+        def _notify(self, **values):
+            with self.changed:
+                for key, value in values.items():
+                    setattr(self, key, value)
+                self.changed.notify_all()
+        def _run(self):
+            part = self.path + ".part"
+            try:
+                os.makedirs(os.path.dirname(part), exist_ok = True)
+                response = self.cache.open(self.url)
+                with response, open(part, "wb") as file:
+                    headers = {
+                        key : response.headers[key]
+                        for key in ("Content-Length", "Content-Type", "Last-Modified")
+                        if response.headers.get(key)
+                    }
+                    status = response.getcode()
+                    self._notify(status = status, headers = headers)
+                    while status == 200:
+                        data = response.read(PackageCache.chunk)
+                        if not data:
+                            break
+                        file.write(data)
+                        file.flush()
+                        self._notify(written = self.written + len(data))
+                if status == 200:
+                    os.rename(part, self.path)
+                    with self.cache.lock:
+                        self.cache.size += self.written
+                else:
+                    os.remove(part)
+            except Exception as e:
+                try:
+                    os.remove(part)
+                except OSError:
+                    pass
+                self._notify(error = e)
+            finally:
+                with self.cache.lock:
+                    del self.cache.inflight[self.url]
+                self._notify(done = True)
+                self.cache.evict()
+        def wait_headers(self):
+            with self.changed:
+                self.changed.wait_for(
+                    lambda: self.status is not None or self.done
+                )
+        def stream(self, out):
+            """Copy the download into 'out', as it progresses."""
+            try:
+                file = open(self.path + ".part", "rb")
+            except FileNotFoundError:
+                # Completed (and renamed) in the meantime
+                file = open(self.path, "rb")
+            with file:
+                sent = 0
+                while True:
+                    with self.changed:
+                        self.changed.wait_for(
+                            lambda: self.written > sent or self.done
+                        )
+                        available, done = self.written, self.done
+                    if self.error:
+                        raise self.error
+                    while sent < available:
+                        data = file.read(min(available - sent, PackageCache.chunk))
+                        out.write(data)
+                        sent += len(data)
+                    if done and sent >= self.written:
+                        return
+
+
+def serve_proxy(address: str, port: int, directory: str, maxsize: int,
+                hosts: list):
+    """Run the caching proxy on 'address' (station's LAN address) until
+    interrupted (CTRL-C). Only requests to 'hosts' are served."""
+    import shutil
+    import socketserver
+    import http.server
+    cache = PackageCache(directory, maxsize)
+    class ProxyHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        def log_message(self, format, *args):
+            pass
+        def report(self, what: str):
+            print("{:<5} {}".format(what, self.path), flush = True)
+        def send(self, status: int, headers: dict):
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            if "Content-Length" not in headers:
+                self.send_header("Connection", "close")
+                self.close_connection = True
+            self.end_headers()
+        def do_GET(self):
+            url = self.path
+            if not url.startswith("http://"):
+                self.send_error(400, "Proxy requests only (absolute URI)")
+                return
+            if not cache.is_allowed(url, hosts):
+                self.report("DENY")
+                self.send_error(403, "Not a configured repository mirror")
+                return
+            try:
+                if not cache.is_cacheable(url):
+                    self.passthrough(url)
+                elif os.path.exists(cache.path(url)):
+                    self.hit(url)
+                else:
+                    self.miss(url)
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+            except Exception as e:
+                self.report("ERROR")
+                print("      ", e)
+                self.close_connection = True
+        def hit(self, url: str):
+            path = cache.path(url)
+            try:
+                os.utime(path)          # Most recently used
+                file = open(path, "rb")
+            except FileNotFoundError:
+                # Evicted since os.path.exists()
+                self.miss(url)
+                return
+            cache.hits += 1
+            self.report("HIT")
+            with file:
+                self.send(200, {
+                    "Content-Length" : str(os.fstat(file.fileno()).st_size)
+                })
+                shutil.copyfileobj(file, self.wfile, PackageCache.chunk)
+        def miss(self, url: str):
+            download = cache.download(url)
+            download.wait_headers()
+            if download.status is None:
+                self.send_error(502, str(download.error))
+                return
+            self.report("MISS" if download.status == 200 else str(download.status))
+            if download.status != 200:
+                self.send(download.status, {"Content-Length" : "0"})
+                return
+            self.send(200, download.headers)
+            download.stream(self.wfile)
+        def passthrough(self, url: str):
+            cache.passes += 1
+            headers = {
+                key : self.headers[key]
+                for key in ("If-Modified-Since", "If-None-Match", "Range")
+                if self.headers.get(key)
+            }
+            with cache.open(url, headers) as response:
+                status = response.getcode()
+                self.report("PASS" if status == 200 else str(status))
+                self.send(status, {
+                    key : response.headers[key]
+                    for key in (
+                        "Content-Length", "Content-Type", "Last-Modified",
+                        "ETag", "Content-Range"
+                    )
+                    if response.headers.get(key)
+                })
+                shutil.copyfileobj(response, self.wfile, PackageCache.chunk)
+    class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads      = True
+        allow_reuse_address = True
+    server = ThreadingHTTPServer((address, port), ProxyHandler)
+    print(
+        "APT caching proxy on {}:{}, cache '{}' ({:.1f} of {:.1f} GB used)".format(
+            address, port, directory, cache.size / 1024**3, maxsize / 1024**3
+        )
+    )
+    print("Mirrors: " + ", ".join(hosts))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(
+            "\nHits: {}, misses: {}, passed through: {}".format(
+                cache.hits, cache.misses, cache.passes
+            )
+        )
+
+
+
+
+##############################################################################
+#
+# Git mirror (./writesd.py --serve-git)
+#
+#   Bare mirrors of the repositories that the installer clones (read from
+#   the installer script's 'repositories' list) and their submodules, kept
+#   up to date and served over the LAN with 'git daemon'. Layout is
+#   '<directory>/<host>/<path>.git', so that a unit can reach any of them
+#   by rewriting 'https://<host>/' into '<mirror url>/<host>/'
+#   (install.py does this when install.config has [Mirror] url).
+#
+def installer_repositories(filename: str) -> list:
+    """Repository URLs from the installer script's 'repositories' list.
+    The script is parsed, not executed."""
+    import ast
+    try:
+        with open(filename, "r") as file:
+            tree = ast.parse(file.read())
+    except (OSError, SyntaxError):
+        return []
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and \
+           any(getattr(t, "id", None) == "repositories" for t in node.targets):
+            return [repo[2] for repo in ast.literal_eval(node.value)]
+    return []
+
+
+class GitMirror:
+    def __init__(self, directory: str, urls: list):
+        self.directory  = directory
+        self.urls       = urls
+    def path(self, url: str) -> str:
+        import urllib.parse
+        location = urllib.parse.urlsplit(url)
+        path = location.path.strip("/")
+        if not path.endswith(".git"):
+            path += ".git"
+        return os.path.join(
+            self.directory, location.hostname or "localhost", path
+        )
+    @staticmethod
+    def git(*args) -> tuple:
+        """Returns (returncode, output)."""
+        proc = subprocess.run(
+            ["git", *args],
+            stdout = subprocess.PIPE,
+            stderr = subprocess.STDOUT
+        )
+        return proc.returncode, proc.stdout.decode("utf-8", errors = "replace")
+    def submodules(self, gitdir: str, url: str) -> list:
+        """Submodule URLs from .gitmodules in HEAD (relative ones resolved)."""
+        import posixpath
+        import urllib.parse
+        code, output = GitMirror.git(
+            "--git-dir=" + gitdir,
+            "config", "--blob", "HEAD:.gitmodules",
+            "--get-regexp", r"^submodule\..*\.url$"
+        )
+        if code:
+            return []
+        urls = []
+        for line in output.splitlines():
+            sub = line.split(" ", 1)[-1].strip()
+            if sub.startswith(("./", "../")):
+                location = urllib.parse.urlsplit(url.rstrip("/"))
+                path = posixpath.normpath(
+                    posixpath.join(location.path, sub)
+                )
+                sub = urllib.parse.urlunsplit(location._replace(path = path))
+            urls.append(sub)
+        return urls
+    def update(self) -> list:
+        """Clone missing and fetch existing mirrors, submodules included.
+        Returns a list of (url, ok, message)."""
+        results = []
+        queue = list(self.urls)
+        done = set()
+        while queue:
+            url = queue.pop(0)
+            if url in done:
+                continue
+            done.add(url)
+            gitdir = self.path(url)
+            if os.path.isdir(gitdir):
+                code, output = GitMirror.git(
+                    "--git-dir=" + gitdir, "fetch", "--prune", "--quiet", "origin"
+                )
+            else:
+                os.makedirs(os.path.dirname(gitdir), exist_ok = True)
+                code, output = GitMirror.git(
+                    "clone", "--mirror", "--quiet", url, gitdir
+                )
+            results.append((url, code == 0, output.strip()))
+            if code == 0:
+                queue += self.submodules(gitdir, url)
+        return results
+
+
+def serve_git(port: int, directory: str, urls: list, interval: int):
+    """Run 'git daemon' for the mirrors and update them every 'interval'
+    seconds, until interrupted (CTRL-C)."""
+    import signal
+    mirror = GitMirror(directory, urls)
+    os.makedirs(directory, exist_ok = True)
+    # Terminate 'git daemon' also when stopped by a service manager
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    daemon = subprocess.Popen([
+        "git", "daemon",
+        "--reuseaddr",
+        "--export-all",
+        "--port={}".format(port),
+        "--base-path=" + directory,
+        directory
+    ])
+    print(
+        "Git mirror on git://<this host>:{}/ from '{}', updated every {}s".format(
+            port, directory, interval
+        )
+    )
+    try:
+        while daemon.poll() is None:
+            start = time.time()
+            for url, ok, message in mirror.update():
+                print(
+                    "{} {:<8} {}".format(
+                        time.strftime("%H:%M:%S"), "OK" if ok else "FAILED", url
+                    ),
+                    flush = True
+                )
+                if not ok:
+                    print("         ", message)
+            time.sleep(max(interval - (time.time() - start), 1))
+        print("git daemon exited with code {}!".format(daemon.returncode))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if daemon.poll() is None:
+            daemon.terminate()
+            daemon.wait()
+
+
+
+
 ###############################################################################
 #
 # COMMON
@@ -534,22 +1242,98 @@ def shell(cmd: str):
     return subprocess.run(cmd.split(" ")).returncode
 
 
-def do_or_die(cmd: str):
-    """Die (exit) on exception or non-zero return code"""
+# RingBuffer and pump_output(): copies of install.py (the reference, see
+# README.md "Record and Replay").
+class RingBuffer:
+    """Keeps (at least) the last 'size' bytes written into it. Memory use is
+    bounded to 2 * size, regardless of how much is written."""
+    def __init__(self, size: int):
+        self.size   = size
+        self.total  = 0
+        self.buffer = bytearray()
+    def write(self, data: bytes):
+        self.total  += len(data)
+        self.buffer += data
+        if len(self.buffer) > 2 * self.size:
+            del self.buffer[:-self.size]
+    def tail(self) -> str:
+        """Last 'size' bytes as text. If older output has been discarded,
+        the partial first line is dropped."""
+        data = bytes(self.buffer[-self.size:])
+        if self.total > len(data):
+            data = data[data.find(b"\n") + 1:]
+        return data.decode("utf-8", errors = "replace")
+
+
+def pump_output(proc, ring: RingBuffer, tee = None, echo: bool = False):
+    """Reads merged stdout/stderr of 'proc' (Popen(stdout = PIPE)) into
+    'ring' and optionally into 'tee' (binary file) and to console, until EOF.
+    Non-blocking reads, so the child never stalls on a full pipe. The child
+    is not reaped (waitid(WNOWAIT)). If it has exited, but a daemonized
+    descendant still holds the pipe open, reading stops once it goes quiet."""
+    import selectors
+    fd = proc.stdout.fileno()
+    os.set_blocking(fd, False)
+    selector = selectors.DefaultSelector()
+    selector.register(fd, selectors.EVENT_READ)
+    exited = False
+    try:
+        while True:
+            if selector.select(timeout = 0.2 if exited else 0.5):
+                try:
+                    data = os.read(fd, 65536)
+                except BlockingIOError:
+                    continue
+                if not data:
+                    break
+                ring.write(data)
+                if tee:
+                    tee.write(data)
+                if echo:
+                    sys.stdout.buffer.write(data)
+                    sys.stdout.flush()
+            elif exited:
+                break
+            else:
+                exited = os.waitid(
+                    os.P_PID, proc.pid,
+                    os.WEXITED | os.WNOHANG | os.WNOWAIT
+                ) is not None
+    finally:
+        selector.close()
+        proc.stdout.close()
+
+
+def do_or_die(cmd: str, echo: bool = False):
+    """Die (exit) on exception or non-zero return code. Command output is captured and its last App.output_tail bytes are shown on failure."""
+    output = RingBuffer(App.output_tail)
     try:
-        if shell(cmd):
+        proc = subprocess.Popen(
+            cmd.split(" "),
+            stdout = subprocess.PIPE,
+            stderr = subprocess.STDOUT
+        )
+        pump_output(proc, output, echo = echo)
+        if proc.wait():
             raise ValueError("Non-zero return code!")
     except Exception as e:
+        print(output.tail(), end = "")
         print(e)
         print("Command '{}' failed!".format(cmd))
         os._exit(-1)
 
 
-def choose_image_file(dir: str) -> str:
-    """If more than one *.img in script directory, let user choose."""
+def choose_image_file(dir: str, store: "ImageStore" = None) -> str:
+    """If more than one image in script directory (or in the image store),
+    let user choose."""
     import glob
     os.chdir(dir)
-    img_list = sorted(glob.glob("*.img"))
+    img_list = sorted(glob.glob("*.img") + glob.glob("*.img.[gx]z"))
+    if store:
+        img_list += [
+            f for f in map(os.path.relpath, store.images())
+            if f not in img_list
+        ]
     if len(img_list) < 1:
         print("NO Rasbian IMAGES IN SCRIPT DIRECTORY!")
         print(
@@ -563,7 +1347,7 @@ def choose_image_file(dir: str) -> str:
     else:
         print("Choose image:")
         for i, file in enumerate(img_list):
-            print("  ", i + 1, file)
+            print("  ", i + 1, file, store.describe(file) if store else "")
         sel = None
         while (not sel):
             try:
@@ -591,6 +1375,958 @@ def choose_image_file(dir: str) -> str:
         os._exit(-1)
 
 
+def image_extents(fd: int, size: int) -> list:
+    """(offset, length) of data regions in a (sparse) image file, using
+    SEEK_DATA / SEEK_HOLE. Whole file as one extent if not supported."""
+    if not hasattr(os, "SEEK_DATA"):
+        return [(0, size)]
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError:
+                break           # ENXIO: no more data
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+            extents.append((start, end - start))
+            offset = end
+    except OSError:
+        return [(0, size)]
+    return extents
+
+
+def write_image(image: str, target, blocksize: int = 4 * 1024**2,
+                sparse: bool = False, zeros: bool = True) -> tuple:
+    """Native (in-process) image writer, alternative to 'dd'. Writes also
+    compressed ('.img.gz', '.img.xz') images.
+    'target' is a path or an open binary file object (such as a simulated
+    device). Writes are 'blocksize' chunks, aligned to image offsets.
+    If 'sparse' is True, holes in the image file and all-zero chunks (unless
+    'zeros' is False) are not written at all - correct ONLY if the target
+    already reads as zero there (fresh file, discarded card).
+    Returns (bytes written, bytes skipped)."""
+    skip_zeros = sparse and zeros
+    zeros = bytes(blocksize)
+    written = skipped = 0
+    with open_image(image) as src:
+        if image_compression(image):
+            # Sequential only, size not known
+            extents = [(0, None)]
+        else:
+            size = os.fstat(src.fileno()).st_size
+            extents = image_extents(src.fileno(), size) if sparse else [(0, size)]
+        if isinstance(target, str):
+            dst = open(target, "r+b", buffering = 0)
+        else:
+            dst = target
+        try:
+            for start, length in extents:
+                end = start + length if length is not None else None
+                src.seek(start)
+                dst.seek(start)
+                offset = start
+                while end is None or offset < end:
+                    # Keep chunks aligned to 'blocksize' boundaries
+                    count = blocksize - offset % blocksize
+                    if end is not None:
+                        count = min(count, end - offset)
+                    chunk = src.read(count)
+                    if not chunk:
+                        break
+                    if skip_zeros and chunk == zeros[:len(chunk)]:
+                        dst.seek(len(chunk), os.SEEK_CUR)
+                        skipped += len(chunk)
+                    else:
+                        view = memoryview(chunk)
+                        while view:
+                            view = view[dst.write(view):]
+                        written += len(chunk)
+                    offset += len(chunk)
+            if not image_compression(image):
+                skipped += size - written - skipped
+            dst.flush()
+            os.fsync(dst.fileno())
+        finally:
+            if dst is not target:
+                dst.close()
+    return written, skipped
+
+
+def verify_image(image: str, target: str, blocksize: int = 4 * 1024**2) -> bool:
+    """Read back and compare. Target may be larger than the image."""
+    with open_image(image) as src, \
+         open(target, "rb", buffering = 0) as dst:
+        # Do not compare against page cache content of what was just written
+        try:
+            os.posix_fadvise(dst.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        except (AttributeError, OSError):
+            pass
+        while True:
+            a = src.read(blocksize)
+            if not a:
+                return True
+            if dst.read(len(a)) != a:
+                return False
+
+
+def device_size(path: str) -> int:
+    with open(path, "rb") as file:
+        return file.seek(0, os.SEEK_END)
+
+
+def discard_device(path: str, ranges: list = None) -> float:
+    """Tell the card that the given (offset, length) ranges (or the whole
+    device) hold no data (BLKDISCARD, TRIM/ERASE for SD cards), so that the
+    controller does not need to preserve them and can pre-erase the blocks.
+    Ranges are aligned inwards to 4 kB. Returns elapsed seconds."""
+    import fcntl
+    import struct
+    BLKDISCARD = 0x1277
+    start = time.time()
+    with open(path, "r+b", buffering = 0) as file:
+        if ranges is None:
+            ranges = [(0, file.seek(0, os.SEEK_END))]
+        for offset, length in ranges:
+            end = (offset + length) // 4096 * 4096
+            offset = -(-offset // 4096) * 4096
+            if end > offset:
+                fcntl.ioctl(
+                    file.fileno(), BLKDISCARD,
+                    struct.pack("QQ", offset, end - offset)
+                )
+    return time.time() - start
+
+
+def discard_zeroes(path: str, ranges: list, samples: int = 16) -> bool:
+    """Sample discarded ranges: True if they read back as zeros. Not all
+    cards guarantee that, and sparse writing depends on it."""
+    zeros = bytes(4096)
+    ranges = [(o, l) for o, l in ranges if l >= 2 * 4096]
+    if not ranges:
+        return True
+    with open(path, "rb", buffering = 0) as file:
+        try:
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        except (AttributeError, OSError):
+            pass
+        for i in range(samples):
+            offset, length = ranges[i % len(ranges)]
+            position = -(-offset // 4096) * 4096 + \
+                (length - 2 * 4096) * i // samples // 4096 * 4096
+            file.seek(position)
+            if file.read(4096) != zeros:
+                return False
+    return True
+
+
+def unwritten_ranges(image: str, size: int) -> list:
+    """Ranges of a device of 'size' bytes that write_image(sparse = True,
+    zeros = False) leaves unwritten: holes of the image file and everything
+    after it."""
+    with open(image, "rb") as file:
+        length = os.fstat(file.fileno()).st_size
+        extents = image_extents(file.fileno(), length)
+    ranges = []
+    offset = 0
+    for start, count in extents + [(length, 0)]:
+        if start > offset:
+            ranges.append((offset, start - offset))
+        offset = start + count
+    if size > length:
+        ranges.append((length, size - length))
+    return ranges
+
+
+###############################################################################
+#
+# Card identity and write tuning (--probe)
+#
+#   Write throughput of SD cards depends on the write size (and alignment
+#   to the card's internal allocation units), differently for each model.
+#   A short probe writes test data with each chunk size in App.Tuning.sizes
+#   (O_DIRECT, so that the card is measured, not the page cache) and the
+#   fastest is cached per card model. Writes to cards of a known model use
+#   the cached block size.
+#
+#   Card model comes from the CID register (sysfs, mmcblk devices). USB card
+#   readers do not expose CID; reader vendor/model and card size are used.
+#
+
+def card_identity(blkdev: str) -> dict:
+    """Identity of the card in /dev/<blkdev>, from sysfs. 'model' identifies
+    the card model (tuning cache key), 'cid' the individual card (None if
+    the reader does not expose it)."""
+    def read(name: str):
+        try:
+            with open("/sys/block/{}/{}".format(blkdev, name), "r") as file:
+                return file.read().strip()
+        except OSError:
+            return None
+    size = int(read("size") or 0) * 512
+    cid = read("device/cid")
+    if cid:
+        return {
+            "cid"       : cid,
+            "serial"    : read("device/serial"),
+            "name"      : read("device/name"),
+            "date"      : read("device/date"),
+            "size"      : size,
+            "model"     : "mmc:{}:{}:{}".format(
+                read("device/manfid"), read("device/oemid"), read("device/name")
+            )
+        }
+    name = " ".join(filter(None, (read("device/vendor"), read("device/model"))))
+    return {
+        "cid"       : None,
+        "serial"    : None,
+        "name"      : name or blkdev,
+        "date"      : None,
+        "size"      : size,
+        "model"     : "{}:{}GB".format(name or blkdev, round(size / 1000**3))
+    }
+
+
+def probe_card(device: str, sizes: list, offset: int, length: int) -> dict:
+    """Write 'length' bytes at 'offset' with each chunk size (bytes) in
+    'sizes', bypassing the page cache. Also the fastest size misaligned
+    by 64 kB. DESTROYS DATA in the probed area.
+    Returns {"results" : {size : MB/s}, "blocksize" : fastest,
+    "misaligned" : MB/s}."""
+    import mmap
+    def run(chunk: int, start: int) -> float:
+        buffer = mmap.mmap(-1, chunk)           # Page aligned for O_DIRECT
+        buffer.write(os.urandom(chunk))
+        fd = os.open(device, os.O_WRONLY | getattr(os, "O_DIRECT", 0))
+        try:
+            began = time.time()
+            position = start
+            while position < start + length:
+                os.pwrite(fd, buffer, position)
+                position += chunk
+            os.fsync(fd)
+            return (position - start) / 1024**2 / (time.time() - began)
+        finally:
+            os.close(fd)
+            buffer.close()
+    results = {size : run(size, offset) for size in sizes}
+    best = max(results, key = results.get)
+    return {
+        "results"       : {str(k) : round(v, 1) for k, v in results.items()},
+        "blocksize"     : best,
+        "misaligned"    : round(run(best, offset + 64 * 1024), 1)
+    }
+
+
+class TuningCache:
+    """Card model : write parameters (JSON file)."""
+    def __init__(self, filename: str):
+        self.filename = filename
+    def load(self) -> dict:
+        import json
+        try:
+            with open(self.filename, "r") as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return {}
+    def get(self, model: str) -> dict:
+        return self.load().get(model)
+    def put(self, model: str, params: dict):
+        """Store parameters. File is rewritten atomically."""
+        import json
+        cache = self.load()
+        cache[model] = params
+        os.makedirs(os.path.dirname(self.filename), exist_ok = True)
+        with open(self.filename + ".tmp", "w") as file:
+            json.dump(cache, file, indent = 2, sort_keys = True)
+        os.replace(self.filename + ".tmp", self.filename)
+
+
+###############################################################################
+#
+# Card registry (--registry, --card)
+#
+#   Every write is recorded into an SQLite database: which card (CID, when
+#   the reader exposes it), which image (SHA-256 of the uncompressed image),
+#   instance choices, phase timings and throughput. Queries answer what
+#   is on a card, which card models are slow and which individual cards
+#   have slowed down (worn cards are replaced).
+#
+#   Throughput ('mbps') is computed from bytes actually written, so that
+#   sparse writes onto discarded cards do not look faster than they are.
+#
+
+class CardRegistry:
+    """SQLite database of cards and writes onto them."""
+    schema = """
+        CREATE TABLE IF NOT EXISTS card (
+            cid         TEXT PRIMARY KEY,
+            serial      TEXT,
+            name        TEXT,
+            model       TEXT NOT NULL,
+            size        INTEGER,
+            date        TEXT,
+            first_seen  TEXT NOT NULL,
+            last_seen   TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS flash (
+            id          INTEGER PRIMARY KEY,
+            started     TEXT NOT NULL,
+            cid         TEXT REFERENCES card (cid),
+            model       TEXT NOT NULL,
+            device      TEXT,
+            image       TEXT,
+            sha256      TEXT,
+            size        INTEGER,
+            written     INTEGER,
+            mode        TEXT,
+            ddns        INTEGER,
+            sshkeys     INTEGER,
+            writer      TEXT,
+            blocksize   INTEGER,
+            discard     TEXT,
+            probe_s     REAL,
+            discard_s   REAL,
+            write_s     REAL,
+            verify_s    REAL,
+            expand_s    REAL,
+            configure_s REAL,
+            total_s     REAL,
+            mbps        REAL,
+            verified    INTEGER,
+            result      TEXT NOT NULL,
+            version     TEXT
+        );
+        CREATE INDEX IF NOT EXISTS flash_cid    ON flash (cid, started);
+        CREATE INDEX IF NOT EXISTS flash_model  ON flash (model, mbps);
+        CREATE INDEX IF NOT EXISTS flash_sha256 ON flash (sha256);
+        CREATE TABLE IF NOT EXISTS image (
+            path        TEXT PRIMARY KEY,
+            size        INTEGER NOT NULL,
+            mtime       REAL NOT NULL,
+            sha256      TEXT NOT NULL
+        );
+    """
+    def __init__(self, filename: str):
+        import sqlite3
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok = True)
+        self.db = sqlite3.connect(filename)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(self.schema)
+    def close(self):
+        self.db.close()
+    def digest(self, filename: str, store: "ImageStore" = None) -> str:
+        """SHA-256 of the uncompressed image content. Taken from the image
+        store index, or computed once and cached by path, size and mtime."""
+        import hashlib
+        if store and os.path.dirname(os.path.abspath(filename)) == \
+           os.path.abspath(store.directory):
+            info = store.index().get(os.path.basename(filename), {})
+            if "sha256" in info:
+                return info["sha256"]
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        row = self.db.execute(
+            "SELECT sha256 FROM image WHERE path = ? AND size = ? AND mtime = ?",
+            (path, st.st_size, st.st_mtime)
+        ).fetchone()
+        if row:
+            return row["sha256"]
+        digest = hashlib.sha256()
+        with open_image(path) as file:
+            for chunk in iter(lambda: file.read(4 * 1024**2), b""):
+                digest.update(chunk)
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO image VALUES (?, ?, ?, ?)",
+                (path, st.st_size, st.st_mtime, digest.hexdigest())
+            )
+        return digest.hexdigest()
+    def record(self, card: dict, **flash) -> int:
+        """Record a write onto 'card' (card_identity()). Keyword arguments
+        are 'flash' table columns. Returns the row id."""
+        now = time.strftime("%Y-%m-%d %H:%M:%S")
+        flash.setdefault("started", now)
+        flash["cid"]   = card["cid"]
+        flash["model"] = card["model"]
+        if flash.get("written") and flash.get("write_s"):
+            flash["mbps"] = round(
+                flash["written"] / 1024**2 / max(flash["write_s"], 0.001), 2
+            )
+        with self.db:
+            if card["cid"]:
+                self.db.execute(
+                    "INSERT OR IGNORE INTO card VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        card["cid"], card["serial"], card["name"],
+                        card["model"], card["size"], card["date"], now, now
+                    )
+                )
+                self.db.execute(
+                    "UPDATE card SET last_seen = ? WHERE cid = ?",
+                    (now, card["cid"])
+                )
+            cursor = self.db.execute(
+                "INSERT INTO flash ({}) VALUES ({})".format(
+                    ", ".join(flash), ", ".join("?" * len(flash))
+                ),
+                list(flash.values())
+            )
+        return cursor.lastrowid
+    def history(self, cid: str) -> list:
+        """Writes onto card 'cid' (or CID prefix), newest first. The first
+        row tells which image is on the card."""
+        return self.db.execute(
+            "SELECT * FROM flash WHERE cid LIKE ? || '%' "
+            "ORDER BY started DESC, id DESC",
+            (cid,)
+        ).fetchall()
+    def slowest_models(self, limit: int = 10) -> list:
+        """Card models by average write throughput, slowest first."""
+        return self.db.execute(
+            "SELECT model, COUNT(*) AS writes, COUNT(DISTINCT cid) AS cards, "
+            "AVG(mbps) AS mbps, MIN(mbps) AS worst, "
+            "AVG(total_s) AS total_s, MAX(blocksize) AS blocksize "
+            "FROM flash WHERE result = 'OK' AND mbps IS NOT NULL "
+            "GROUP BY model ORDER BY mbps LIMIT ?",
+            (limit,)
+        ).fetchall()
+    def degraded(self, ratio: float) -> list:
+        """Cards whose latest write throughput is below 'ratio' of their
+        best earlier write."""
+        return self.db.execute(
+            "SELECT * FROM ("
+            "  SELECT f.cid, f.model, f.started, f.mbps, ("
+            "    SELECT MAX(p.mbps) FROM flash p"
+            "    WHERE p.cid = f.cid AND p.id < f.id AND p.result = 'OK'"
+            "  ) AS best, ("
+            "    SELECT COUNT(*) FROM flash p WHERE p.cid = f.cid"
+            "  ) AS writes"
+            "  FROM flash f"
+            "  WHERE f.id = (SELECT MAX(id) FROM flash WHERE cid = f.cid)"
+            "  AND f.result = 'OK'"
+            ") WHERE best IS NOT NULL AND mbps < ? * best "
+            "ORDER BY mbps / best",
+            (ratio,)
+        ).fetchall()
+
+
+def register_write(store: "ImageStore", card: dict, timing: dict,
+                   started: float, size: int, written: int, result: str,
+                   verified: bool = None):
+    """Record current write (App) into the card registry. Registry failure
+    is only a warning - it must not fail the card."""
+    total = time.time() - started
+    try:
+        registry = CardRegistry(App.Registry.database)
+        registry.record(
+            card,
+            started     = time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.localtime(started)
+            ),
+            device      = "/dev/" + App.blkdev,
+            image       = os.path.abspath(App.image),
+            sha256      = registry.digest(App.image, store),
+            size        = size,
+            written     = written,
+            mode        = App.Mode.selected,
+            ddns        = App.DDNS.selected,
+            sshkeys     = App.SSHKeys.selected,
+            writer      = App.writer,
+            blocksize   = App.blocksize,
+            discard     = App.discard,
+            total_s     = round(total, 2),
+            verified    = verified,
+            result      = result,
+            version     = App.version,
+            **{k : round(v, 2) for k, v in timing.items()}
+        )
+        registry.close()
+    except Exception as e:
+        print("WARNING: Card registry not updated ({})".format(e))
+
+
+def registry_report(registry: CardRegistry, report: str, cid: str = None):
+    """Print registry query results."""
+    if report == "card":
+        rows = registry.history(cid)
+        if not rows:
+            print("No writes recorded for card '{}'".format(cid))
+            return
+        cids = sorted(set(row["cid"] for row in rows))
+        if len(cids) > 1:
+            print("Card '{}' is ambiguous:".format(cid))
+            for c in cids:
+                print("  " + c)
+            return
+        print("Card {} ({}), {} write(s):".format(
+                rows[0]["cid"], rows[0]["model"], len(rows)
+            )
+        )
+        print("  Image on card: {} (sha256 {}{})".format(
+                rows[0]["image"], rows[0]["sha256"],
+                "" if rows[0]["result"] == "OK" else
+                ", last write " + rows[0]["result"]
+            )
+        )
+        print("  {:<19}  {:<7} {:<4} {:>8} {:>7}  {:<8} {}".format(
+                "WRITTEN", "RESULT", "MODE", "MB/s", "TOTAL", "VERIFIED", "IMAGE"
+            )
+        )
+        for row in rows:
+            print("  {:<19}  {:<7} {:<4} {:>8} {:>6.0f}s  {:<8} {}".format(
+                    row["started"], row["result"], row["mode"] or "",
+                    "" if row["mbps"] is None else round(row["mbps"], 1),
+                    row["total_s"] or 0,
+                    {None: "", 0: "FAILED", 1: "yes"}[row["verified"]],
+                    os.path.basename(row["image"] or "")
+                )
+            )
+    elif report == "models":
+        print("{:<40} {:>6} {:>5} {:>8} {:>8} {:>8} {:>6}".format(
+                "MODEL", "WRITES", "CARDS", "MB/s", "WORST", "TOTAL", "BS kB"
+            )
+        )
+        for row in registry.slowest_models():
+            print("{:<40} {:>6} {:>5} {:>8.1f} {:>8.1f} {:>7.0f}s {:>6}".format(
+                    row["model"][:40], row["writes"], row["cards"],
+                    row["mbps"], row["worst"], row["total_s"] or 0,
+                    (row["blocksize"] or 0) // 1024
+                )
+            )
+    elif report == "degraded":
+        rows = registry.degraded(App.Registry.degraded)
+        print("Cards below {:.0f}% of their best write throughput:".format(
+                App.Registry.degraded * 100
+            )
+        )
+        for row in rows:
+            print("  {}  {:<30} {:>6.1f} MB/s (best {:.1f}, {} writes, {})".format(
+                    row["cid"], row["model"][:30], row["mbps"], row["best"],
+                    row["writes"], row["started"]
+                )
+            )
+        if not rows:
+            print("  None")
+
+
+###############################################################################
+#
+# Image store and card capture (--capture)
+#
+#   A card that has completed the installation is read back into a "golden"
+#   image. Only allocated blocks are read: ext2/3/4 partitions with
+#   'e2image -ra' (filesystem metadata tells which blocks are in use), other
+#   partitions and the area before the first partition in full, but all-zero
+#   blocks are left as holes. The image is then generalised (machine-id,
+#   SSH host keys), compressed and indexed in the image store
+#   (App.Store.directory/index.json), from where it can be written like any
+#   other image.
+#
+#   Optimised (--shrink, --optimise) images have their root filesystem
+#   shrunk to minimum plus headroom and the file truncated after it. After
+#   writing a shrunk store image (or with --expand), root partition is
+#   expanded to fill the card (unless --noexpand).
+#
+
+def partition_table(device: str) -> list:
+    """MBR (DOS) primary partitions of a disk or an image file, as a list of
+    (number, type, offset, size) tuples, offset and size in bytes.
+    Raspbian images use MBR partition tables."""
+    import struct
+    with open(device, "rb") as file:
+        mbr = file.read(512)
+    if len(mbr) < 512 or mbr[510:512] != b"\x55\xaa":
+        raise ValueError("No MBR partition table in '{}'!".format(device))
+    partitions = []
+    for number in range(1, 5):
+        entry = mbr[446 + (number - 1) * 16:446 + number * 16]
+        ptype = entry[4]
+        start, count = struct.unpack("<II", entry[8:16])
+        if ptype and count:
+            partitions.append((number, ptype, start * 512, count * 512))
+    return partitions
+
+
+def copy_sparse(src, dst, offset: int, length: int,
+                blocksize: int = 4 * 1024**2) -> int:
+    """Copy 'length' bytes at 'offset' from 'src' to 'dst' (binary files),
+    leaving all-zero blocks as holes in 'dst'. Returns bytes written."""
+    zeros = bytes(blocksize)
+    written = 0
+    src.seek(offset)
+    end = offset + length
+    while offset < end:
+        chunk = src.read(min(blocksize - offset % blocksize, end - offset))
+        if not chunk:
+            break
+        if chunk != zeros[:len(chunk)]:
+            dst.seek(offset)
+            dst.write(chunk)
+            written += len(chunk)
+        offset += len(chunk)
+    return written
+
+
+def image_compression(filename: str):
+    """'gz', 'xz' or None, by file extension."""
+    for ext in ("gz", "xz"):
+        if filename.endswith(".img." + ext):
+            return ext
+    return None
+
+
+def open_image(filename: str):
+    """Open (possibly compressed) image for reading."""
+    compression = image_compression(filename)
+    if compression == "gz":
+        import gzip
+        return gzip.open(filename, "rb")
+    if compression == "xz":
+        import lzma
+        return lzma.open(filename, "rb")
+    return open(filename, "rb", buffering = 0)
+
+
+def generalise_image(filename: str, offset: int, size: int,
+                     tls_cn: str = None) -> list:
+    """Remove unit specific identity from the root filesystem at 'offset'
+    of the image, so that each unit written from it gets its own:
+    /etc/machine-id is emptied (systemd generates a new one on boot),
+    SSH host keys are removed (Raspbian regenerate_ssh_host_keys.service
+    is enabled to create new ones) and so is the TLS key and certificate
+    for 'tls_cn' (install_host_keys() writes them per unit). Returns a
+    list of actions taken."""
+    import glob
+    import tempfile
+    actions = []
+    mnt = tempfile.mkdtemp(prefix = "writesd.")
+    do_or_die(
+        "mount -o loop,offset={},sizelimit={} {} {}".format(
+            offset, size, filename, mnt
+        )
+    )
+    try:
+        if os.path.exists(mnt + "/etc/machine-id"):
+            open(mnt + "/etc/machine-id", "w").close()
+            actions.append("/etc/machine-id emptied")
+        keys = glob.glob(mnt + "/etc/ssh/ssh_host_*")
+        for key in keys:
+            os.remove(key)
+        if keys:
+            actions.append("{} SSH host key files removed".format(len(keys)))
+        unit = "/lib/systemd/system/regenerate_ssh_host_keys.service"
+        link = mnt + "/etc/systemd/system/multi-user.target.wants/" + \
+               os.path.basename(unit)
+        if keys and os.path.exists(mnt + unit) and not os.path.lexists(link):
+            os.symlink(unit, link)
+            actions.append("SSH host key regeneration enabled")
+        elif keys and not os.path.exists(mnt + unit):
+            actions.append(
+                "WARNING: no {}, SSH host keys must be created!".format(
+                    os.path.basename(unit)
+                )
+            )
+        if tls_cn:
+            tls = [
+                mnt + "/etc/ssl/private/{}.key".format(tls_cn),
+                mnt + "/etc/ssl/certs/{}.crt".format(tls_cn)
+            ]
+            tls = [path for path in tls if os.path.lexists(path)]
+            for path in tls:
+                os.remove(path)
+            if tls:
+                actions.append(
+                    "{} TLS key/certificate files for '{}' removed".format(
+                        len(tls), tls_cn
+                    )
+                )
+    finally:
+        do_or_die("umount {}".format(mnt))
+        os.rmdir(mnt)
+    return actions
+
+
+def set_partition_size(device: str, number: int, size: int):
+    """Rewrite the length of MBR primary partition 'number' (1-4) in a disk
+    or an image file. 'size' in bytes (multiple of 512)."""
+    import struct
+    with open(device, "r+b", buffering = 0) as file:
+        file.seek(446 + (number - 1) * 16 + 12)
+        file.write(struct.pack("<I", size // 512))
+        os.fsync(file.fileno())
+
+
+def loop_attach(filename: str, offset: int, size: int) -> str:
+    """Attach a region of a file (or device) to a loop device."""
+    return subprocess.run(
+        [
+            "losetup", "--find", "--show",
+            "--offset", str(offset), "--sizelimit", str(size), filename
+        ],
+        stdout = subprocess.PIPE, check = True
+    ).stdout.decode().strip()
+
+
+def ext_check(device: str, discard: bool = False):
+    """Forced filesystem check (required before resize2fs). With 'discard',
+    free blocks are discarded as well - on a loop device this punches holes
+    into the image file, so that free space reads as zeros."""
+    cmd = ["e2fsck", "-f", "-y"]
+    if discard:
+        cmd += ["-E", "discard"]
+    proc = subprocess.run(
+        cmd + [device], stdout = subprocess.PIPE, stderr = subprocess.STDOUT
+    )
+    # 1 = errors corrected, anything more is trouble
+    if proc.returncode & ~1:
+        raise ValueError(
+            "e2fsck {} failed ({})\n{}".format(
+                device, proc.returncode, proc.stdout.decode(errors = "replace")
+            )
+        )
+
+
+def ext_geometry(device: str) -> tuple:
+    """(block size, block count, minimum block count) of ext filesystem."""
+    out = subprocess.run(
+        ["dumpe2fs", "-h", device],
+        stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, check = True
+    ).stdout.decode()
+    values = dict(
+        line.split(":", 1) for line in out.splitlines() if ":" in line
+    )
+    out = subprocess.run(
+        ["resize2fs", "-P", device],
+        stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, check = True
+    ).stdout.decode()
+    minimum = int(out.rsplit(":", 1)[1])
+    return (
+        int(values["Block size"]),
+        int(values["Block count"]),
+        minimum
+    )
+
+
+def optimise_image(filename: str, headroom: int) -> dict:
+    """Minimise image file: free space of the root (last) ext partition is
+    discarded (reads as zeros, stored as holes), the filesystem is shrunk
+    to its minimum plus 'headroom' bytes, the partition table is updated
+    and the file is truncated after the partition.
+    Returns {"before" : bytes, "after" : bytes} (file sizes)."""
+    number, ptype, offset, length = max(
+        partition_table(filename), key = lambda p: p[2]
+    )
+    if ptype != 0x83:
+        raise ValueError("Last partition of '{}' is not Linux!".format(filename))
+    before = os.path.getsize(filename)
+    loop = loop_attach(filename, offset, length)
+    try:
+        ext_check(loop, discard = True)
+        blocksize, count, minimum = ext_geometry(loop)
+        target = minimum + -(-headroom // blocksize)
+        if target < count:
+            do_or_die("resize2fs {} {}".format(loop, target))
+            count = target
+    finally:
+        subprocess.run(["losetup", "--detach", loop])
+    # Partition end aligned to 4 MB (erase block size of most cards)
+    align = 4 * 1024**2
+    length = min(-(-(count * blocksize) // align) * align, length)
+    set_partition_size(filename, number, length)
+    os.truncate(filename, offset + length)
+    return {"before" : before, "after" : offset + length}
+
+
+def expand_root(blkdev: str) -> int:
+    """Grow the last (Linux) partition of the written card to the end of the
+    device and resize its filesystem, so that shrunk images use the whole
+    card. Returns bytes added (0 if there was nothing to do)."""
+    import fcntl
+    device = "/dev/" + blkdev
+    number, ptype, offset, length = max(
+        partition_table(device), key = lambda p: p[2]
+    )
+    if ptype != 0x83:
+        return 0
+    align = 4 * 1024**2
+    with open(device, "rb") as file:
+        end = file.seek(0, os.SEEK_END) // align * align
+    if end - offset <= length + align:
+        return 0
+    set_partition_size(device, number, end - offset)
+    # Kernel must see the new partition size before it is mounted
+    try:
+        with open(device, "rb") as file:
+            fcntl.ioctl(file.fileno(), 0x125f)      # BLKRRPART
+    except OSError as e:
+        print("WARNING: Partition table re-read failed ({})".format(e))
+    loop = loop_attach(device, offset, end - offset)
+    try:
+        ext_check(loop)
+        do_or_die("resize2fs {}".format(loop))
+    finally:
+        subprocess.run(["losetup", "--detach", loop])
+    return end - offset - length
+
+
+class ImageStore:
+    """Directory of captured images and 'index.json' describing them."""
+    def __init__(self, directory: str):
+        self.directory  = directory
+        self.index_file = os.path.join(directory, "index.json")
+    def index(self) -> dict:
+        import json
+        try:
+            with open(self.index_file, "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+    def add(self, filename: str, **info):
+        """Add (or replace) image entry. Index is rewritten atomically."""
+        import json
+        index = self.index()
+        index[os.path.basename(filename)] = info
+        os.makedirs(self.directory, exist_ok = True)
+        with open(self.index_file + ".tmp", "w") as file:
+            json.dump(index, file, indent = 2, sort_keys = True)
+        os.replace(self.index_file + ".tmp", self.index_file)
+    def entry(self, filename: str) -> dict:
+        """Index entry of the image, empty if it is not a store image."""
+        if os.path.dirname(os.path.abspath(filename)) != \
+           os.path.abspath(self.directory):
+            return {}
+        return self.index().get(os.path.basename(filename), {})
+    def images(self) -> list:
+        """Image files in the store, as paths."""
+        import glob
+        return sorted(
+            f for pattern in ("*.img", "*.img.gz", "*.img.xz")
+            for f in glob.glob(os.path.join(self.directory, pattern))
+        )
+    def describe(self, filename: str) -> str:
+        info = self.index().get(os.path.basename(filename))
+        if not info:
+            return ""
+        return "captured {} from {} ({:.0f} MB data)".format(
+            info.get("created", "?")[:16],
+            info.get("source", "?"),
+            info.get("allocated", 0) / 1024**2
+        )
+
+
+def capture_image(blkdev: str, store: ImageStore, name: str,
+                  compression: str = "xz", shrink: bool = False) -> str:
+    """Read allocated blocks of /dev/<blkdev> into a sparse image, generalise
+    it, optionally shrink it (optimise_image()), compress (None, 'gz' or
+    'xz') and add into 'store'. Returns the image filename."""
+    import hashlib
+    import datetime
+    device = "/dev/" + blkdev
+    partitions = partition_table(device)
+    if not partitions:
+        raise ValueError("'{}' has no partitions!".format(device))
+    size = max(offset + length for _, _, offset, length in partitions)
+    os.makedirs(store.directory, exist_ok = True)
+    raw = os.path.join(store.directory, name + ".img")
+    filename = raw if not compression else raw + "." + compression
+    if os.path.exists(raw) or os.path.exists(filename):
+        raise ValueError("Image '{}' already exists in the store!".format(name))
+    start = time.time()
+    try:
+        with open(device, "rb", buffering = 0) as src, \
+             open(raw + ".partial", "wb") as dst:
+            dst.truncate(size)
+            # MBR, bootloader gap
+            first = min(offset for _, _, offset, _ in partitions)
+            copy_sparse(src, dst, 0, first)
+            for number, ptype, offset, length in partitions:
+                print(
+                    "  Partition {} ({:.0f} MB)... ".format(
+                        number, length / 1024**2
+                    ),
+                    end = '', flush = True
+                )
+                dst.flush()
+                if ptype == 0x83 and subprocess.run(
+                    ["e2image", "-ra", "-p", "-o", str(offset),
+                     "-O", str(offset), device, raw + ".partial"],
+                    stdout = subprocess.DEVNULL,
+                    stderr = subprocess.DEVNULL
+                ).returncode == 0:
+                    # e2image writes only in-use blocks
+                    print("ext filesystem, in-use blocks")
+                else:
+                    copy_sparse(src, dst, offset, length)
+                    print("copied")
+        root = [p for p in partitions if p[1] == 0x83]
+        actions = []
+        if root:
+            actions = generalise_image(
+                raw + ".partial", root[0][2], root[0][3], App.Keys.tls_cn
+            )
+        for action in actions:
+            print("  " + action)
+        if shrink:
+            print("  Shrinking... ", end = '', flush = True)
+            result = optimise_image(raw + ".partial", App.Store.headroom)
+            size = result["after"]
+            actions.append(
+                "shrunk from {:.0f} MB".format(result["before"] / 1024**2)
+            )
+            print("{:.0f} MB".format(size / 1024**2))
+        with open(raw + ".partial", "rb") as file:
+            allocated = sum(
+                length for _, length in image_extents(file.fileno(), size)
+            )
+        # Compress (reading holes as zeros), hash the raw image
+        digest = hashlib.sha256()
+        if compression == "gz":
+            import gzip
+            out = gzip.open(filename + ".partial", "wb", compresslevel = 6)
+        elif compression == "xz":
+            import lzma
+            out = lzma.open(filename + ".partial", "wb", preset = 3)
+        else:
+            out = None
+        print("  Hashing{}... ".format(
+                " and compressing" if out else ""
+            ),
+            end = '', flush = True
+        )
+        with open(raw + ".partial", "rb") as file:
+            for chunk in iter(lambda: file.read(4 * 1024**2), b""):
+                digest.update(chunk)
+                if out:
+                    out.write(chunk)
+        if out:
+            out.close()
+            os.rename(filename + ".partial", filename)
+            os.remove(raw + ".partial")
+        else:
+            os.rename(raw + ".partial", filename)
+        print("Done!")
+    except:
+        for f in (raw + ".partial", filename + ".partial"):
+            if os.path.exists(f):
+                os.remove(f)
+        raise
+    store.add(
+        filename,
+        created     = datetime.datetime.now().isoformat(),
+        source      = device,
+        size        = size,
+        allocated   = allocated,
+        stored      = os.path.getsize(filename),
+        compression = compression,
+        shrunk      = shrink,
+        sha256      = digest.hexdigest(),
+        generalised = actions,
+        seconds     = round(time.time() - start, 1)
+    )
+    return filename
+
+
 def disk_exists(path: str) -> bool:
     """Simply checks if given path points to a block device. For this reason, both /dev/sda and /dev/sda1 return both true."""
     try:
@@ -821,6 +2557,166 @@ def copy_ssh(home: str):
     return lst
 
 
+class KeyPool:
+    """Ready-made SSH host key sets (and TLS key and self-signed certificate)
+    generated on the station, so that units do not generate them on first
+    boot. Each set is a subdirectory that is renamed into place once all of
+    its keys exist, and renamed again when taken, so that concurrent
+    writesd.py instances never get the same set. Sets left behind by an
+    interrupted fill() or write are removed once 'stale' seconds old."""
+    def __init__(self, directory: str, size: int, types: list,
+                 tls_cn: str = None, tls_key: str = "rsa:4096",
+                 stale: int = 3600):
+        self.directory  = directory
+        self.size       = size
+        self.types      = types
+        self.tls_cn     = tls_cn
+        self.tls_key    = tls_key
+        self.stale      = stale
+    def ready(self) -> list:
+        import glob
+        return sorted(glob.glob(os.path.join(self.directory, "set-*")))
+    def clean(self) -> int:
+        """Remove stale '.new-*' and '.taken-*' directories. Age is from
+        ctime, which rename() (taking a set) updates as well. Younger ones
+        may belong to another running instance. Returns number removed."""
+        import glob
+        import shutil
+        removed = 0
+        for pattern in (".new-*", ".taken-*"):
+            for path in glob.glob(os.path.join(self.directory, pattern)):
+                try:
+                    if time.time() - os.stat(path).st_ctime < self.stale:
+                        continue
+                    shutil.rmtree(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+    def _generate(self, path: str, item: str):
+        if item == "tls":
+            cmd = [
+                "openssl", "req", "-new", "-newkey", self.tls_key,
+                "-days", "365", "-nodes", "-x509",
+                "-subj", "/CN={}".format(self.tls_cn),
+                "-keyout", os.path.join(path, "tls.key"),
+                "-out", os.path.join(path, "tls.crt")
+            ]
+        else:
+            cmd = [
+                "ssh-keygen", "-q", "-t", item, "-N", "", "-C", "",
+                "-f", os.path.join(path, "ssh_host_{}_key".format(item))
+            ]
+        proc = subprocess.run(
+            cmd, stdout = subprocess.DEVNULL, stderr = subprocess.PIPE
+        )
+        if proc.returncode:
+            raise ValueError(
+                "{} failed: {}".format(cmd[0], proc.stderr.decode().strip())
+            )
+    def fill(self, count: int = None) -> int:
+        """Generate 'count' sets (default: until 'size' sets are ready).
+        All keys of all sets are generated in parallel processes.
+        Returns the number of sets generated."""
+        import shutil
+        import tempfile
+        from concurrent.futures import ThreadPoolExecutor
+        os.makedirs(self.directory, mode = 0o700, exist_ok = True)
+        self.clean()
+        if count is None:
+            count = self.size - len(self.ready())
+        if count < 1:
+            return 0
+        paths = [
+            tempfile.mkdtemp(prefix = ".new-", dir = self.directory)
+            for _ in range(count)
+        ]
+        items = list(self.types) + (["tls"] if self.tls_cn else [])
+        try:
+            with ThreadPoolExecutor(max_workers = os.cpu_count() or 2) as pool:
+                jobs = [
+                    pool.submit(self._generate, path, item)
+                    for path in paths for item in items
+                ]
+                for job in jobs:
+                    job.result()
+            for path in paths:
+                os.rename(
+                    path,
+                    os.path.join(
+                        self.directory,
+                        "set-{}-{}".format(
+                            time.strftime("%Y%m%d%H%M%S"),
+                            os.path.basename(path)[5:]
+                        )
+                    )
+                )
+        finally:
+            for path in paths:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+        return count
+    def take(self) -> str:
+        """Claim the oldest ready set (one is generated, if the pool is
+        empty). Remove it with release() once it has been installed."""
+        while True:
+            ready = self.ready()
+            if not ready:
+                self.fill(1)
+                continue
+            taken = os.path.join(
+                self.directory, ".taken-" + os.path.basename(ready[0])
+            )
+            try:
+                os.rename(ready[0], taken)
+                return taken
+            except FileNotFoundError:
+                continue            # Another instance took it
+    def release(self, path: str):
+        import shutil
+        shutil.rmtree(path)
+
+
+def install_host_keys(root: str, keyset: str, tls_cn: str = None) -> list:
+    """Copy SSH host keys from 'keyset' (KeyPool.take()) into '{root}/etc/ssh'
+    and disable Raspbian's regenerate_ssh_host_keys.service, which would
+    replace them on first boot. TLS key and certificate, if present in the
+    set, are copied as '/etc/ssl/private/{tls_cn}.key' and
+    '/etc/ssl/certs/{tls_cn}.crt'. Ownership is taken from the target
+    directories (as copy_ssh() does). Returns a list of installed files."""
+    import shutil
+    installed = []
+    def install(src: str, tgt: str, permissions: int):
+        info = os.stat(os.path.dirname(tgt))
+        shutil.copyfile(src, tgt)
+        os.chmod(tgt, permissions)
+        os.chown(tgt, info.st_uid, info.st_gid)
+        installed.append(tgt[len(root):])
+    for filename in sorted(os.listdir(keyset)):
+        if filename.startswith("ssh_host_"):
+            install(
+                os.path.join(keyset, filename),
+                "{}/etc/ssh/{}".format(root, filename),
+                0o644 if filename.endswith(".pub") else 0o600
+            )
+    link = root + "/etc/systemd/system/multi-user.target.wants/" + \
+           "regenerate_ssh_host_keys.service"
+    if os.path.lexists(link):
+        os.remove(link)
+    if tls_cn and os.path.exists(os.path.join(keyset, "tls.key")):
+        install(
+            os.path.join(keyset, "tls.key"),
+            "{}/etc/ssl/private/{}.key".format(root, tls_cn),
+            0o600
+        )
+        install(
+            os.path.join(keyset, "tls.crt"),
+            "{}/etc/ssl/certs/{}.crt".format(root, tls_cn),
+            0o644
+        )
+    return installed
+
+
 
 
 ##############################################################################
@@ -832,8 +2728,10 @@ if __name__ == '__main__':
 
     #
     # Check that /mnt is not already a mount point
+    # (not needed for --serve-proxy or --serve-git, which do not write)
     #
-    if os.path.ismount("/mnt"):
+    if os.path.ismount("/mnt") and \
+       not {"--serve-proxy", "--serve-git"} & set(sys.argv):
         # Auto-unmount is not very wise - it may not be a leftover from us.
         print("Directory '/mnt' is already mounted!")
         print("Unmount ('umount /mnt') and re-run this script.")
@@ -881,6 +2779,134 @@ if __name__ == '__main__':
         help = 'Add DDNS client into the instance.',
         action = 'store_true'
     )
+    parser.add_argument(
+        '--proxy',
+        help    = "APT caching proxy URL for the instance. Default: '{}'".format(
+            App.Proxy.url
+        ),
+        default = App.Proxy.url,
+        metavar = "URL"
+    )
+    parser.add_argument(
+        '--noproxy',
+        help    = 'Do not configure APT proxy into the instance.',
+        action  = 'store_true'
+    )
+    parser.add_argument(
+        '--serve-proxy',
+        help    = "Run APT caching proxy (port {}) instead of writing.".format(
+            App.Proxy.port
+        ),
+        action  = 'store_true',
+        dest    = 'serve_proxy'
+    )
+    parser.add_argument(
+        '--serve-git',
+        help    = "Run git mirror (port {}) instead of writing.".format(
+            App.Mirror.port
+        ),
+        action  = 'store_true',
+        dest    = 'serve_git'
+    )
+    parser.add_argument(
+        '--writer',
+        help    = "Image writer: 'dd' or 'native'. Default: '{}'".format(
+            App.writer
+        ),
+        choices = ["dd", "native"],
+        default = App.writer
+    )
+    parser.add_argument(
+        '--verify',
+        help    = 'Read back and compare the written image.',
+        action  = 'store_true'
+    )
+    parser.add_argument(
+        '--discard',
+        help    = "Discard (TRIM) card before writing: 'all' (default) or\n" +
+                  "'unwritten' (image holes and space after the image).\n" +
+                  "Native writer then skips blocks that read as zeros.",
+        choices = ["all", "unwritten"],
+        nargs   = '?',
+        const   = "all",
+        metavar = "MODE"
+    )
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        '--probe',
+        help    = "Probe card write speed with different block sizes and\n" +
+                  "cache the fastest for the card model.",
+        action  = 'store_true'
+    )
+    group.add_argument(
+        '--noprobe',
+        help    = "Do not probe unseen card models (use default 4 MB).",
+        action  = 'store_true'
+    )
+    parser.add_argument(
+        '--registry',
+        help    = "Print card registry report and exit:\n" +
+                  "  models   - card models, slowest first\n" +
+                  "  degraded - cards whose write throughput has dropped\n" +
+                  "  card     - writes (and current image) of card --card",
+        choices = ["models", "degraded", "card"],
+        metavar = "REPORT"
+    )
+    parser.add_argument(
+        '--card',
+        help    = "Card CID (or its beginning) for '--registry card'.\n" +
+                  "Default: card in --device.",
+        metavar = "CID"
+    )
+    parser.add_argument(
+        '--capture',
+        help    = "Read card (--device) back into the image store as NAME.",
+        metavar = "NAME"
+    )
+    parser.add_argument(
+        '--compression',
+        help    = "Image store compression for --capture. Default: '{}'".format(
+            App.Store.compression
+        ),
+        choices = ["xz", "gz", "none"],
+        default = App.Store.compression
+    )
+    parser.add_argument(
+        '--shrink',
+        help    = "With --capture, shrink root filesystem and image.",
+        action  = 'store_true'
+    )
+    parser.add_argument(
+        '--optimise',
+        help    = "Shrink root filesystem of (uncompressed) IMAGE file\n" +
+                  "and truncate the file, then exit.",
+        metavar = "IMAGE"
+    )
+    parser.add_argument(
+        '--nohostkeys',
+        help    = "Do not install pre-generated SSH host keys and TLS\n" +
+                  "certificate (unit generates them on first boot).",
+        action  = 'store_true'
+    )
+    parser.add_argument(
+        '--fill-keys',
+        help    = "Generate SSH host key sets into the pool until {} are\n".format(
+                      App.Keys.size
+                  ) + "ready, then exit.",
+        action  = 'store_true'
+    )
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        '--expand',
+        help    = "Expand root partition to fill the card. Default for\n" +
+                  "shrunk (--shrink) store images only.",
+        action  = 'store_true'
+    )
+    group.add_argument(
+        '--noexpand',
+        help    = "Do not expand root partition, not even for shrunk images.",
+        action  = 'store_true'
+    )
     parser.add_argument(
         '-s',
         '--nokeys',
@@ -891,6 +2917,69 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
 
+    #
+    # Special feature - run APT caching proxy and exit
+    #
+    if args.serve_proxy:
+        import urllib.parse
+        address = App.Proxy.bind or \
+                  urllib.parse.urlsplit(args.proxy or "").hostname
+        if not address:
+            print("ERROR: Proxy LAN address unknown! Set 'bind' or 'url' in [Proxy]")
+            os._exit(1)
+        try:
+            serve_proxy(
+                address, App.Proxy.port, App.Proxy.cache, App.Proxy.maxsize,
+                App.Proxy.hosts
+            )
+        except OSError as e:
+            print(e)
+            print("Starting APT caching proxy failed!")
+            os._exit(-1)
+        os._exit(0)
+    App.Proxy.url = None if args.noproxy else args.proxy
+
+    #
+    # Special feature - run git mirror and exit
+    #
+    if args.serve_git:
+        installer = App.Installer.run or "install.py"
+        if installer[:1] != '/':
+            installer = App.Script.path + "/" + installer
+        serve_git(
+            App.Mirror.port,
+            App.Mirror.directory,
+            installer_repositories(installer) + App.Mirror.repositories,
+            App.Mirror.interval
+        )
+        os._exit(0)
+
+
+    #
+    # Special feature - card registry report and exit
+    # (card in a reader can be identified without root)
+    #
+    if args.registry:
+        cid = args.card
+        if args.registry == "card" and not cid:
+            if not args.write_to_device:
+                print("ERROR: '--registry card' needs --card CID or --device")
+                os._exit(1)
+            cid = card_identity(args.write_to_device.split('/')[-1])["cid"]
+            if not cid:
+                print("Card reader does not expose card CID!")
+                os._exit(1)
+        try:
+            registry = CardRegistry(App.Registry.database)
+            registry_report(registry, args.registry, cid)
+            registry.close()
+        except Exception as e:
+            print(e)
+            print("Registry query failed!")
+            os._exit(-1)
+        os._exit(0)
+
+
     #
     # Require root user
     # Checked here so that non-root user can still get help displayed
@@ -910,6 +2999,86 @@ if __name__ == '__main__':
     # Print header
     #
     print(HEADER)
+
+    store = ImageStore(os.path.join(App.Script.path, App.Store.directory))
+    keypool = KeyPool(
+        App.Keys.pool,
+        App.Keys.size,
+        App.Keys.types,
+        App.Keys.tls_cn,
+        App.Keys.tls_key,
+        App.Keys.stale
+    )
+
+    #
+    # Special feature - fill host key pool and exit
+    #
+    if args.fill_keys:
+        print("Filling key pool '{}'... ".format(App.Keys.pool), end = '', flush = True)
+        start = time.time()
+        try:
+            count = keypool.fill()
+        except Exception as e:
+            print(e)
+            print("Key generation failed!")
+            os._exit(-1)
+        print(
+            "{} set(s) generated in {:.1f}s, {} ready".format(
+                count, time.time() - start, len(keypool.ready())
+            )
+        )
+        os._exit(0)
+
+    #
+    # Special feature - optimise image file and exit
+    #
+    if args.optimise:
+        if image_compression(args.optimise):
+            print("Compressed images cannot be optimised!")
+            os._exit(1)
+        print("Optimising '{}'... ".format(args.optimise), end = '', flush = True)
+        try:
+            result = optimise_image(args.optimise, App.Store.headroom)
+        except Exception as e:
+            print(e)
+            print("Optimising failed!")
+            os._exit(-1)
+        print(
+            "{:.0f} MB -> {:.0f} MB".format(
+                result["before"] / 1024**2, result["after"] / 1024**2
+            )
+        )
+        os._exit(0)
+
+    #
+    # Special feature - capture card into the image store and exit
+    #
+    if args.capture:
+        App.blkdev = choose_disk(args.write_to_device).split('/')[-1]
+        print("Capturing '/dev/{}' as '{}'...".format(App.blkdev, args.capture))
+        try:
+            filename = capture_image(
+                App.blkdev,
+                store,
+                args.capture,
+                None if args.compression == "none" else args.compression,
+                args.shrink
+            )
+        except Exception as e:
+            print(e)
+            print("Capture failed!")
+            os._exit(-1)
+        info = store.index()[os.path.basename(filename)]
+        print(
+            "Image '{}': {:.0f} MB, {:.0f} MB data, {:.0f} MB stored, {:.0f}s".format(
+                filename,
+                info["size"] / 1024**2,
+                info["allocated"] / 1024**2,
+                info["stored"] / 1024**2,
+                info["seconds"]
+            )
+        )
+        os._exit(0)
     print(
         "Creating",
         args.mode,      # Not yet in App data structure...
@@ -919,6 +3088,12 @@ if __name__ == '__main__':
     )
 
 
+    App.writer = args.writer
+    App.verify = args.verify
+    App.discard = args.discard
+    App.Keys.selected = not args.nohostkeys
+
+
     #
     # Disable ssh/ -files copy?
     #
@@ -942,7 +3117,10 @@ if __name__ == '__main__':
     #
     # Work out Rasbian image files to choose from
     #
-    App.image = choose_image_file(App.Script.path)
+    App.image = choose_image_file(App.Script.path, store)
+    if image_compression(App.image) and App.writer == "dd":
+        print("Compressed image, using native writer")
+        App.writer = "native"
 
 
     #
@@ -981,6 +3159,98 @@ if __name__ == '__main__':
     # Write and configure SD / target disk
     #
 
+    #
+    # Write block size for the card model (probed, if model is new)
+    #   Probe writes into the area that the image then overwrites.
+    #
+    started = time.time()
+    timing  = {}
+    card    = card_identity(App.blkdev)
+    tuning  = TuningCache(App.Tuning.cache)
+    params = tuning.get(card["model"])
+    if args.probe or not args.noprobe and (
+        App.Tuning.probe == "always" or
+        App.Tuning.probe == "auto" and params is None
+    ):
+        print(
+            "Probing '{}' ({})... ".format(App.blkdev, card["model"]),
+            end = '', flush = True
+        )
+        start = time.time()
+        try:
+            params = probe_card(
+                "/dev/" + App.blkdev,
+                App.Tuning.sizes,
+                App.Tuning.offset,
+                App.Tuning.length
+            )
+            params["probed"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            tuning.put(card["model"], params)
+            print(
+                "{} kB ({} MB/s)".format(
+                    params["blocksize"] // 1024,
+                    params["results"][str(params["blocksize"])]
+                )
+            )
+        except OSError as e:
+            print("failed ({})".format(e))
+        timing["probe_s"] = time.time() - start
+    if params:
+        App.blocksize = params["blocksize"]
+
+
+    #
+    # Discard (TRIM) card before writing
+    #   Card controller gets to start from erased blocks instead of doing
+    #   read-modify-write over old data. If discarded blocks read back as
+    #   zeros, native writer can also skip writing them.
+    #
+    sparse  = False
+    zeros   = True
+    discarded = None
+    if App.discard:
+        device = "/dev/" + App.blkdev
+        if App.discard == "unwritten" and not image_compression(App.image):
+            ranges = unwritten_ranges(App.image, device_size(device))
+            zeros  = False
+        else:
+            ranges = [(0, device_size(device))]
+        print(
+            "Discarding {:.0f} MB of '{}'... ".format(
+                sum(length for _, length in ranges) / 1024**2, App.blkdev
+            ),
+            end = '', flush = True
+        )
+        try:
+            discarded = discard_device(device, ranges)
+            timing["discard_s"] = discarded
+            print("{:.1f}s".format(discarded))
+            if App.writer == "native":
+                sparse = discard_zeroes(device, ranges)
+                if not sparse:
+                    print("Discarded blocks do not read as zeros, writing all")
+        except OSError as e:
+            print("not supported ({})".format(e))
+
+
+    #
+    # Pre-generated SSH host keys (and TLS certificate) for the unit
+    #   Pool is refilled in the background while the image is written (CPU
+    #   is idle meanwhile). A set is taken only when it is installed, so
+    #   that a failed write does not leave a claimed set behind.
+    #
+    refill = None
+    if App.Keys.selected:
+        import threading
+        def fill_pool():
+            try:
+                keypool.fill()
+            except Exception as e:
+                print("WARNING: Key pool refill failed ({})".format(e))
+        refill = threading.Thread(target = fill_pool, name = "keypool")
+        refill.start()
+
+
     #
     # Write image
     #
@@ -988,18 +3258,88 @@ if __name__ == '__main__':
         "Writing Rasbian image to block device '{}'... ".format(App.blkdev),
         end = '', flush = True
     )
-    do_or_die(
-        "dd if={} of=/dev/{} bs=4M conv=fsync".format(
-            App.image,
-            App.blkdev
+    start = time.time()
+    size = os.path.getsize(App.image)
+    written = size
+    skipped = 0
+    if App.writer == "native":
+        try:
+            written, skipped = write_image(
+                App.image, "/dev/" + App.blkdev, App.blocksize,
+                sparse = sparse, zeros = zeros
+            )
+            size = written + skipped
+        except Exception as e:
+            print(e)
+            print("Writing image failed!")
+            os._exit(-1)
+    else:
+        do_or_die(
+            "dd if={} of=/dev/{} bs={} conv=fsync".format(
+                App.image,
+                App.blkdev,
+                App.blocksize
+            )
         )
-    )
+    elapsed = time.time() - start
+    timing["write_s"] = elapsed
+    if App.verify:
+        print("Verifying... ", end = '', flush = True)
+        start = time.time()
+        verified = verify_image(App.image, "/dev/" + App.blkdev)
+        timing["verify_s"] = time.time() - start
+        if not verified:
+            print("FAILED!")
+            print("Written image does not match '{}'!".format(App.image))
+            register_write(
+                store, card, timing, started, size, written, "FAILED",
+                verified = False
+            )
+            os._exit(-1)
+    expanded = 0
+    # Shrunk images have only 'headroom' free - stock images are left to
+    # Raspbian's own first boot resize, as before
+    if args.expand or \
+       (not args.noexpand and store.entry(App.image).get("shrunk")):
+        start = time.time()
+        try:
+            expanded = expand_root(App.blkdev)
+            timing["expand_s"] = time.time() - start
+        except Exception as e:
+            print(e)
+            print("Root partition expansion failed!")
+            os._exit(-1)
     # For unknown reason, immediate mount after dd has high chance of failure.
     # Sleep some...
     time.sleep(3)
     # First, write directly into the App.summary to get differnt kind of indent
+    configured = time.time()
     App.summary = "\n/dev/{}:\n".format(App.blkdev)
-    App.report("Rasbian image '{}'".format(App.image))
+    App.report(
+        "Rasbian image '{}' ({}, {:.1f} MB/s{})".format(
+            App.image,
+            App.writer,
+            size / 1024**2 / max(elapsed, 0.001),
+            ", verified" if App.verify else ""
+        )
+    )
+    App.report(
+        "Block size {} kB{} ({})".format(
+            App.blocksize // 1024,
+            ", tuned" if params else "",
+            card["model"]
+        )
+    )
+    if discarded is not None:
+        App.report(
+            "Discarded ({}) in {:.1f}s, {:.0f} MB not written".format(
+                App.discard, discarded, skipped / 1024**2
+            )
+        )
+    if expanded:
+        App.report(
+            "Root partition expanded by {:.0f} MB".format(expanded / 1024**2)
+        )
     print("Done!")
 
 
@@ -1061,6 +3401,9 @@ if __name__ == '__main__':
         with open("/mnt/install.config", "w+") as file:
             file.write("[Config]\n")
             file.write("mode = {}\n".format(App.Mode.selected))
+            if App.Mirror.url:
+                file.write("[Mirror]\n")
+                file.write("url = {}\n".format(App.Mirror.url))
         App.report("/boot/install.config")
         print("Done!")
 
@@ -1133,6 +3476,18 @@ if __name__ == '__main__':
             print("Done!")
 
 
+        #
+        # APT caching proxy
+        #
+        if App.Proxy.url:
+            print(
+                "Configuring APT proxy... ",
+                end = '', flush = True
+            )
+            setup_apt_proxy(App.Proxy.url)
+            print("Done!")
+
+
         #
         # Bash customisation for user 'pi'
         #
@@ -1170,6 +3525,35 @@ if __name__ == '__main__':
                 )
 
 
+        #
+        # Pre-generated SSH host keys and TLS certificate
+        #
+        keyset = None
+        if App.Keys.selected:
+            try:
+                keyset = keypool.take()
+            except Exception as e:
+                print("WARNING: No pre-generated host keys ({})".format(e))
+        if keyset:
+            print(
+                "Installing SSH host keys...",
+                end = "", flush = True
+            )
+            try:
+                files = install_host_keys("/mnt", keyset, App.Keys.tls_cn)
+            finally:
+                # Used (or partially copied) - never handed out again
+                keypool.release(keyset)
+            print("Done!")
+            App.report(
+                "SSH host keys ({}){} pre-generated".format(
+                    ", ".join(App.Keys.types),
+                    " and TLS certificate for '{}'".format(App.Keys.tls_cn)
+                    if App.Keys.tls_cn else ""
+                )
+            )
+
+
         #
         # Git configuration (/home/pi/.gitconfig)
         #
@@ -1194,26 +3578,29 @@ if __name__ == '__main__':
 
 
         #
-        # Run Once init.d script
+        # Run Once systemd service
         #
         if App.Installer.run:
             print(
-                "Creating run-once init.d script...",
+                "Creating run-once systemd service...",
                 end = "", flush = True
             )
-            script = App.Installer.initdscript
-            script.content = script.content.replace(
+            unit = App.Installer.service
+            unit.content = unit.content.replace(
                 "{{installer}}",
                 "/boot/" + os.path.basename(App.Installer.run)
             )
-            with open("/mnt" + App.Installer.initdscript.name, "w") as file:
-                file.write(script.content)
-                os.chmod(
-                    "/mnt" + App.Installer.initdscript.name,
-                    App.Installer.initdscript.permissions
+            with open("/mnt" + unit.name, "w") as file:
+                file.write(unit.content)
+            os.chmod("/mnt" + unit.name, unit.permissions)
+            # Enable by linking it (as 'systemctl enable' would)
+            shell(
+                "ln -s -f {} /mnt/etc/systemd/system/multi-user.target.wants/{}".format(
+                    unit.name, os.path.basename(unit.name)
                 )
+            )
             App.report(
-                "Run Once init.d script for '{}'".format(
+                "Run Once systemd service for '{}'".format(
                     App.Installer.run
                 )
             )
@@ -1223,6 +3610,11 @@ if __name__ == '__main__':
 
     except Exception as e:
         App.report("EXCEPTION: " + str(e))
+        timing["configure_s"] = time.time() - configured
+        register_write(
+            store, card, timing, started, size, written, "EXCEPTION",
+            verified = App.verify or None
+        )
         raise
 
     finally:
@@ -1236,14 +3628,29 @@ if __name__ == '__main__':
         do_or_die("umount /mnt")
         print("Done!")
 
+    if refill:
+        refill.join()
+    timing["configure_s"] = time.time() - configured
+    register_write(
+        store, card, timing, started, size, written, "OK",
+        verified = App.verify or None
+    )
     print("Rasbian image write and configuration is complete!")
     print(App.summary)
     print("You can safely remove the uSD card now.")
     print("Next:")
     print("\t1. Insert the uSD into PateMonitor Raspberry and start it up.")
-    print("\t2. Login as pi/raspberry.")
-    print("\t3. Run install.py ('sudo /boot/install.py')")
-    print("\t4. Follow the instructions provided by install.py")
+    if App.Installer.run:
+        print("\t2. {} runs automatically on first boot.".format(
+                os.path.basename(App.Installer.run)
+            )
+        )
+        print("\t3. Login as pi/raspberry to follow the progress:")
+        print("\t   'systemctl status run-once', 'journalctl -u run-once -f'")
+    else:
+        print("\t2. Login as pi/raspberry.")
+        print("\t3. Run install.py ('sudo /boot/install.py')")
+        print("\t4. Follow the instructions provided by install.py")
     # some sounds to wake user up on completion
     for _ in range(0, 4):
         sys.stdout.write('\a')